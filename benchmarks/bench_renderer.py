@@ -0,0 +1,211 @@
+"""
+Micro-benchmark renderer hasil ekstraksi.
+
+Membandingkan formatter lama (f-string per respons, lookup anggota KK O(n^2),
+teks polos via regex emoji) dengan DocumentRenderer yang dikompilasi sekali.
+
+Jalankan dari root repository:
+    python benchmarks/bench_renderer.py [jumlah_anggota_kk]
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import DOCUMENT_TYPES, render_extraction_response  # noqa: E402
+
+# Salinan formatter lama sebagai baseline
+def legacy_render_ktp(parsed):
+    result = (
+        "🆔 *HASIL EKSTRAKSI KTP* 🆔\n"
+        "━━━━━━━━━━━━━━━━━━━━━━\n\n"
+        f"📌 *NIK:* `{parsed.get('nik', 'Tidak terdeteksi')}`\n"
+        f"👤 *Nama:* {parsed.get('nama', 'Tidak terdeteksi')}\n"
+        f"🎂 *TTL:* {parsed.get('tempat_tanggal_lahir', 'Tidak terdeteksi')}\n"
+        f"⚧️ *Jenis Kelamin:* {parsed.get('jenis_kelamin', 'Tidak terdeteksi')}\n"
+        f"🩸 *Golongan Darah:* {parsed.get('golongan_darah', 'Tidak terdeteksi')}\n\n"
+        "📍 *DOMISILI* 📍\n"
+        f"🏠 *Alamat:* {parsed.get('alamat', 'Tidak terdeteksi')}\n"
+        f"🏘️ *RT/RW:* {parsed.get('rt_rw', 'Tidak terdeteksi')}\n"
+        f"🏙️ *Kel/Desa:* {parsed.get('kel_desa', 'Tidak terdeteksi')}\n"
+        f"🌆 *Kecamatan:* {parsed.get('kecamatan', 'Tidak terdeteksi')}\n\n"
+        "ℹ️ *INFORMASI LAINNYA* ℹ️\n"
+        f"🕌 *Agama:* {parsed.get('agama', 'Tidak terdeteksi')}\n"
+        f"💍 *Status Perkawinan:* {parsed.get('status_perkawinan', 'Tidak terdeteksi')}\n"
+        f"💼 *Pekerjaan:* {parsed.get('pekerjaan', 'Tidak terdeteksi')}\n"
+        f"🌐 *Kewarganegaraan:* {parsed.get('kewarganegaraan', 'Tidak terdeteksi')}\n"
+        f"⏱️ *Berlaku Hingga:* {parsed.get('berlaku_hingga', 'Tidak terdeteksi')}\n"
+        f"📅 *Dikeluarkan di:* {parsed.get('dikeluarkan_di', 'Tidak terdeteksi')}\n\n"
+        "━━━━━━━━━━━━━━━━━━━━━━\n"
+        "⚠️ *PERHATIAN:* _Gunakan informasi ini hanya untuk keperluan yang sah dan legal. Penyalahgunaan data pribadi dapat dikenakan sanksi hukum._"
+    )
+    return result
+
+def legacy_render_kk(parsed):
+    # Format data kepala keluarga
+    kepala_keluarga = parsed.get('kepala_keluarga', {})
+    
+    result = (
+        "👨‍👩‍👧‍👦 *HASIL EKSTRAKSI KARTU KELUARGA* 👨‍👩‍👧‍👦\n"
+        "━━━━━━━━━━━━━━━━━━━━━━\n\n"
+        f"📝 *Nomor KK:* `{parsed.get('nomor_kk', 'Tidak terdeteksi')}`\n"
+        f"🔢 *Kode Keluarga:* {parsed.get('kode_keluarga', 'Tidak terdeteksi')}\n\n"
+        "👑 *DATA KEPALA KELUARGA* 👑\n"
+        f"👤 *Nama:* {kepala_keluarga.get('nama', 'Tidak terdeteksi')}\n"
+        f"🆔 *NIK:* `{kepala_keluarga.get('nik', 'Tidak terdeteksi')}`\n"
+        f"📍 *Alamat:* {kepala_keluarga.get('alamat', 'Tidak terdeteksi')}\n"
+        f"🏘️ *RT/RW:* {kepala_keluarga.get('rt_rw', 'Tidak terdeteksi')}\n"
+        f"🏙️ *Desa/Kelurahan:* {kepala_keluarga.get('desa_kelurahan', 'Tidak terdeteksi')}\n"
+        f"🌆 *Kecamatan:* {kepala_keluarga.get('kecamatan', 'Tidak terdeteksi')}\n"
+        f"🏢 *Kabupaten/Kota:* {kepala_keluarga.get('kabupaten_kota', 'Tidak terdeteksi')}\n"
+        f"📮 *Kode Pos:* {kepala_keluarga.get('kode_pos', 'Tidak terdeteksi')}\n"
+        f"🌏 *Provinsi:* {kepala_keluarga.get('provinsi', 'Tidak terdeteksi')}\n"
+    )
+    
+    # Format data anggota keluarga
+    anggota_keluarga = parsed.get('anggota_keluarga', [])
+    if anggota_keluarga:
+        result += "\n👨‍👩‍👧‍👦 *ANGGOTA KELUARGA* 👨‍👩‍👧‍👦\n"
+        for i, anggota in enumerate(anggota_keluarga, 1):
+            # Tentukan emoji untuk hubungan keluarga
+            status_hubungan = next((s for s in parsed.get('status_hubungan', []) if s.get('nama') == anggota.get('nama')), {})
+            hubungan = status_hubungan.get('hubungan_keluarga', '').lower() if status_hubungan else ''
+            
+            emoji = "👤"
+            if "kepala" in hubungan:
+                emoji = "👨‍💼" if anggota.get('jenis_kelamin', '').lower() == "laki-laki" else "👩‍💼"
+            elif "suami" in hubungan:
+                emoji = "👨"
+            elif "istri" in hubungan:
+                emoji = "👩"
+            elif "anak" in hubungan:
+                emoji = "👦" if anggota.get('jenis_kelamin', '').lower() == "laki-laki" else "👧"
+            
+            result += (
+                f"{emoji} *{i}. {anggota.get('nama', 'Tidak terdeteksi')}*\n"
+                f"   🆔 NIK: `{anggota.get('nik', 'Tidak terdeteksi')}`\n"
+                f"   ⚧️ Jenis Kelamin: {anggota.get('jenis_kelamin', 'Tidak terdeteksi')}\n"
+                f"   🎂 TTL: {anggota.get('tempat_lahir', 'Tidak terdeteksi')}, {anggota.get('tanggal_lahir', 'Tidak terdeteksi')}\n"
+                f"   🕌 Agama: {anggota.get('agama', 'Tidak terdeteksi')}\n"
+                f"   🎓 Pendidikan: {anggota.get('pendidikan', 'Tidak terdeteksi')}\n"
+                f"   💼 Pekerjaan: {anggota.get('pekerjaan', 'Tidak terdeteksi')}\n"
+            )
+                
+            # Tambahkan info status hubungan
+            if status_hubungan:
+                result += (
+                    f"   💍 Status Pernikahan: {status_hubungan.get('status_pernikahan', 'Tidak terdeteksi')}\n"
+                    f"   👨‍👩‍👧‍👦 Hubungan Keluarga: {status_hubungan.get('hubungan_keluarga', 'Tidak terdeteksi')}\n"
+                    f"   🌐 Kewarganegaraan: {status_hubungan.get('kewarganegaraan', 'Tidak terdeteksi')}\n"
+                )
+                
+            # Tambahkan info orang tua
+            orang_tua = next((o for o in parsed.get('orang_tua', []) if o.get('nama') == anggota.get('nama')), {})
+            if orang_tua:
+                result += (
+                    f"   👨‍👩 Orang Tua:\n"
+                    f"   ┣ 👨 Ayah: {orang_tua.get('ayah', 'Tidak terdeteksi')}\n"
+                    f"   ┗ 👩 Ibu: {orang_tua.get('ibu', 'Tidak terdeteksi')}\n"
+                )
+                
+            if i < len(anggota_keluarga):
+                result += "\n"
+    else:
+        result += "\n👥 *Anggota Keluarga:* Tidak terdeteksi\n"
+    
+    # Tambahkan tanggal penerbitan
+    if parsed.get('tanggal_penerbitan'):
+        result += f"\n📅 *Tanggal Penerbitan:* {parsed.get('tanggal_penerbitan')}\n"
+    
+    # Tambahkan catatan penting
+    result += (
+        "\n━━━━━━━━━━━━━━━━━━━━━━\n"
+        "⚠️ *PERHATIAN:* _Gunakan informasi ini hanya untuk keperluan yang sah dan legal. Penyalahgunaan data pribadi dapat dikenakan sanksi hukum._"
+    )
+    
+    return result
+
+LEGACY_EMOJI_PATTERN = re.compile("["
+                                  u"\U0001F600-\U0001F64F"
+                                  u"\U0001F300-\U0001F5FF"
+                                  u"\U0001F680-\U0001F6FF"
+                                  u"\U0001F700-\U0001F77F"
+                                  u"\U0001F780-\U0001F7FF"
+                                  u"\U0001F800-\U0001F8FF"
+                                  u"\U0001F900-\U0001F9FF"
+                                  u"\U0001FA00-\U0001FA6F"
+                                  u"\U0001FA70-\U0001FAFF"
+                                  u"\U00002702-\U000027B0"
+                                  u"\U000024C2-\U0001F251"
+                                  "]+", flags=re.UNICODE)
+
+def legacy_plain_text(markdown):
+    clean_content = LEGACY_EMOJI_PATTERN.sub(r'', markdown.replace('*', '').replace('_', ''))
+    return clean_content.replace('`', '').replace('┣', '-').replace('┗', '-')
+
+def wrap(parsed):
+    return {"status": "success", "data": {"analysis": {"parsed": parsed}}}
+
+KTP_SAMPLE = {
+    "status": "success", "nik": "3201010101010001", "nama": "BUDI SANTOSO",
+    "tempat_tanggal_lahir": "BANDUNG, 01-01-1990", "jenis_kelamin": "LAKI-LAKI",
+    "golongan_darah": "O", "alamat": "JL. MERDEKA NO. 1", "rt_rw": "001/002",
+    "kel_desa": "SUKAJADI", "kecamatan": "SUKASARI", "agama": "ISLAM",
+    "status_perkawinan": "KAWIN", "pekerjaan": "KARYAWAN SWASTA",
+    "kewarganegaraan": "WNI", "berlaku_hingga": "SEUMUR HIDUP", "dikeluarkan_di": "BANDUNG",
+}
+
+def make_kk_sample(members):
+    anggota, status, orang_tua = [], [], []
+    for i in range(members):
+        nama = f"ANGGOTA {i}"
+        anggota.append({
+            "nama": nama, "nik": f"32010101010{i:05d}",
+            "jenis_kelamin": "LAKI-LAKI" if i % 2 else "PEREMPUAN",
+            "tempat_lahir": "BANDUNG", "tanggal_lahir": "01-01-2000", "agama": "ISLAM",
+            "pendidikan": "SLTA/SEDERAJAT", "pekerjaan": "PELAJAR/MAHASISWA",
+        })
+        status.append({
+            "nama": nama, "status_pernikahan": "BELUM KAWIN",
+            "hubungan_keluarga": "KEPALA KELUARGA" if i == 0 else "ANAK", "kewarganegaraan": "WNI",
+        })
+        orang_tua.append({"nama": nama, "ayah": "AYAH", "ibu": "IBU"})
+    return {
+        "status": "success", "nomor_kk": "3201010101010001", "kode_keluarga": "-",
+        "kepala_keluarga": {"nama": "ANGGOTA 0", "nik": "3201010101000000", "alamat": "JL. MERDEKA NO. 1"},
+        "anggota_keluarga": anggota, "status_hubungan": status, "orang_tua": orang_tua,
+        "tanggal_penerbitan": "01-01-2020",
+    }
+
+def bench(label, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    per_call = seconds / number * 1e6
+    print(f"{label:<44} {per_call:10.1f} us/call")
+    return per_call
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    ktp, kk = DOCUMENT_TYPES["ktp"], DOCUMENT_TYPES["kk"]
+    ktp_response, kk_parsed = wrap(KTP_SAMPLE), make_kk_sample(members)
+    kk_response = wrap(kk_parsed)
+
+    # Keluaran markdown harus sama persis dengan formatter lama
+    assert render_extraction_response(ktp, ktp_response)[0] == legacy_render_ktp(KTP_SAMPLE)
+    assert render_extraction_response(kk, kk_response)[0] == legacy_render_kk(kk_parsed)
+
+    print(f"KK dengan {members} anggota\n")
+    for name, legacy, doc, parsed, response in (
+        ("KTP", legacy_render_ktp, ktp, KTP_SAMPLE, ktp_response),
+        ("KK", legacy_render_kk, kk, kk_parsed, kk_response),
+    ):
+        number = 2000 if name == "KTP" else max(20, 20000 // max(members, 1))
+        old = bench(f"{name} lama (markdown + regex teks polos)",
+                    lambda: legacy_plain_text(legacy(parsed)), number)
+        new = bench(f"{name} renderer (markdown + teks polos)",
+                    lambda: render_extraction_response(doc, response), number)
+        print(f"{'':<44} {old / new:10.2f}x\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+NewAClient tiruan dan pembuat MessageEv sintetis untuk benchmark.
+
+FakeClient mencatat setiap send_message/reply_message/send_document beserta
+ID job (job_id_var dari main.py) sehingga latensi end-to-end per pesan dapat
+dihitung, dan melayani download_any dengan bytes gambar yang disiapkan.
+"""
+import asyncio
+import hashlib
+import time
+from collections import Counter
+
+from neonize.events import MessageEv
+from neonize.proto.Neonize_pb2 import JID, MessageInfo, MessageSource
+from neonize.proto.waE2E.WAWebProtobufsE2E_pb2 import (
+    ContextInfo,
+    ExtendedTextMessage,
+    ImageMessage,
+    Message,
+)
+
+class FakeClient:
+    """
+    Pengganti NewAClient untuk handle_message.
+
+    Args:
+        job_id_var: ContextVar ID korelasi job dari main.py
+        download_latency: latensi download_any (detik)
+    """
+
+    def __init__(self, job_id_var, download_latency=0.05):
+        self.job_id_var = job_id_var
+        self.download_latency = download_latency
+        self.media = {}        # fileSHA256 -> bytes gambar
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self.last_send = {}    # job_id -> waktu kirim terakhir (monotonic)
+
+    def register_media(self, data):
+        file_sha = hashlib.sha256(data).digest()
+        self.media[file_sha] = data
+        return file_sha
+
+    def _record(self, method, size):
+        self.calls[method] += 1
+        self.bytes_sent += size
+        self.last_send[self.job_id_var.get()] = time.monotonic()
+
+    async def send_message(self, to, message, *args, **kwargs):
+        self._record("send_message", len(str(message).encode("utf-8")))
+
+    async def reply_message(self, message, quoted, *args, **kwargs):
+        self._record("reply_message", len(str(message).encode("utf-8")))
+
+    async def send_document(self, to, file, caption=None, *args, **kwargs):
+        self._record("send_document", len(file) if isinstance(file, (bytes, bytearray)) else 0)
+
+    async def download_any(self, message):
+        self.calls["download_any"] += 1
+        await asyncio.sleep(self.download_latency)
+        return self.media.get(message.imageMessage.fileSHA256)
+
+def make_jid(user, server="s.whatsapp.net"):
+    return JID(User=user, Server=server)
+
+def make_image_message(client, data):
+    """Message berisi imageMessage; bytes gambar didaftarkan ke client untuk download_any"""
+    file_sha = client.register_media(data)
+    return Message(imageMessage=ImageMessage(
+        mimetype="image/jpeg",
+        fileSHA256=file_sha,
+        fileLength=len(data),
+        mediaKey=hashlib.sha256(b"key" + file_sha).digest(),
+        directPath=f"/v/t62.7118-24/{file_sha.hex()[:16]}",
+        width=1280,
+        height=800,
+    ))
+
+def make_event(message_id, chat, sender, message):
+    return MessageEv(
+        Info=MessageInfo(
+            MessageSource=MessageSource(Chat=chat, Sender=sender, IsGroup=chat.Server == "g.us"),
+            ID=message_id,
+        ),
+        Message=message,
+    )
+
+def make_command_event(message_id, chat, sender, text, quoted=None):
+    """Pesan teks perintah, opsional me-reply (quote) pesan gambar"""
+    if quoted is None:
+        return make_event(message_id, chat, sender, Message(conversation=text))
+    return make_event(message_id, chat, sender, Message(extendedTextMessage=ExtendedTextMessage(
+        text=text,
+        contextInfo=ContextInfo(quotedMessage=quoted),
+    )))
+
+def make_image_event(message_id, chat, sender, image_message):
+    return make_event(message_id, chat, sender, image_message)
@@ -0,0 +1,294 @@
+"""
+Benchmark end-to-end handle_message dengan extractor lokal dan client tiruan.
+
+Setiap skenario mengirim MessageEv sintetis ke main.handle_message, menunggu
+scheduler selesai, lalu mencatat throughput, persentil latensi end-to-end
+(dari pesan masuk sampai balasan terakhir job), peak memori (tracemalloc)
+dan snapshot metrik per tahap dari main.metrics. Waktu `import main` di proses
+baru juga dicatat agar regresi waktu startup terlihat di --compare.
+
+Jalankan dari root repository:
+    python benchmarks/run_scenarios.py                      # semua skenario
+    python benchmarks/run_scenarios.py -s mixed_burst -s kk_large_export
+    python benchmarks/run_scenarios.py --compare benchmarks/results/a.json benchmarks/results/b.json
+
+Hasil disimpan di benchmarks/results/<timestamp>_<commit>.json.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from stub_extractor import StubExtractor  # noqa: E402
+
+# commands: perintah yang dipakai bergiliran; messages: jumlah pesan;
+# chats: jumlah chat berbeda; wave: jumlah pesan yang dikirim sekaligus sebelum
+# menunggu antrean kosong; stub: konfigurasi StubExtractor; batch: jumlah gambar
+# per perintah `batch`; same_image: semua pesan memakai gambar yang sama (cache)
+SCENARIOS = {
+    "ktp_sequential": {"commands": ["ktp"], "messages": 20, "chats": 1, "wave": 1},
+    "mixed_burst": {"commands": ["ktp", "kk", "ijazah", "sim"], "messages": 100, "chats": 10, "wave": 100},
+    "kk_large_export": {
+        "commands": ["kk.xlsx", "kk.csv", "kk.txt"], "messages": 30, "chats": 5, "wave": 30,
+        "stub": {"kk_members": 12, "response_padding": 50_000},
+    },
+    "flaky_extractor": {"commands": ["ktp"], "messages": 50, "chats": 5, "wave": 50, "stub": {"error_rate": 0.2}},
+    "cache_repeat": {"commands": ["ktp"], "messages": 50, "chats": 5, "wave": 50, "same_image": True},
+    # Satu gambar diproses sebagai beberapa jenis dokumen: download dari media cache
+    "media_reuse": {"commands": ["ktp", "kk", "ijazah", "sim"], "messages": 40, "chats": 5, "wave": 40, "same_image": True},
+    "batch_ktp": {"commands": ["batch ktp.json"], "messages": 5, "chats": 5, "wave": 5, "batch": 5},
+    # Obrolan grup biasa tanpa perintah: mengukur biaya ingress per pesan
+    "group_chatter": {
+        "commands": ["halo semua", "ktp saya sudah dikirim belum?", "siap", "wkwk " * 40, "ok nanti sore"],
+        "messages": 20000, "chats": 3, "wave": 20000, "text_only": True,
+    },
+}
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def measure_cold_import(runs=5):
+    """Median waktu `import main` di proses Python baru (tanpa cache modul)"""
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=REPO_DIR, env=dict(os.environ))
+        samples.append(float(output.decode().strip().splitlines()[-1]))
+    return round(percentile(samples, 0.5), 4)
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+async def wait_for_idle(main, timeout):
+    """Menunggu sampai antrean scheduler kosong dan tidak ada job yang berjalan"""
+    scheduler = main.extraction_scheduler
+    deadline = time.monotonic() + timeout
+    while scheduler.in_flight or scheduler.queued:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"jobs did not finish within {timeout}s")
+        await asyncio.sleep(0.01)
+
+async def run_scenario(main, fake_client, stub, name, spec, args):
+    from fake_client import make_command_event, make_image_event, make_image_message, make_jid
+
+    stub.config.update({"latency": args.latency, "jitter": args.jitter, "error_rate": 0.0,
+                        "response_padding": 0, "kk_members": 6})
+    stub.config.update(spec.get("stub", {}))
+    stub.requests = stub.errors = 0
+    main.metrics.reset()
+    main.endpoint_health.clear()
+    fake_client.calls.clear()
+    fake_client.bytes_sent = 0
+    fake_client.last_send.clear()
+    ingress_before = dict(main.ingress_stats)
+
+    base_image = os.urandom(args.image_kb * 1024)
+    commands = spec["commands"]
+    events = []
+    for i in range(spec["messages"]):
+        chat = make_jid(f"120363{i % spec['chats']:06d}", "g.us")
+        sender = make_jid(f"62811{i:07d}")
+        image = base_image if spec.get("same_image") else base_image + f"{name}:{i}".encode()
+        message_id = f"BENCH{name.upper()}{i:05d}"
+        batch = spec.get("batch")
+        if spec.get("text_only"):
+            events.append(make_command_event(message_id, chat, sender, commands[i % len(commands)]))
+        elif batch:
+            # Kirim beberapa gambar dulu, lalu perintah batch tanpa reply
+            for j in range(batch):
+                image_message = make_image_message(fake_client, image + f":{j}".encode())
+                await main.handle_message(fake_client, make_image_event(f"{message_id}IMG{j}", chat, sender, image_message))
+            events.append(make_command_event(message_id, chat, sender, commands[i % len(commands)]))
+        else:
+            quoted = make_image_message(fake_client, image)
+            events.append(make_command_event(message_id, chat, sender, commands[i % len(commands)], quoted))
+
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    scheduler = main.extraction_scheduler
+    started = {}
+    rejected_before = scheduler.rejected
+    submitted = 0
+    t0 = time.monotonic()
+    for offset in range(0, len(events), spec["wave"]):
+        for event in events[offset:offset + spec["wave"]]:
+            started[event.Info.ID] = time.monotonic()
+            await main.handle_message(fake_client, event)
+            submitted += 1
+        await wait_for_idle(main, args.timeout)
+    duration = time.monotonic() - t0
+    peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+
+    latencies = [fake_client.last_send[mid] - t for mid, t in started.items() if mid in fake_client.last_send]
+    stages = {
+        dict(labels).get("stage", "-"): {key: round(value, 6) for key, value in entry.items()}
+        for labels, entry in main.metrics.summaries("stage_seconds").items()
+    }
+    return {
+        "messages": submitted,
+        "rejected": scheduler.rejected - rejected_before,
+        "duration_s": round(duration, 4),
+        "throughput_msg_s": round(submitted / duration, 3) if duration else None,
+        "latency_ms": {
+            key: round(percentile(latencies, q) * 1000, 2) if latencies else None
+            for key, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))
+        },
+        "peak_tracemalloc_bytes": peak,
+        "client_calls": dict(fake_client.calls),
+        "bytes_sent": fake_client.bytes_sent,
+        "ingress": {key: value - ingress_before[key] for key, value in main.ingress_stats.items()},
+        "extractor_requests": stub.requests,
+        "extractor_errors": stub.errors,
+        "stages": stages,
+        "stub": dict(stub.config),
+    }
+
+async def run(args):
+    stub = StubExtractor()
+    base_url = await stub.start()
+
+    # Konfigurasi bot dibaca saat import, jadi environment diisi sebelum import main
+    os.environ.update({
+        "KTP_API_URLS": f"{base_url}/ktp",
+        "KK_API_URLS": f"{base_url}/kk",
+        "IJAZAH_API_URLS": f"{base_url}/ijazah",
+        "SIM_API_URLS": f"{base_url}/sim",
+        "METRICS_PORT": "0",
+        "IMAGE_PREPROCESS_ENABLED": "0",
+        "RESULT_CACHE_DISK_ENABLED": "0",
+        # Stub tidak punya kuota; rate limit dimatikan agar hasil sebanding antar run
+        "EXTRACTOR_RPS": "0",
+        "EXTRACTOR_MAX_IN_FLIGHT": "0",
+        "JOB_WORKERS": str(args.workers),
+        "JOB_QUEUE_MAX": str(args.queue_max),
+        "LOG_LEVEL": args.log_level,
+    })
+    # ClientFactory membuat db.sqlite3 di direktori kerja; pakai direktori sementara
+    workdir = tempfile.mkdtemp(prefix="wa-bench-")
+    os.chdir(workdir)
+    import_started = time.perf_counter()
+    import main
+    import_seconds = time.perf_counter() - import_started
+    main.configure_logging()
+    from fake_client import FakeClient
+
+    main.instrument_client_sends(FakeClient)
+    fake_client = FakeClient(main.job_id_var, download_latency=args.download_latency)
+    main.extraction_scheduler.start()
+
+    results = {}
+    try:
+        for name in args.scenario or list(SCENARIOS):
+            print(f"Running {name}...", flush=True)
+            result = await run_scenario(main, fake_client, stub, name, SCENARIOS[name], args)
+            results[name] = result
+            latency = result["latency_ms"]
+            print(f"  {result['messages']} msgs in {result['duration_s']}s "
+                  f"({result['throughput_msg_s']} msg/s), p50 {latency['p50']} ms, "
+                  f"p95 {latency['p95']} ms, p99 {latency['p99']} ms, "
+                  f"peak {result['peak_tracemalloc_bytes']} bytes", flush=True)
+    finally:
+        await main.extraction_scheduler.stop()
+        await main.close_http_session()
+        await stub.stop()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "workers": args.workers, "queue_max": args.queue_max, "latency": args.latency,
+            "jitter": args.jitter, "download_latency": args.download_latency,
+            "image_kb": args.image_kb, "tracemalloc": tracemalloc.is_tracing(),
+        },
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "startup": {
+            "cold_import_s": measure_cold_import(),
+            "in_process_import_s": round(import_seconds, 4),
+            "phases": main.startup_timer.as_dict()["phases"],
+        },
+        "scenarios": results,
+    }
+
+def compare(base_path, new_path):
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    old_import = base.get("startup", {}).get("cold_import_s")
+    new_import = new.get("startup", {}).get("cold_import_s")
+    if old_import and new_import:
+        print(f"cold import: {old_import * 1000:.0f} ms -> {new_import * 1000:.0f} ms "
+              f"({(new_import - old_import) / old_import * 100:+.0f}%)")
+    print(f"{'scenario':<20} {'msg/s':>18} {'p50 ms':>20} {'p95 ms':>20} {'peak MB':>16}")
+    for name, new_result in new["scenarios"].items():
+        old_result = base["scenarios"].get(name)
+        if old_result is None:
+            continue
+
+        def cell(old, current):
+            if old is None or current is None:
+                return f"{'-':>20}"
+            change = (current - old) / old * 100 if old else 0.0
+            return f"{old:>8.1f}->{current:<8.1f}{change:+5.0f}%"
+
+        old_peak = (old_result["peak_tracemalloc_bytes"] or 0) / 1e6 or None
+        new_peak = (new_result["peak_tracemalloc_bytes"] or 0) / 1e6 or None
+        print(f"{name:<20} {cell(old_result['throughput_msg_s'], new_result['throughput_msg_s'])} "
+              f"{cell(old_result['latency_ms']['p50'], new_result['latency_ms']['p50'])} "
+              f"{cell(old_result['latency_ms']['p95'], new_result['latency_ms']['p95'])} "
+              f"{cell(old_peak, new_peak)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark skenario bot dengan extractor lokal")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--queue-max", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.2, help="latensi dasar extractor (detik)")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--download-latency", type=float, default=0.05)
+    parser.add_argument("--image-kb", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="tanpa pengukuran peak memori")
+    parser.add_argument("--output", help="path file JSON hasil")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="bandingkan dua file hasil")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    output = args.output or os.path.join(BENCH_DIR, "results", f"{time.strftime('%Y%m%d_%H%M%S')}_{git_commit() or 'nogit'}.json")
+    output = os.path.abspath(output)
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+    report = asyncio.run(run(args))
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
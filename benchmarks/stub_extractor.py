@@ -0,0 +1,172 @@
+"""
+Server pengganti API Extractor (Apps Script) untuk benchmark lokal.
+
+Menerima body JSON yang sama dengan API asli ({"action": "process-ktp", ...})
+dan membalas dengan respons sukses berisi data contoh. Latensi, error rate dan
+ukuran respons dapat diatur, baik lewat argumen CLI maupun atribut
+StubExtractor.config saat dipakai in-process oleh run_scenarios.py.
+
+Jalankan terpisah:
+    python benchmarks/stub_extractor.py --port 8099 --latency 0.5 --error-rate 0.05
+lalu arahkan bot ke server ini, mis. KTP_API_URLS=http://127.0.0.1:8099/ktp
+"""
+import argparse
+import asyncio
+import json
+import random
+
+from aiohttp import web
+
+KTP_PARSED = {
+    "status": "success", "nik": "3201010101010001", "nama": "BUDI SANTOSO",
+    "tempat_tanggal_lahir": "BANDUNG, 01-01-1990", "jenis_kelamin": "LAKI-LAKI",
+    "golongan_darah": "O", "alamat": "JL. MERDEKA NO. 1", "rt_rw": "001/002",
+    "kel_desa": "SUKAJADI", "kecamatan": "SUKASARI", "agama": "ISLAM",
+    "status_perkawinan": "KAWIN", "pekerjaan": "KARYAWAN SWASTA",
+    "kewarganegaraan": "WNI", "berlaku_hingga": "SEUMUR HIDUP", "dikeluarkan_di": "BANDUNG",
+}
+
+IJAZAH_PARSED = {
+    "status": "success", "jenis_ijazah": "IJAZAH SMA", "kementerian_penerbit": "KEMENDIKBUD",
+    "nama_institusi": "SMA NEGERI 1 BANDUNG", "akreditasi": "A", "program_studi_jurusan": "IPA",
+    "nama_peserta_didik": "SITI AMINAH", "tempat_tanggal_lahir": "BANDUNG, 02-02-2005",
+    "nama_orang_tua": "AHMAD", "nomor_induk": "12345", "tanggal_penerbitan": "01-06-2023",
+    "pejabat_pengesah": "KEPALA SEKOLAH", "nomor_seri": "DN-02 Ma 0000001",
+}
+
+SIM_PARSED = {
+    "status": "success", "nomor_sim": "1234-5678-000001", "golongan_sim": "C",
+    "nama": "BUDI SANTOSO", "tempat_tanggal_lahir": "BANDUNG, 01-01-1990",
+    "jenis_kelamin": "PRIA", "golongan_darah": "O", "tinggi": "170 cm",
+    "pekerjaan": "SWASTA", "alamat": "JL. MERDEKA NO. 1", "rt_rw": "001/002",
+    "berlaku_hingga": "01-01-2030", "dikeluarkan_di": "POLRESTABES BANDUNG",
+}
+
+def make_kk_parsed(members):
+    anggota, status, orang_tua = [], [], []
+    for i in range(members):
+        nama = f"ANGGOTA {i}"
+        anggota.append({
+            "nama": nama, "nik": f"32010101010{i:05d}",
+            "jenis_kelamin": "LAKI-LAKI" if i % 2 else "PEREMPUAN",
+            "tempat_lahir": "BANDUNG", "tanggal_lahir": "01-01-2000", "agama": "ISLAM",
+            "pendidikan": "SLTA/SEDERAJAT", "pekerjaan": "PELAJAR/MAHASISWA",
+        })
+        status.append({
+            "nama": nama, "status_pernikahan": "BELUM KAWIN",
+            "hubungan_keluarga": "KEPALA KELUARGA" if i == 0 else "ANAK", "kewarganegaraan": "WNI",
+        })
+        orang_tua.append({"nama": nama, "ayah": "AYAH", "ibu": "IBU"})
+    return {
+        "status": "success", "nomor_kk": "3201010101010001", "kode_keluarga": "-",
+        "kepala_keluarga": {"nama": "ANGGOTA 0", "nik": "3201010101000000", "alamat": "JL. MERDEKA NO. 1"},
+        "anggota_keluarga": anggota, "status_hubungan": status, "orang_tua": orang_tua,
+        "tanggal_penerbitan": "01-01-2020",
+    }
+
+class StubExtractor:
+    """
+    Stand-in aiohttp untuk action process-ktp/process-kk/process-ijazah/process-sim.
+
+    config:
+        latency: latensi dasar per request (detik)
+        jitter: tambahan latensi acak maksimum (detik)
+        error_rate: peluang membalas HTTP 500
+        response_padding: byte tambahan di respons (meniru teks OCR mentah)
+        kk_members: jumlah anggota KK di respons process-kk
+    """
+
+    def __init__(self, **config):
+        self.config = {
+            "latency": 0.2,
+            "jitter": 0.05,
+            "error_rate": 0.0,
+            "response_padding": 0,
+            "kk_members": 6,
+        }
+        self.config.update(config)
+        self.requests = 0
+        self.errors = 0
+        self.bytes_received = 0
+        self._runner = None
+        self.port = None
+
+    def parsed_for(self, action):
+        if action == "process-ktp":
+            return KTP_PARSED
+        if action == "process-kk":
+            return make_kk_parsed(self.config["kk_members"])
+        if action == "process-ijazah":
+            return IJAZAH_PARSED
+        if action == "process-sim":
+            return SIM_PARSED
+        return None
+
+    async def handle(self, request):
+        body = await request.read()
+        self.requests += 1
+        self.bytes_received += len(body)
+
+        config = self.config
+        await asyncio.sleep(config["latency"] + random.uniform(0, config["jitter"]))
+
+        if random.random() < config["error_rate"]:
+            self.errors += 1
+            return web.Response(status=500, text="stub extractor error")
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return web.Response(status=400, text="invalid json")
+
+        parsed = self.parsed_for(payload.get("action"))
+        if parsed is None:
+            return web.json_response({"status": "error", "message": "Unknown action", "code": 400})
+
+        analysis = {"parsed": parsed}
+        if config["response_padding"]:
+            analysis["raw_text"] = "x" * config["response_padding"]
+        return web.json_response({"status": "success", "data": {"analysis": analysis}})
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/{doc_type}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.port = self._runner.addresses[0][1]
+        return f"http://{host}:{self.port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+async def serve(args):
+    stub = StubExtractor(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        response_padding=args.response_padding, kk_members=args.kk_members,
+    )
+    base_url = await stub.start(args.host, args.port)
+    print(f"Stub extractor listening on {base_url}/<ktp|kk|ijazah|sim>")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stub.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in lokal untuk API Extractor")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--response-padding", type=int, default=0)
+    parser.add_argument("--kk-members", type=int, default=6)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,226 @@
+import time
+
+# Waktu mulai memuat modul, titik nol laporan durasi fase startup
+STARTUP_STARTED = time.monotonic()
+
 import asyncio
 import logging
+import atexit
+import contextvars
+import copy
+import queue
 import os
 import sys
 import traceback
 import base64
 import json
-import aiohttp
-import requests
+import importlib.util
+import cProfile
+import signal
+import tracemalloc
 import tempfile
-from neonize.aioze.client import ClientFactory, NewAClient
-from neonize.events import (
-    ConnectedEv,
-    MessageEv,
-)
-from neonize.proto.waE2E.WAWebProtobufsE2E_pb2 import Message
-from neonize.utils import log
+import hashlib
+import heapq
+import mmap
+import sqlite3
+import threading
+import random
+import re
+import io
+import csv
+import zipfile
+from collections import OrderedDict, deque
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
+from xml.sax.saxutils import escape as xml_escape
+
+# neonize, thundra_io dan aiohttp di-import saat pertama dipakai agar import
+# modul ini (mis. untuk renderer, tooling atau benchmark) tetap ringan
+if TYPE_CHECKING:
+    from neonize.aioze.client import NewAClient
+    from neonize.events import ConnectedEv, MessageEv
 
-# Tambahkan import dari thundra_io
-from thundra_io.utils import get_message_type, get_user_id
-from thundra_io.types import MediaMessageType
-from thundra_io.storage.file import File
+# Pillow opsional, dipakai untuk preprocessing gambar sebelum upload
+PIL_AVAILABLE = importlib.util.find_spec("PIL") is not None
 
 sys.path.insert(0, os.getcwd())
 
+# Sharding multi-proses: SHARD_COUNT>1 menjalankan supervisor yang membagi device
+# ke SHARD_COUNT proses worker; SHARD_INDEX diisi supervisor untuk setiap worker
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "1"))
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX", "-1"))
+IS_SHARD_SUPERVISOR = SHARD_COUNT > 1 and SHARD_INDEX < 0
+# Penanda proses di log: kosong (satu proses), "supervisor" atau "shard-N"
+LOG_PROCESS_NAME = "" if SHARD_COUNT <= 1 else ("supervisor" if IS_SHARD_SUPERVISOR else f"shard-{SHARD_INDEX}")
+
 # Konfigurasi logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-log.setLevel(logging.DEBUG)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# Level per logger, dipisahkan koma, mis. LOG_LEVELS="wa_extractor.media=DEBUG,aiohttp=WARNING"
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # text atau json
+LOG_FILE = os.environ.get("LOG_FILE", "")
+# Porsi dump diagnostik verbose (atribut protobuf) yang ditulis saat level DEBUG aktif
+LOG_DIAG_SAMPLE_RATE = float(os.environ.get("LOG_DIAG_SAMPLE_RATE", "0.05"))
+# String argumen log lebih panjang dari ini dipotong; nilai bytes hanya ditulis ukurannya
+LOG_MAX_VALUE_CHARS = int(os.environ.get("LOG_MAX_VALUE_CHARS", "500"))
+
+log = logging.getLogger("wa_extractor")
+media_log = logging.getLogger("wa_extractor.media")
+http_log = logging.getLogger("wa_extractor.http")
+diag_log = logging.getLogger("wa_extractor.diag")
+
+# ID korelasi job yang sedang diproses (diisi per job oleh scheduler)
+job_id_var = contextvars.ContextVar("job_id", default="-")
+
+def redact_log_value(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"<{len(value)} bytes>"
+    if isinstance(value, str) and len(value) > LOG_MAX_VALUE_CHARS:
+        return f"{value[:LOG_MAX_VALUE_CHARS]}...(+{len(value) - LOG_MAX_VALUE_CHARS} chars)"
+    return value
+
+class LogContextFilter(logging.Filter):
+    """Menambahkan job_id ke record dan meredaksi argumen biner sebelum pesan digabung"""
+
+    def filter(self, record):
+        record.job_id = job_id_var.get()
+        if isinstance(record.args, tuple):
+            record.args = tuple(redact_log_value(arg) for arg in record.args)
+        elif isinstance(record.args, dict):
+            record.args = {key: redact_log_value(arg) for key, arg in record.args.items()}
+        return True
+
+class LogQueueHandler(QueueHandler):
+    """
+    QueueHandler yang hanya menggabungkan pesan di thread pemanggil; format
+    akhir (text/JSON) dan I/O dikerjakan thread QueueListener.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "job_id": getattr(record, "job_id", "-"),
+            "msg": record.getMessage(),
+        }
+        if LOG_PROCESS_NAME:
+            entry["process"] = LOG_PROCESS_NAME
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+def parse_log_level(value):
+    value = value.strip().upper()
+    return int(value) if value.isdigit() else logging.getLevelName(value)
+
+def configure_logging():
+    """Memasang QueueHandler di root logger dan menjalankan QueueListener untuk I/O log"""
+    if LOG_FORMAT == "json":
+        formatter = JsonLogFormatter()
+    else:
+        process = f"{LOG_PROCESS_NAME} " if LOG_PROCESS_NAME else ""
+        formatter = logging.Formatter(f'%(asctime)s - %(levelname)s - {process}[%(job_id)s] %(name)s - %(message)s')
+
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        handlers.append(logging.FileHandler(LOG_FILE, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(parse_log_level(LOG_LEVEL))
+    for item in LOG_LEVELS.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(parse_log_level(level))
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def should_dump_diagnostics():
+    """Dump diagnostik verbose hanya ditulis jika DEBUG aktif dan lolos sampling"""
+    return diag_log.isEnabledFor(logging.DEBUG) and random.random() < LOG_DIAG_SAMPLE_RATE
+
+def describe_fields(obj):
+    """Field yang terisi pada objek protobuf (nilai biner/panjang diredaksi)"""
+    try:
+        items = [(field.name, value) for field, value in obj.ListFields()]
+    except AttributeError:
+        items = [(name, getattr(obj, name, None)) for name in dir(obj) if not name.startswith('_')]
+    fields = {}
+    for name, value in items:
+        if not isinstance(value, (str, bytes, int, float, bool)):
+            value = str(value)
+        fields[name] = redact_log_value(value)
+    return fields
+
+async def with_job_id(job_id, coro):
+    """Menjalankan coroutine dengan ID korelasi job untuk semua log di dalamnya"""
+    token = job_id_var.set(job_id)
+    profiled = job_profiler.job_started(job_id)
+    try:
+        return await coro
+    finally:
+        if profiled:
+            job_profiler.job_finished(job_id)
+        job_id_var.reset(token)
+
+class StartupTimer:
+    """Durasi fase startup berurutan (detik) sejak modul mulai dimuat"""
+
+    def __init__(self, started):
+        self.started = started
+        self.phases = OrderedDict()
+        self.connected_after = None
+        self._last = started
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    def describe(self):
+        return ", ".join(f"{phase}={seconds * 1000:.0f}ms" for phase, seconds in self.phases.items())
+
+    def report_connected(self):
+        """Dipanggil pada ConnectedEv; hanya koneksi pertama yang dilaporkan"""
+        if self.connected_after is not None:
+            return
+        self.mark("connect")
+        self.connected_after = time.monotonic() - self.started
+        log.info("Startup phases: %s; first connection %.0f ms after start",
+                 self.describe(), self.connected_after * 1000)
+
+    def as_dict(self):
+        return {
+            "phases": {phase: round(seconds, 4) for phase, seconds in self.phases.items()},
+            "connected_after": round(self.connected_after, 4) if self.connected_after is not None else None,
+        }
+
+startup_timer = StartupTimer(STARTUP_STARTED)
 
 # API Extractor configurations
 KTP_API_URL = "https://github.com/classyid/ktp-extraction-api"  # Ganti dengan ID_DEPLOYMENT yang sesuai
@@ -33,1155 +228,4462 @@ KK_API_URL = "https://github.com/classyid/kk-extractor-api"  # Ganti dengan ID_D
 IJAZAH_API_URL = "https://github.com/classyid/ijazah-extractor-api"  # Ganti dengan ID_DEPLOYMENT yang sesuai
 SIM_API_URL = "https://github.com/classyid/sim-extractor-api"  # Ganti dengan ID_DEPLOYMENT yang sesuai
 
+# Konfigurasi HTTP client bersama (connection pool, keep-alive, DNS cache)
+HTTP_POOL_LIMIT = int(os.environ.get("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get("HTTP_POOL_LIMIT_PER_HOST", "20"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_DNS_CACHE_TTL = int(os.environ.get("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "10"))
 
-# Setup client
-client_factory = ClientFactory("db.sqlite3")
-os.makedirs("temp_media", exist_ok=True)
+# Timeout total per endpoint extractor (detik); KK biasanya paling lama diproses
+EXTRACTOR_TIMEOUTS = {
+    "ktp": float(os.environ.get("KTP_API_TIMEOUT", "60")),
+    "kk": float(os.environ.get("KK_API_TIMEOUT", "90")),
+    "ijazah": float(os.environ.get("IJAZAH_API_TIMEOUT", "60")),
+    "sim": float(os.environ.get("SIM_API_TIMEOUT", "60")),
+}
+DEFAULT_HTTP_TIMEOUT = float(os.environ.get("HTTP_DEFAULT_TIMEOUT", "60"))
 
-# Load existing sessions
-sessions = client_factory.get_all_devices()
-for device in sessions:
-    client_factory.new_client(device.JID)
+# Circuit breaker, retry dan timeout adaptif per endpoint extractor
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("BREAKER_RESET_TIMEOUT", "30"))
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "2"))
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", "5"))
+LATENCY_WINDOW = int(os.environ.get("LATENCY_WINDOW", "100"))
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = int(os.environ.get("ADAPTIVE_TIMEOUT_MIN_SAMPLES", "20"))
+ADAPTIVE_TIMEOUT_MULTIPLIER = float(os.environ.get("ADAPTIVE_TIMEOUT_MULTIPLIER", "2.0"))
+ADAPTIVE_TIMEOUT_MIN = float(os.environ.get("ADAPTIVE_TIMEOUT_MIN", "10"))
 
-# Helper function untuk mendapatkan pesan yang dikutip dan jenisnya
-async def get_quoted_message_info(message):
-    has_quoted = False
-    quoted_message = None
-    quoted_type = None
-    
-    try:
-        # Check untuk extended text message
-        if (hasattr(message.Message, 'extendedTextMessage') and 
-            hasattr(message.Message.extendedTextMessage, 'contextInfo') and
-            hasattr(message.Message.extendedTextMessage.contextInfo, 'quotedMessage')):
-            
-            quoted_message = message.Message.extendedTextMessage.contextInfo.quotedMessage
-            has_quoted = True
-            
-            # Coba gunakan thundra_io untuk deteksi tipe
+# Rate limit per endpoint (deployment) extractor: token bucket request/detik + burst,
+# maksimum request bersamaan dan kuota harian (0 = tanpa batas). Dapat di-override
+# per jenis dokumen, mis. KK_API_RPS=1 atau KTP_API_DAILY_QUOTA=20000
+EXTRACTOR_RPS = float(os.environ.get("EXTRACTOR_RPS", "5"))
+EXTRACTOR_BURST = int(os.environ.get("EXTRACTOR_BURST", "5"))
+EXTRACTOR_MAX_IN_FLIGHT = int(os.environ.get("EXTRACTOR_MAX_IN_FLIGHT", "25"))
+EXTRACTOR_DAILY_QUOTA = int(os.environ.get("EXTRACTOR_DAILY_QUOTA", "0"))
+# Hari kuota dimulai tengah malam pada UTC+offset (jam)
+EXTRACTOR_QUOTA_UTC_OFFSET = float(os.environ.get("EXTRACTOR_QUOTA_UTC_OFFSET", "0"))
+# Pemakaian kuota disimpan di sini agar tetap terhitung setelah restart (kosong = hanya memori);
+# hanya dipakai jika ada kuota harian, global atau per jenis dokumen
+EXTRACTOR_QUOTA_DB_PATH = os.environ.get("EXTRACTOR_QUOTA_DB_PATH", "extractor_quota.sqlite3")
+EXTRACTOR_QUOTA_FLUSH_INTERVAL = float(os.environ.get("EXTRACTOR_QUOTA_FLUSH_INTERVAL", "5"))
+# Jika perkiraan antrean melebihi ini (detik), pengguna diminta mencoba lagi nanti
+EXTRACTOR_MAX_WAIT = float(os.environ.get("EXTRACTOR_MAX_WAIT", "120"))
+# Jeda request baru ke endpoint setelah menerima HTTP 429 (detik)
+EXTRACTOR_429_PAUSE = float(os.environ.get("EXTRACTOR_429_PAUSE", "10"))
+
+# Batas download media langsung dari URL (fallback di download_media)
+MEDIA_DOWNLOAD_MAX_BYTES = int(os.environ.get("MEDIA_DOWNLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+MEDIA_DOWNLOAD_CHUNK_SIZE = int(os.environ.get("MEDIA_DOWNLOAD_CHUNK_SIZE", str(64 * 1024)))
+MEDIA_DOWNLOAD_TIMEOUT = float(os.environ.get("MEDIA_DOWNLOAD_TIMEOUT", "30"))
+
+# Strategi download media: hedging ke metode berikutnya setelah MEDIA_HEDGE_DELAY
+# (atau p95 latensi metode setelah MEDIA_STRATEGY_MIN_SAMPLES sampel, dibatasi
+# MIN..MAX), urutan metode dari riwayat MEDIA_STRATEGY_WINDOW hasil terakhir
+MEDIA_HEDGE_DELAY = float(os.environ.get("MEDIA_HEDGE_DELAY", "3"))
+MEDIA_HEDGE_MIN_DELAY = float(os.environ.get("MEDIA_HEDGE_MIN_DELAY", "0.5"))
+MEDIA_HEDGE_MAX_DELAY = float(os.environ.get("MEDIA_HEDGE_MAX_DELAY", "10"))
+MEDIA_STRATEGY_WINDOW = int(os.environ.get("MEDIA_STRATEGY_WINDOW", "50"))
+MEDIA_STRATEGY_MIN_SAMPLES = int(os.environ.get("MEDIA_STRATEGY_MIN_SAMPLES", "5"))
+# Pakai JPEGThumbnail (resolusi rendah, ditandai ke pengguna) jika semua metode gagal
+MEDIA_THUMBNAIL_FALLBACK = os.environ.get("MEDIA_THUMBNAIL_FALLBACK", "1") == "1"
+
+# Cache bytes media yang sudah di-download (key: fileSHA256 atau directPath+mediaKey)
+# sehingga perintah lain pada gambar yang sama tidak men-download ulang. Tier disk
+# (satu file per gambar di MEDIA_CACHE_DIR, dibaca lewat mmap) hanya aktif jika
+# MEDIA_CACHE_DIR diisi; isinya gambar dokumen identitas yang sudah didekripsi
+MEDIA_CACHE_ENABLED = os.environ.get("MEDIA_CACHE_ENABLED", "1") == "1"
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get("MEDIA_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+MEDIA_CACHE_TTL = float(os.environ.get("MEDIA_CACHE_TTL", "3600"))
+MEDIA_CACHE_DIR = os.environ.get("MEDIA_CACHE_DIR", "")
+MEDIA_CACHE_DISK_MAX_BYTES = int(os.environ.get("MEDIA_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Mode upload ke extractor: "stream" (base64 per potongan) atau "json" (payload lama)
+UPLOAD_MODE = os.environ.get("UPLOAD_MODE", "stream").lower()
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", str(48 * 1024)))
+
+# Cache hasil ekstraksi (key: SHA-256 gambar + jenis dokumen)
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "1") == "1"
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "1000"))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", str(6 * 3600)))
+RESULT_CACHE_DISK_ENABLED = os.environ.get("RESULT_CACHE_DISK_ENABLED", "0") == "1"
+RESULT_CACHE_DB_PATH = os.environ.get("RESULT_CACHE_DB_PATH", "extraction_cache.sqlite3")
+
+# Riwayat hasil ekstraksi (SQLite mode WAL) untuk perintah `riwayat` dan `cari`.
+# Opt-in: menyimpan data pribadi (NIK, nomor KK, alamat) dalam bentuk teks biasa
+HISTORY_ENABLED = os.environ.get("HISTORY_ENABLED", "0") == "1"
+HISTORY_DB_PATH = os.environ.get("HISTORY_DB_PATH", "extraction_history.sqlite3")
+# Hasil yang lebih lama dihapus (hari, 0 = simpan selamanya)
+HISTORY_RETENTION_DAYS = float(os.environ.get("HISTORY_RETENTION_DAYS", "30"))
+# Hasil baru ditulis per batch setiap HISTORY_FLUSH_INTERVAL detik atau HISTORY_BATCH_SIZE hasil
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "1"))
+HISTORY_BATCH_SIZE = int(os.environ.get("HISTORY_BATCH_SIZE", "100"))
+HISTORY_LIST_LIMIT = int(os.environ.get("HISTORY_LIST_LIMIT", "10"))
+
+# Scheduler job ekstraksi (jumlah worker dan kapasitas antrean)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_QUEUE_MAX = int(os.environ.get("JOB_QUEUE_MAX", "100"))
+
+# Endpoint metrik Prometheus lokal (METRICS_PORT=0 untuk menonaktifkan)
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+# Jumlah sampel terakhir per tahap untuk menghitung p50/p95/p99
+METRICS_WINDOW = int(os.environ.get("METRICS_WINDOW", "1024"))
+
+# Supervisor shard: backoff restart worker yang crash dan scrape metrik/health worker
+SHARD_RESTART_DELAY = float(os.environ.get("SHARD_RESTART_DELAY", "1"))
+SHARD_RESTART_MAX_DELAY = float(os.environ.get("SHARD_RESTART_MAX_DELAY", "60"))
+# Worker yang hidup lebih lama dari ini dianggap stabil; backoff restart direset
+SHARD_STABLE_UPTIME = float(os.environ.get("SHARD_STABLE_UPTIME", "60"))
+SHARD_SCRAPE_TIMEOUT = float(os.environ.get("SHARD_SCRAPE_TIMEOUT", "2"))
+# Port metrik worker ke-i = SHARD_METRICS_BASE_PORT + i (0 = METRICS_PORT + 1)
+SHARD_METRICS_BASE_PORT = int(os.environ.get("SHARD_METRICS_BASE_PORT", "0"))
+
+# Profiling on-demand (perintah admin `profile` atau sinyal SIGUSR1/SIGUSR2)
+# ADMIN_NUMBERS: nomor WhatsApp (tanpa +) yang boleh memakai perintah admin
+ADMIN_NUMBERS = {number.strip() for number in os.environ.get("ADMIN_NUMBERS", "").split(",") if number.strip()}
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_DEFAULT_JOBS = int(os.environ.get("PROFILE_DEFAULT_JOBS", "10"))
+PROFILE_MAX_JOBS = int(os.environ.get("PROFILE_MAX_JOBS", "500"))
+PROFILE_MAX_WINDOW = float(os.environ.get("PROFILE_MAX_WINDOW", "3600"))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_TRACEMALLOC_FRAMES = int(os.environ.get("PROFILE_TRACEMALLOC_FRAMES", "10"))
+PROFILE_TOP_STATS = int(os.environ.get("PROFILE_TOP_STATS", "30"))
+
+# Ekstraksi batch (perintah `batch ktp [N]` atas N gambar terakhir di chat)
+BATCH_MAX_IMAGES = int(os.environ.get("BATCH_MAX_IMAGES", "10"))
+# Gambar batch yang diproses bersamaan, total untuk semua job batch yang berjalan
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+RECENT_IMAGE_CHATS = int(os.environ.get("RECENT_IMAGE_CHATS", "500"))
+
+# Deteksi otomatis jenis dokumen (perintah `auto`) dan fallback saat salah perintah
+AUTO_MAX_CANDIDATES = int(os.environ.get("AUTO_MAX_CANDIDATES", "2"))
+AUTO_FALLBACK_ENABLED = os.environ.get("AUTO_FALLBACK_ENABLED", "0") == "1"
+
+# Filter pesan masuk sebelum parsing: allow-list chat/pengirim (kosong = semua),
+# dan panjang maksimum teks yang masih mungkin berupa perintah
+INGRESS_ALLOWED_CHATS = frozenset(
+    chat.strip() for chat in os.environ.get("INGRESS_ALLOWED_CHATS", "").split(",") if chat.strip()
+)
+INGRESS_ALLOWED_SENDERS = frozenset(
+    sender.strip() for sender in os.environ.get("INGRESS_ALLOWED_SENDERS", "").split(",") if sender.strip()
+)
+INGRESS_IGNORE_FROM_ME = os.environ.get("INGRESS_IGNORE_FROM_ME", "0") == "1"
+INGRESS_MAX_COMMAND_CHARS = int(os.environ.get("INGRESS_MAX_COMMAND_CHARS", "64"))
+
+# Preprocessing gambar (rotasi EXIF, resize, re-encode JPEG) sebelum upload
+IMAGE_PREPROCESS_ENABLED = os.environ.get("IMAGE_PREPROCESS_ENABLED", "1") == "1"
+IMAGE_PREPROCESS_WORKERS = int(os.environ.get("IMAGE_PREPROCESS_WORKERS", "2"))
+IMAGE_PREPROCESS_MIN_BYTES = int(os.environ.get("IMAGE_PREPROCESS_MIN_BYTES", str(300 * 1024)))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", "85"))
+# Sisi terpanjang maksimum per jenis dokumen; KK butuh resolusi lebih tinggi
+IMAGE_MAX_EDGE = {
+    "ktp": int(os.environ.get("KTP_IMAGE_MAX_EDGE", "1600")),
+    "kk": int(os.environ.get("KK_IMAGE_MAX_EDGE", "2400")),
+    "ijazah": int(os.environ.get("IJAZAH_IMAGE_MAX_EDGE", "2000")),
+    "sim": int(os.environ.get("SIM_IMAGE_MAX_EDGE", "1280")),
+}
+
+
+# Setup client (dibuat oleh create_client_factory saat startup)
+DB_PATH = os.environ.get("DB_PATH", "db.sqlite3")
+client_factory = None
+
+# Metrik latensi per tahap, counter dan gauge dalam format teks Prometheus
+METRICS_NAMESPACE = "wa_extractor"
+METRIC_QUANTILES = (0.5, 0.95, 0.99)
+
+class StageSummary:
+    """Kuantil dari jendela sampel terakhir, serta jumlah dan total kumulatif"""
+
+    __slots__ = ("window", "count", "total")
+
+    def __init__(self, window):
+        self.window = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.window.append(value)
+        self.count += 1
+        self.total += value
+
+    def quantiles(self):
+        values = sorted(self.window)
+        if not values:
+            return []
+        return [(q, values[min(len(values) - 1, int(q * len(values)))]) for q in METRIC_QUANTILES]
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_metric_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels) + "}"
+
+class Metrics:
+    """
+    Registry metrik in-process.
+
+    Summary dipakai untuk latensi (kuantil p50/p95/p99 dari jendela sampel
+    terakhir), counter untuk jumlah kejadian per label, dan gauge dibaca dari
+    callback saat endpoint di-scrape sehingga tidak ada biaya di hot path.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._meta = {}       # name -> (type, help)
+        self._summaries = {}  # (name, labels) -> StageSummary
+        self._counters = {}   # (name, labels) -> value
+        self._gauges = {}     # name -> callback() -> float
+        self._gauge_families = {}  # name -> callback() -> iterable (labels dict, float)
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        summary = self._summaries.get(key)
+        if summary is None:
+            summary = self._summaries[key] = StageSummary(self.window)
+        summary.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def gauge(self, name, help_text, callback, kind="gauge"):
+        self.describe(name, kind, help_text)
+        self._gauges[name] = callback
+
+    def gauge_family(self, name, help_text, callback, kind="gauge"):
+        """Gauge berlabel; callback mengembalikan iterable (dict label, nilai)"""
+        self.describe(name, kind, help_text)
+        self._gauge_families[name] = callback
+
+    def counter_value(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def summaries(self, name):
+        """Snapshot summary name: {labels: {"count", "sum", "p50", "p95", "p99"}}"""
+        result = {}
+        for (summary_name, labels), summary in self._summaries.items():
+            if summary_name != name:
+                continue
+            entry = {"count": summary.count, "sum": summary.total}
+            for q, value in summary.quantiles():
+                entry[f"p{int(q * 100)}"] = value
+            result[labels] = entry
+        return result
+
+    def reset(self):
+        """Mengosongkan summary dan counter (gauge tetap terdaftar)"""
+        self._summaries.clear()
+        self._counters.clear()
+
+    def render(self):
+        """Seluruh metrik dalam format teks Prometheus (version 0.0.4)"""
+        families = {}
+        for (name, labels), summary in self._summaries.items():
+            family = families.setdefault(name, [])
+            for q, value in summary.quantiles():
+                family.append(f"{METRICS_NAMESPACE}_{name}{format_metric_labels(labels + (('quantile', q),))} {value:.6f}")
+            family.append(f"{METRICS_NAMESPACE}_{name}_sum{format_metric_labels(labels)} {summary.total:.6f}")
+            family.append(f"{METRICS_NAMESPACE}_{name}_count{format_metric_labels(labels)} {summary.count}")
+        for (name, labels), value in self._counters.items():
+            families.setdefault(name, []).append(f"{METRICS_NAMESPACE}_{name}{format_metric_labels(labels)} {value}")
+        for name, callback in self._gauges.items():
             try:
-                msg_type = get_message_type(quoted_message)
-                if isinstance(msg_type, MediaMessageType):
-                    quoted_type = msg_type.__class__.__name__.lower().replace('message', '')
-                    log.info(f"Detected quoted {quoted_type} message using thundra_io")
+                value = float(callback())
             except Exception as e:
-                log.error(f"Error using thundra_io for type detection: {e}")
-            
-            # Fallback ke metode deteksi lama jika thundra_io gagal
-            if not quoted_type:
-                if hasattr(quoted_message, 'videoMessage'):
-                    quoted_type = "video"
-                    log.info("Detected quoted video message")
-                elif hasattr(quoted_message, 'audioMessage'):
-                    quoted_type = "audio"
-                    log.info("Detected quoted audio message")
-                elif hasattr(quoted_message, 'imageMessage'):
-                    quoted_type = "image"
-                    log.info("Detected quoted image message")
-                elif hasattr(quoted_message, 'documentMessage'):
-                    quoted_type = "document"
-                    log.info("Detected quoted document message")
-                else:
-                    log.info("Unknown quoted message type")
-                    # Log atribut
-                    for attr in dir(quoted_message):
-                        if not attr.startswith('_'):
-                            log.info(f"Quoted message has attribute: {attr}")
-    
-    except Exception as e:
-        log.error(f"Error in get_quoted_message_info: {e}")
-        log.error(traceback.format_exc())
-    
-    return has_quoted, quoted_message, quoted_type
+                log.error("Error reading gauge %s: %s", name, e)
+                continue
+            families.setdefault(name, []).append(f"{METRICS_NAMESPACE}_{name} {value}")
+        for name, callback in self._gauge_families.items():
+            try:
+                samples = [(tuple(sorted(labels.items())), float(value)) for labels, value in callback()]
+            except Exception as e:
+                log.error("Error reading gauge %s: %s", name, e)
+                continue
+            family = families.setdefault(name, [])
+            for labels, value in samples:
+                family.append(f"{METRICS_NAMESPACE}_{name}{format_metric_labels(labels)} {value}")
 
-# Fungsi download langsung dari URL jika tersedia
-async def download_from_url(url):
+        lines = []
+        for name in sorted(families):
+            kind, help_text = self._meta.get(name, ("untyped", ""))
+            lines.append(f"# HELP {METRICS_NAMESPACE}_{name} {help_text}")
+            lines.append(f"# TYPE {METRICS_NAMESPACE}_{name} {kind}")
+            lines.extend(families[name])
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRICS_WINDOW)
+metrics.describe("stage_seconds", "summary", "Latency per processing stage in seconds")
+metrics.describe("extractions_total", "counter", "Extractor calls per document type and outcome")
+metrics.describe("download_method_total", "counter", "Media downloads per fallback method that succeeded (failed when all methods failed)")
+metrics.describe("preprocess_images_total", "counter", "Images shrunk by preprocessing before upload")
+metrics.describe("preprocess_bytes_total", "counter", "Image bytes before (in) and after (out) preprocessing, for images that were shrunk")
+metrics.describe("singleflight_total", "counter", "Single-flight calls per flight label (download, extraction) that ran (leader) or joined an in-flight call (coalesced)")
+metrics.describe("cache_requests_total", "counter", "Extraction cache lookups per result")
+metrics.describe("download_attempts_total", "counter", "Media download attempts per method and result (success, failed, cancelled)")
+metrics.describe("extractor_limited_total", "counter", "Extractor requests turned away because the projected rate-limit wait was too long")
+metrics.describe("media_cache_requests_total", "counter", "Media blob cache lookups per result")
+metrics.describe("download_hedges_total", "counter", "Hedged media downloads started because the previous method was slow")
+
+def instrument_client_sends(client_class):
+    """Membungkus send_message/send_document agar latensinya tercatat di stage_seconds"""
+    for method_name in ("send_message", "send_document"):
+        original = getattr(client_class, method_name, None)
+        if original is None or getattr(original, "_metrics_wrapped", False):
+            continue
+
+        async def timed(self, *args, _original=original, _stage=method_name, **kwargs):
+            with metrics.timer("stage_seconds", stage=_stage):
+                return await _original(self, *args, **kwargs)
+        timed._metrics_wrapped = True
+        setattr(client_class, method_name, timed)
+
+async def handle_metrics_request(request):
+    from aiohttp import web
+    return web.Response(body=metrics.render().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def handle_health_request(request):
+    from aiohttp import web
+    return web.json_response({
+        "shard": SHARD_INDEX if SHARD_COUNT > 1 else None,
+        "pid": os.getpid(),
+        "startup": startup_timer.as_dict(),
+        "clients": len(client_factory.clients) if client_factory is not None else 0,
+        "queued": extraction_scheduler.queued,
+        "in_flight": extraction_scheduler.in_flight,
+        "completed": extraction_scheduler.completed,
+        "rejected": extraction_scheduler.rejected,
+        "breakers": get_breaker_states(),
+        "extractors": [limiter.snapshot() for limiter in endpoint_limiters.values()],
+        "result_cache": extraction_cache.stats() if extraction_cache is not None else None,
+        "media_cache": media_cache.stats() if media_cache is not None else None,
+        "preprocess": preprocess_stats,
+        "download_strategy": media_download_strategy.snapshot(),
+        "singleflight": {flight.name: flight.stats() for flight in (download_flight, extraction_flight)},
+    })
+
+async def start_metrics_server(metrics_handler=handle_metrics_request, health_handler=handle_health_request):
+    """Menjalankan endpoint /metrics dan /health lokal; None jika dinonaktifkan atau gagal bind"""
+    if METRICS_PORT <= 0:
+        return None
     try:
-        log.info(f"Downloading from URL: {url}")
-        response = requests.get(url, timeout=30)
-        if response.status_code == 200:
-            log.info(f"Successfully downloaded {len(response.content)} bytes from URL")
-            return response.content
-        else:
-            log.error(f"Failed to download from URL: status code {response.status_code}")
-            return None
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get("/metrics", metrics_handler)
+        app.router.add_get("/health", health_handler)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+        log.info("Metrics endpoint listening on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+        return runner
     except Exception as e:
-        log.error(f"Error downloading from URL: {e}")
-        log.error(traceback.format_exc())
+        log.error("Error starting metrics endpoint: %s", e)
         return None
 
-# Fungsi untuk mengunduh media (image)
-async def download_media(client, quoted_message, quoted_type):
-    try:
-        log.info(f"Starting download process for {quoted_type}")
-        
-        # Hanya fokus pada image untuk Extractor
-        if quoted_type != "image":
-            log.info(f"Media type {quoted_type} not supported for extraction, only images are supported")
-            return None, None, None
-            
-        # Metode 1: Coba menggunakan thundra_io
-        try:
-            log.info("Trying thundra_io approach for image")
-            msg_type = get_message_type(quoted_message)
-            
-            if isinstance(msg_type, MediaMessageType):
-                # Buat File object dari message
-                file_obj = File.from_message(msg_type)
-                
-                # Jika file_obj memiliki method get_content, gunakan
-                if hasattr(file_obj, 'get_content') and callable(file_obj.get_content):
-                    media_bytes = file_obj.get_content()
-                    
-                    # Set default extension dan mime_type
-                    extension = ".jpg"
-                    mime_type = "image/jpeg"
-                    
-                    # Coba dapatkan mime_type dari file_obj jika ada
-                    if hasattr(file_obj, 'mime_type'):
-                        mime_type = file_obj.mime_type
-                    
-                    # Coba dapatkan extension dari file_obj jika ada
-                    if hasattr(file_obj, 'get_extension') and callable(file_obj.get_extension):
-                        ext = file_obj.get_extension()
-                        if ext:
-                            extension = ext
-                    
-                    if media_bytes and len(media_bytes) > 0:
-                        temp_path = f"temp_media/image_thundra_{os.urandom(4).hex()}{extension}"
-                        with open(temp_path, 'wb') as f:
-                            f.write(media_bytes)
-                        log.info(f"Successfully downloaded image using thundra_io: {len(media_bytes)} bytes")
-                        return media_bytes, mime_type, temp_path
-                else:
-                    log.warning("thundra_io File object doesn't have get_content method")
-            else:
-                log.warning("thundra_io did not detect a media message type")
-        except Exception as e:
-            log.error(f"Error in thundra_io approach: {e}")
-            log.error(traceback.format_exc())
-        
-        # Metode 2: Gunakan metode standar
-        media_obj = None
-        message = Message()
-        mime_type = None
-        extension = None
-        
-        if hasattr(quoted_message, 'imageMessage'):
-            media_obj = quoted_message.imageMessage
-            message.imageMessage.CopyFrom(media_obj)
-            mime_type = getattr(media_obj, 'mimetype', "image/jpeg")
-            extension = ".jpg"
+PROFILE_MODES = ("cpu", "cprofile", "mem")
+PROFILE_AMOUNT_RE = re.compile(r"^(\d+)([sm]?)$")
+
+def safe_profile_name(job_id):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", str(job_id))[:80]
+
+def format_folded(samples):
+    """Sampel stack -> format collapsed ("a;b;c 12") untuk flamegraph.pl/speedscope"""
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(samples.items()))
+
+def format_memory_diff(before, after, stage, job_id):
+    """Selisih dua snapshot tracemalloc, diurutkan dari pertambahan alokasi terbesar"""
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    stats = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "lineno")
+    total = sum(stat.size_diff for stat in stats)
+    lines = [f"job {job_id} stage {stage}: {total / 1024:+.1f} KiB total", ""]
+    lines += [str(stat) for stat in stats[:PROFILE_TOP_STATS]]
+    return "\n".join(lines) + "\n"
+
+class JobProfiler:
+    """
+    Profiling on-demand untuk job ekstraksi yang berjalan di produksi.
+
+    Mode:
+        cpu: sampling statistik stack thread event loop; satu file .folded
+             (collapsed stack, siap untuk flamegraph.pl/speedscope) per job.
+             Sampel di luar job (mis. task anak batch) masuk ke _unattributed.folded
+        cprofile: cProfile deterministik selama sesi, ditulis ke session.prof.
+                  Job asyncio saling berselang di satu thread sehingga hasilnya
+                  tidak dapat dipisah per job
+        mem: snapshot tracemalloc sebelum/sesudah download media dan panggilan
+             extractor; selisih alokasi teratas ditulis per job per tahap.
+             Job lain yang berjalan bersamaan ikut terhitung di selisihnya
+
+    Sesi berlaku untuk N job berikutnya atau job yang dimulai dalam jendela
+    waktu, lalu berhenti sendiri setelah semua job yang diprofil selesai.
+    File ditulis di thread executor agar event loop tidak tertahan.
+    """
+
+    def __init__(self, directory, sample_interval):
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self.mode = None
+        self.session_dir = None
+        self.remaining = 0
+        self.deadline = None
+        self.profiled_jobs = 0
+        self._active_jobs = set()
+        self._samples = {}
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._sampler_stop = None
+        self._cprofile = None
+        self._started_tracemalloc = False
+        self._window_handle = None
+
+    @property
+    def active(self):
+        return self.mode is not None
+
+    def start(self, mode, jobs=None, seconds=None):
+        """Memulai sesi baru (sesi lama dihentikan); mengembalikan direktori output"""
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"unknown profiling mode {mode!r}")
+        self.stop()
+        self.session_dir = os.path.join(self.directory, f"{datetime.now():%Y%m%d_%H%M%S}_{mode}")
+        os.makedirs(self.session_dir, exist_ok=True)
+        self.mode = mode
+        self.profiled_jobs = 0
+        if seconds is not None:
+            self.remaining = 0
+            self.deadline = time.monotonic() + seconds
+            self._window_handle = asyncio.get_running_loop().call_later(seconds, self._window_expired)
         else:
-            log.error("Image message attribute not found")
-            return None, None, None
+            self.remaining = PROFILE_DEFAULT_JOBS if jobs is None else jobs
+            self.deadline = None
 
-        # Debug: Print all attributes of media_obj
-        log.info("Media object attributes for image:")
-        for attr in dir(media_obj):
-            if not attr.startswith('_'):
-                try:
-                    val = getattr(media_obj, attr)
-                    log.info(f"{attr}: {val}")
-                except Exception as e:
-                    log.info(f"{attr}: Error retrieving value - {e}")
+        if mode == "cpu":
+            self._sampler_stop = threading.Event()
+            self._sampler = threading.Thread(
+                target=self._sample_loop, args=(threading.get_ident(),), name="job-profiler", daemon=True
+            )
+            self._sampler.start()
+        elif mode == "cprofile":
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        elif not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+            self._started_tracemalloc = True
 
-        # Metode 2a: Gunakan download_any
-        try:
-            log.info("Trying download_any for image")
-            media_bytes = await client.download_any(message)
-            
-            if media_bytes and len(media_bytes) > 0:
-                temp_path = f"temp_media/image_{os.urandom(4).hex()}{extension}"
-                with open(temp_path, 'wb') as f:
-                    f.write(media_bytes)
-                log.info(f"Successfully downloaded image using download_any: {len(media_bytes)} bytes")
-                return media_bytes, mime_type, temp_path
-            else:
-                log.warning("download_any returned empty data for image")
-        except Exception as e:
-            log.error(f"Error in download_any: {e}")
-            log.error(traceback.format_exc())
-
-        # Metode 2b: Coba melalui URL langsung
-        url = None
-        if hasattr(media_obj, 'URL'):
-            url = media_obj.URL
-        elif hasattr(media_obj, 'url'):
-            url = media_obj.url
-        
-        if url:
-            log.info("Trying URL download for image")
-            media_bytes = await download_from_url(url)
-            if media_bytes and len(media_bytes) > 0:
-                temp_path = f"temp_media/image_url_{os.urandom(4).hex()}{extension}"
-                with open(temp_path, 'wb') as f:
-                    f.write(media_bytes)
-                log.info(f"Successfully downloaded image from URL: {len(media_bytes)} bytes")
-                return media_bytes, mime_type, temp_path
-            else:
-                log.warning("URL download returned empty data for image")
+        log.warning("Profiling (%s) enabled for %s, output in %s", mode,
+                    f"{seconds:g}s" if seconds is not None else f"{self.remaining} jobs", self.session_dir)
+        return self.session_dir
 
-        # Metode 3: Khusus untuk gambar, coba ekstrak dari thumbnail
-        if hasattr(media_obj, 'JPEGThumbnail') and media_obj.JPEGThumbnail:
-            log.info("Trying to extract image from JPEGThumbnail")
-            thumbnail_bytes = media_obj.JPEGThumbnail
-            temp_path = f"temp_media/image_thumbnail_{os.urandom(4).hex()}.jpg"
-            with open(temp_path, 'wb') as f:
-                f.write(thumbnail_bytes)
-            log.info(f"Successfully extracted thumbnail: {len(thumbnail_bytes)} bytes")
-            return thumbnail_bytes, "image/jpeg", temp_path
+    def stop(self):
+        """Menghentikan sesi dan menulis sisa output; None jika tidak ada sesi aktif"""
+        if self.mode is None:
+            return None
+        mode, session_dir = self.mode, self.session_dir
+        if self._window_handle is not None:
+            self._window_handle.cancel()
+            self._window_handle = None
 
-        log.error("All download methods failed for image")
-        return None, None, None
+        if self._sampler is not None:
+            self._sampler_stop.set()
+            self._sampler.join(timeout=1)
+            self._sampler = None
+            with self._lock:
+                leftover, self._samples = self._samples, {}
+            for job_id, samples in leftover.items():
+                self._write_later(os.path.join(session_dir, f"{safe_profile_name(job_id)}.folded"),
+                                  format_folded, samples)
 
-    except Exception as e:
-        log.error(f"Error in download_media: {e}")
-        log.error(traceback.format_exc())
-        return None, None, None
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._run_later(self._cprofile.dump_stats, os.path.join(session_dir, "session.prof"))
+            self._cprofile = None
 
-# Fungsi untuk mengirim gambar KTP ke API Extractor
-async def query_ktp_extractor(media_bytes, mime_type, file_name):
-    try:
-        log.info(f"Sending image to KTP Extractor API, type: {mime_type}, size: {len(media_bytes)} bytes")
-        
-        # Encode media as base64
-        media_b64 = base64.b64encode(media_bytes).decode('utf-8')
-        
-        # Prepare payload
-        payload = {
-            "action": "process-ktp",
-            "fileData": media_b64,
-            "fileName": file_name,
-            "mimeType": mime_type
-        }
-        
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        log.info("Sending request to KTP Extractor API...")
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(KTP_API_URL, json=payload, headers=headers) as response:
-                response_text = await response.text()
-                
-                if response.status == 200:
-                    try:
-                        response_json = json.loads(response_text)
-                        log.info("Successfully got response from KTP Extractor API")
-                        return response_json
-                    except json.JSONDecodeError as e:
-                        log.error(f"Error parsing JSON response: {e}")
-                        return {"status": "error", "message": f"Error parsing JSON response: {str(e)}", "code": 500}
-                else:
-                    log.error(f"KTP Extractor API error: {response_text}")
-                    return {"status": "error", "message": f"Error dari KTP Extractor API: Status {response.status}.", "code": response.status}
-    except Exception as e:
-        log.error(f"Exception in query_ktp_extractor: {e}")
-        log.error(traceback.format_exc())
-        return {"status": "error", "message": f"Error: {str(e)}", "code": 500}
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
 
-# Fungsi untuk mengirim gambar KK ke API Extractor
-async def query_kk_extractor(media_bytes, mime_type, file_name):
-    try:
-        log.info(f"Sending image to KK Extractor API, type: {mime_type}, size: {len(media_bytes)} bytes")
-        
-        # Encode media as base64
-        media_b64 = base64.b64encode(media_bytes).decode('utf-8')
-        
-        # Prepare payload
-        payload = {
-            "action": "process-kk",
-            "fileData": media_b64,
-            "fileName": file_name,
-            "mimeType": mime_type
-        }
-        
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        log.info("Sending request to KK Extractor API...")
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(KK_API_URL, json=payload, headers=headers) as response:
-                response_text = await response.text()
-                
-                if response.status == 200:
-                    try:
-                        response_json = json.loads(response_text)
-                        log.info("Successfully got response from KK Extractor API")
-                        return response_json
-                    except json.JSONDecodeError as e:
-                        log.error(f"Error parsing JSON response: {e}")
-                        return {"status": "error", "message": f"Error parsing JSON response: {str(e)}", "code": 500}
-                else:
-                    log.error(f"KK Extractor API error: {response_text}")
-                    return {"status": "error", "message": f"Error dari KK Extractor API: Status {response.status}.", "code": response.status}
-    except Exception as e:
-        log.error(f"Exception in query_kk_extractor: {e}")
-        log.error(traceback.format_exc())
-        return {"status": "error", "message": f"Error: {str(e)}", "code": 500}
+        self.mode = None
+        self.session_dir = None
+        self.remaining = 0
+        self.deadline = None
+        self._active_jobs.clear()
+        log.warning("Profiling (%s) stopped after %s jobs, output in %s", mode, self.profiled_jobs, session_dir)
+        return session_dir
 
-# Fungsi untuk memformat data KTP untuk ditampilkan di WhatsApp
-def format_ktp_response(response):
-    try:
-        if response["status"] == "error":
-            return f"❌ Error: {response['message']} (Code: {response['code']})"
-            
-        if response["status"] == "success":
-            data = response["data"]
-            analysis = data["analysis"]
-            parsed = analysis["parsed"]
-            
-            if parsed["status"] == "not_ktp":
-                return "❌ Dokumen yang dikirim bukan merupakan KTP."
-                
-            if parsed["status"] == "success":
-                result = (
-                    "🆔 *HASIL EKSTRAKSI KTP* 🆔\n"
-                    "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-                    f"📌 *NIK:* `{parsed.get('nik', 'Tidak terdeteksi')}`\n"
-                    f"👤 *Nama:* {parsed.get('nama', 'Tidak terdeteksi')}\n"
-                    f"🎂 *TTL:* {parsed.get('tempat_tanggal_lahir', 'Tidak terdeteksi')}\n"
-                    f"⚧️ *Jenis Kelamin:* {parsed.get('jenis_kelamin', 'Tidak terdeteksi')}\n"
-                    f"🩸 *Golongan Darah:* {parsed.get('golongan_darah', 'Tidak terdeteksi')}\n\n"
-                    "📍 *DOMISILI* 📍\n"
-                    f"🏠 *Alamat:* {parsed.get('alamat', 'Tidak terdeteksi')}\n"
-                    f"🏘️ *RT/RW:* {parsed.get('rt_rw', 'Tidak terdeteksi')}\n"
-                    f"🏙️ *Kel/Desa:* {parsed.get('kel_desa', 'Tidak terdeteksi')}\n"
-                    f"🌆 *Kecamatan:* {parsed.get('kecamatan', 'Tidak terdeteksi')}\n\n"
-                    "ℹ️ *INFORMASI LAINNYA* ℹ️\n"
-                    f"🕌 *Agama:* {parsed.get('agama', 'Tidak terdeteksi')}\n"
-                    f"💍 *Status Perkawinan:* {parsed.get('status_perkawinan', 'Tidak terdeteksi')}\n"
-                    f"💼 *Pekerjaan:* {parsed.get('pekerjaan', 'Tidak terdeteksi')}\n"
-                    f"🌐 *Kewarganegaraan:* {parsed.get('kewarganegaraan', 'Tidak terdeteksi')}\n"
-                    f"⏱️ *Berlaku Hingga:* {parsed.get('berlaku_hingga', 'Tidak terdeteksi')}\n"
-                    f"📅 *Dikeluarkan di:* {parsed.get('dikeluarkan_di', 'Tidak terdeteksi')}\n\n"
-                    "━━━━━━━━━━━━━━━━━━━━━━\n"
-                    "⚠️ *PERHATIAN:* _Gunakan informasi ini hanya untuk keperluan yang sah dan legal. Penyalahgunaan data pribadi dapat dikenakan sanksi hukum._"
-                )
-                return result
-                
-        return "❌ Format respons tidak dikenal"
-    except Exception as e:
-        log.error(f"Error formatting KTP response: {e}")
-        log.error(traceback.format_exc())
-        return f"❌ Error saat memformat respons: {str(e)}"
+    def job_started(self, job_id):
+        """Dipanggil saat job dimulai; True jika job ini ikut diprofil"""
+        if self.mode is None:
+            return False
+        if self.deadline is not None:
+            if time.monotonic() >= self.deadline:
+                return False
+        elif self.remaining <= 0:
+            return False
+        else:
+            self.remaining -= 1
+        self._active_jobs.add(job_id)
+        self.profiled_jobs += 1
+        return True
 
+    def job_finished(self, job_id):
+        if job_id not in self._active_jobs:
+            return
+        self._active_jobs.discard(job_id)
+        if self.mode == "cpu":
+            with self._lock:
+                samples = self._samples.pop(job_id, None)
+            if samples:
+                self._write_later(os.path.join(self.session_dir, f"{safe_profile_name(job_id)}.folded"),
+                                  format_folded, samples)
+        if not self._active_jobs and self._exhausted():
+            self.stop()
 
-# Fungsi untuk memformat data KK untuk ditampilkan di WhatsApp
-def format_kk_response(response):
-    try:
-        if response["status"] == "error":
-            return f"❌ Error: {response['message']} (Code: {response['code']})"
-            
-        if response["status"] == "success":
-            data = response["data"]
-            analysis = data["analysis"]
-            parsed = analysis["parsed"]
-            
-            if parsed["status"] == "not_kk":
-                return "❌ Dokumen yang dikirim bukan merupakan Kartu Keluarga."
-                
-            if parsed["status"] == "success":
-                # Format data kepala keluarga
-                kepala_keluarga = parsed.get('kepala_keluarga', {})
-                
-                result = (
-                    "👨‍👩‍👧‍👦 *HASIL EKSTRAKSI KARTU KELUARGA* 👨‍👩‍👧‍👦\n"
-                    "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-                    f"📝 *Nomor KK:* `{parsed.get('nomor_kk', 'Tidak terdeteksi')}`\n"
-                    f"🔢 *Kode Keluarga:* {parsed.get('kode_keluarga', 'Tidak terdeteksi')}\n\n"
-                    "👑 *DATA KEPALA KELUARGA* 👑\n"
-                    f"👤 *Nama:* {kepala_keluarga.get('nama', 'Tidak terdeteksi')}\n"
-                    f"🆔 *NIK:* `{kepala_keluarga.get('nik', 'Tidak terdeteksi')}`\n"
-                    f"📍 *Alamat:* {kepala_keluarga.get('alamat', 'Tidak terdeteksi')}\n"
-                    f"🏘️ *RT/RW:* {kepala_keluarga.get('rt_rw', 'Tidak terdeteksi')}\n"
-                    f"🏙️ *Desa/Kelurahan:* {kepala_keluarga.get('desa_kelurahan', 'Tidak terdeteksi')}\n"
-                    f"🌆 *Kecamatan:* {kepala_keluarga.get('kecamatan', 'Tidak terdeteksi')}\n"
-                    f"🏢 *Kabupaten/Kota:* {kepala_keluarga.get('kabupaten_kota', 'Tidak terdeteksi')}\n"
-                    f"📮 *Kode Pos:* {kepala_keluarga.get('kode_pos', 'Tidak terdeteksi')}\n"
-                    f"🌏 *Provinsi:* {kepala_keluarga.get('provinsi', 'Tidak terdeteksi')}\n"
-                )
-                
-                # Format data anggota keluarga
-                anggota_keluarga = parsed.get('anggota_keluarga', [])
-                if anggota_keluarga:
-                    result += "\n👨‍👩‍👧‍👦 *ANGGOTA KELUARGA* 👨‍👩‍👧‍👦\n"
-                    for i, anggota in enumerate(anggota_keluarga, 1):
-                        # Tentukan emoji untuk hubungan keluarga
-                        status_hubungan = next((s for s in parsed.get('status_hubungan', []) if s.get('nama') == anggota.get('nama')), {})
-                        hubungan = status_hubungan.get('hubungan_keluarga', '').lower() if status_hubungan else ''
-                        
-                        emoji = "👤"
-                        if "kepala" in hubungan:
-                            emoji = "👨‍💼" if anggota.get('jenis_kelamin', '').lower() == "laki-laki" else "👩‍💼"
-                        elif "suami" in hubungan:
-                            emoji = "👨"
-                        elif "istri" in hubungan:
-                            emoji = "👩"
-                        elif "anak" in hubungan:
-                            emoji = "👦" if anggota.get('jenis_kelamin', '').lower() == "laki-laki" else "👧"
-                        
-                        result += (
-                            f"{emoji} *{i}. {anggota.get('nama', 'Tidak terdeteksi')}*\n"
-                            f"   🆔 NIK: `{anggota.get('nik', 'Tidak terdeteksi')}`\n"
-                            f"   ⚧️ Jenis Kelamin: {anggota.get('jenis_kelamin', 'Tidak terdeteksi')}\n"
-                            f"   🎂 TTL: {anggota.get('tempat_lahir', 'Tidak terdeteksi')}, {anggota.get('tanggal_lahir', 'Tidak terdeteksi')}\n"
-                            f"   🕌 Agama: {anggota.get('agama', 'Tidak terdeteksi')}\n"
-                            f"   🎓 Pendidikan: {anggota.get('pendidikan', 'Tidak terdeteksi')}\n"
-                            f"   💼 Pekerjaan: {anggota.get('pekerjaan', 'Tidak terdeteksi')}\n"
-                        )
-                            
-                        # Tambahkan info status hubungan
-                        if status_hubungan:
-                            result += (
-                                f"   💍 Status Pernikahan: {status_hubungan.get('status_pernikahan', 'Tidak terdeteksi')}\n"
-                                f"   👨‍👩‍👧‍👦 Hubungan Keluarga: {status_hubungan.get('hubungan_keluarga', 'Tidak terdeteksi')}\n"
-                                f"   🌐 Kewarganegaraan: {status_hubungan.get('kewarganegaraan', 'Tidak terdeteksi')}\n"
-                            )
-                            
-                        # Tambahkan info orang tua
-                        orang_tua = next((o for o in parsed.get('orang_tua', []) if o.get('nama') == anggota.get('nama')), {})
-                        if orang_tua:
-                            result += (
-                                f"   👨‍👩 Orang Tua:\n"
-                                f"   ┣ 👨 Ayah: {orang_tua.get('ayah', 'Tidak terdeteksi')}\n"
-                                f"   ┗ 👩 Ibu: {orang_tua.get('ibu', 'Tidak terdeteksi')}\n"
-                            )
-                            
-                        if i < len(anggota_keluarga):
-                            result += "\n"
-                else:
-                    result += "\n👥 *Anggota Keluarga:* Tidak terdeteksi\n"
-                
-                # Tambahkan tanggal penerbitan
-                if parsed.get('tanggal_penerbitan'):
-                    result += f"\n📅 *Tanggal Penerbitan:* {parsed.get('tanggal_penerbitan')}\n"
-                
-                # Tambahkan catatan penting
-                result += (
-                    "\n━━━━━━━━━━━━━━━━━━━━━━\n"
-                    "⚠️ *PERHATIAN:* _Gunakan informasi ini hanya untuk keperluan yang sah dan legal. Penyalahgunaan data pribadi dapat dikenakan sanksi hukum._"
-                )
-                
-                return result
-                
-        return "❌ Format respons tidak dikenal"
-    except Exception as e:
-        log.error(f"Error formatting KK response: {e}")
-        log.error(traceback.format_exc())
-        return f"❌ Error saat memformat respons: {str(e)}"
+    @contextmanager
+    def trace_memory(self, stage):
+        """Snapshot tracemalloc di sekitar satu tahap untuk job yang diprofil mode mem"""
+        job_id = job_id_var.get()
+        if self.mode != "mem" or job_id not in self._active_jobs or not tracemalloc.is_tracing():
+            yield
+            return
+        session_dir = self.session_dir
+        before = tracemalloc.take_snapshot()
+        try:
+            yield
+        finally:
+            if tracemalloc.is_tracing():
+                after = tracemalloc.take_snapshot()
+                self._write_later(os.path.join(session_dir, f"{safe_profile_name(job_id)}_{stage}.txt"),
+                                  format_memory_diff, before, after, stage, job_id)
 
+    def describe(self):
+        if self.deadline is not None:
+            return f"job yang dimulai dalam {max(0, self.deadline - time.monotonic()):.0f} detik ke depan"
+        return f"{self.remaining} job berikutnya"
 
-# Fungsi untuk mengirim gambar Ijazah ke API Extractor
-async def query_ijazah_extractor(media_bytes, mime_type, file_name):
-    try:
-        log.info(f"Sending image to Ijazah Extractor API, type: {mime_type}, size: {len(media_bytes)} bytes")
-        
-        # Encode media as base64
-        media_b64 = base64.b64encode(media_bytes).decode('utf-8')
-        
-        # Prepare payload
-        payload = {
-            "action": "process-ijazah",
-            "fileData": media_b64,
+    def _exhausted(self):
+        if self.deadline is not None:
+            return time.monotonic() >= self.deadline
+        return self.remaining <= 0
+
+    def _window_expired(self):
+        self._window_handle = None
+        # Job yang sedang diprofil tetap ditunggu; stop dipanggil dari job_finished
+        if not self._active_jobs:
+            self.stop()
+
+    def _sample_loop(self, thread_id):
+        job_code = with_job_id.__code__
+        while not self._sampler_stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(thread_id)
+            # Event loop sedang menunggu I/O: bukan waktu CPU
+            if frame is None or frame.f_code.co_filename.endswith("selectors.py"):
+                continue
+            stack = []
+            job_id = None
+            while frame is not None:
+                code = frame.f_code
+                if code is job_code and job_id is None:
+                    job_id = frame.f_locals.get("job_id")
+                label = self._labels.get(code)
+                if label is None:
+                    label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                stack.append(label)
+                frame = frame.f_back
+            if job_id not in self._active_jobs:
+                job_id = "_unattributed"
+            key = ";".join(reversed(stack))
+            with self._lock:
+                samples = self._samples.setdefault(job_id, {})
+                samples[key] = samples.get(key, 0) + 1
+
+    def _run_later(self, fn, *args):
+        def run():
+            try:
+                fn(*args)
+            except Exception as e:
+                log.error("Error writing profiling output: %s", e)
+        asyncio.get_running_loop().run_in_executor(None, run)
+
+    def _write_later(self, path, build, *args):
+        def write():
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(build(*args))
+        self._run_later(write)
+
+job_profiler = JobProfiler(PROFILE_DIR, PROFILE_SAMPLE_INTERVAL)
+
+def install_profiling_signals():
+    """SIGUSR1 memulai profiling cpu untuk PROFILE_DEFAULT_JOBS job, SIGUSR2 menghentikannya"""
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGUSR1, lambda: job_profiler.start("cpu", jobs=PROFILE_DEFAULT_JOBS))
+        loop.add_signal_handler(signal.SIGUSR2, job_profiler.stop)
+    except (AttributeError, NotImplementedError, RuntimeError):
+        log.info("Profiling signals are not available on this platform")
+
+# Nama file unik untuk media yang diunduh (hanya dipakai sebagai metadata upload)
+def make_media_file_name(prefix, extension):
+    return f"{prefix}_{os.urandom(4).hex()}{extension}"
+
+def shard_for_jid(jid, shard_count):
+    """Shard pemilik device; stabil selama SHARD_COUNT tidak berubah"""
+    digest = hashlib.sha1(f"{jid.User}@{jid.Server}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") % shard_count
+
+async def load_sessions():
+    """
+    Membuat client untuk setiap device tersimpan (hanya milik shard ini jika
+    sharding aktif). Daftar device dibaca dari SQLite di thread terpisah agar
+    layanan lain dapat dinyalakan bersamaan.
+    """
+    devices = await asyncio.to_thread(client_factory.get_all_devices)
+    if SHARD_COUNT > 1:
+        devices = [device for device in devices if shard_for_jid(device.JID, SHARD_COUNT) == SHARD_INDEX]
+    for device in devices:
+        client_factory.new_client(device.JID)
+    if SHARD_COUNT > 1:
+        log.info("Shard %s/%s owns %s devices", SHARD_INDEX, SHARD_COUNT, len(devices))
+    return devices
+
+# Session HTTP bersama, dibuat sekali saat startup dan ditutup saat shutdown
+_http_session = None
+
+def get_http_session():
+    """
+    Mengembalikan aiohttp.ClientSession bersama untuk semua request keluar.
+
+    Session dibuat secara lazy di dalam event loop yang sedang berjalan agar
+    koneksi TCP/TLS ke host Apps Script dapat dipakai ulang (keep-alive).
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        import aiohttp
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            enable_cleanup_closed=True,
+        )
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=DEFAULT_HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        )
+        http_log.info("Shared HTTP session created (limit=%s, per_host=%s)", HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST)
+    return _http_session
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+        http_log.info("Shared HTTP session closed")
+    _http_session = None
+
+def get_extractor_timeout(doc_type, total=None):
+    if total is None:
+        total = EXTRACTOR_TIMEOUTS.get(doc_type, DEFAULT_HTTP_TIMEOUT)
+    import aiohttp
+    return aiohttp.ClientTimeout(total=total, connect=HTTP_CONNECT_TIMEOUT)
+
+# Cache hasil ekstraksi berbasis konten (content-addressed)
+class ExtractionCache:
+    """
+    Cache LRU untuk respons extractor yang sudah di-parse.
+
+    Key berupa (SHA-256 hex dari gambar, doc_type). Entri dibatasi jumlah,
+    total ukuran (byte JSON) dan TTL. Jika disk tier aktif, entri juga
+    disimpan di SQLite sehingga tetap berlaku setelah restart; akses disk
+    dijalankan di thread terpisah agar tidak memblokir event loop.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl, db_path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, size, response)
+        self._total_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Database disk dibuka saat pertama dipakai (di thread), bukan saat import
+        self.db_path = db_path
+        self._db = None
+        self._db_lock = threading.Lock()
+
+    def _connection(self):
+        # Dipanggil dengan _db_lock dipegang
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS extraction_cache ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM extraction_cache WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+        return self._db
+
+    @staticmethod
+    def make_key(media_hash, doc_type):
+        return f"{media_hash}:{doc_type.lower()}"
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes):
+            _, (_, size, _) = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+
+    def _put_memory(self, key, response, size, expires_at):
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old:
+            self._total_bytes -= old[1]
+        self._entries[key] = (expires_at, size, response)
+        self._total_bytes += size
+        self._evict()
+
+    def _get_memory(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, size, response = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            self._total_bytes -= size
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def _disk_get(self, key):
+        with self._db_lock:
+            row = self._connection().execute(
+                "SELECT response, expires_at FROM extraction_cache WHERE key = ? AND expires_at >= ?",
+                (key, time.time()),
+            ).fetchone()
+        return row
+
+    def _disk_put(self, key, serialized, expires_at):
+        with self._db_lock:
+            db = self._connection()
+            db.execute(
+                "INSERT OR REPLACE INTO extraction_cache (key, response, expires_at) VALUES (?, ?, ?)",
+                (key, serialized, expires_at),
+            )
+            db.commit()
+
+    async def get(self, media_hash, doc_type):
+        key = self.make_key(media_hash, doc_type)
+        response = self._get_memory(key)
+        if response is not None:
+            self.hits += 1
+            return response
+        if self.db_path:
+            try:
+                row = await asyncio.to_thread(self._disk_get, key)
+                if row:
+                    serialized, expires_at = row
+                    response = json.loads(serialized)
+                    self._put_memory(key, response, len(serialized), expires_at)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return response
+            except Exception as e:
+                log.error("Error reading extraction cache from disk: %s", e)
+        self.misses += 1
+        return None
+
+    async def put(self, media_hash, doc_type, response):
+        key = self.make_key(media_hash, doc_type)
+        serialized = json.dumps(response, ensure_ascii=False)
+        expires_at = time.time() + self.ttl
+        self._put_memory(key, response, len(serialized), expires_at)
+        if self.db_path:
+            try:
+                await asyncio.to_thread(self._disk_put, key, serialized, expires_at)
+            except Exception as e:
+                log.error("Error writing extraction cache to disk: %s", e)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._total_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+            self._db = None
+            self.db_path = None
+
+extraction_cache = None
+if RESULT_CACHE_ENABLED:
+    extraction_cache = ExtractionCache(
+        RESULT_CACHE_MAX_ENTRIES,
+        RESULT_CACHE_MAX_BYTES,
+        RESULT_CACHE_TTL,
+        RESULT_CACHE_DB_PATH if RESULT_CACHE_DISK_ENABLED else None,
+    )
+
+# Cache bytes media per identitas WhatsApp
+class MediaCache:
+    """
+    Cache LRU untuk bytes media yang sudah di-download.
+
+    Key berupa identitas media dari get_media_identity. Memori dibatasi total
+    byte dan TTL. Jika disk_dir diisi, setiap gambar juga ditulis sebagai satu
+    file (baris mime type + bytes) dan dibaca kembali lewat mmap sehingga hit
+    dari disk tidak menyalin isi file; file tertua dihapus saat total ukuran
+    melewati disk_max_bytes. Akses disk dijalankan di thread terpisah.
+    """
+
+    def __init__(self, max_bytes, ttl, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # media_id -> (expires_at, data, mime_type)
+        self._total_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Indeks file disk (nama -> (ukuran, mtime)) dimuat saat pertama dipakai
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._disk_index = None
+        self._disk_lock = threading.Lock()
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def _put_memory(self, media_id, data, mime_type, expires_at):
+        size = len(data)
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(media_id, None)
+        if old:
+            self._total_bytes -= len(old[1])
+        self._entries[media_id] = (expires_at, data, mime_type)
+        self._total_bytes += size
+        while self._entries and self._total_bytes > self.max_bytes:
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self._total_bytes -= len(evicted)
+            self.evictions += 1
+
+    def _get_memory(self, media_id):
+        entry = self._entries.get(media_id)
+        if entry is None:
+            return None
+        expires_at, data, mime_type = entry
+        if expires_at < time.time():
+            del self._entries[media_id]
+            self._total_bytes -= len(data)
+            return None
+        self._entries.move_to_end(media_id)
+        return data, mime_type
+
+    @staticmethod
+    def disk_name(media_id):
+        # directPath/mediaKey tidak ditulis apa adanya ke nama file
+        return hashlib.sha256(media_id.encode("utf-8")).hexdigest() + ".blob"
+
+    def _load_disk_index(self):
+        # Dipanggil dengan _disk_lock dipegang
+        if self._disk_index is None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            index = {}
+            for entry in os.scandir(self.disk_dir):
+                if entry.name.endswith(".blob"):
+                    stat = entry.stat()
+                    index[entry.name] = (stat.st_size, stat.st_mtime)
+            self._disk_index = index
+        return self._disk_index
+
+    def _remove_disk(self, index, name):
+        # Dipanggil dengan _disk_lock dipegang
+        index.pop(name, None)
+        try:
+            os.remove(os.path.join(self.disk_dir, name))
+        except FileNotFoundError:
+            pass
+
+    def _disk_get(self, media_id):
+        name = self.disk_name(media_id)
+        with self._disk_lock:
+            index = self._load_disk_index()
+            entry = index.get(name)
+            if entry is None:
+                return None
+            expires_at = entry[1] + self.ttl
+            if expires_at < time.time():
+                self._remove_disk(index, name)
+                return None
+            try:
+                with open(os.path.join(self.disk_dir, name), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # File dihapus proses lain (shard berbagi direktori) atau kosong
+                index.pop(name, None)
+                return None
+        header_end = mapped.find(b"\n")
+        if header_end < 0:
+            mapped.close()
+            return None
+        mime_type = mapped[:header_end].decode("ascii", "replace")
+        # memoryview menahan mmap tetap terbuka selama bytes masih dipakai
+        return memoryview(mapped)[header_end + 1:], mime_type, expires_at
+
+    def _disk_put(self, media_id, data, mime_type):
+        name = self.disk_name(media_id)
+        path = os.path.join(self.disk_dir, name)
+        header = mime_type.encode("ascii", "replace") + b"\n"
+        with self._disk_lock:
+            index = self._load_disk_index()
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(header)
+            f.write(data)
+        os.replace(temp_path, path)
+        with self._disk_lock:
+            index[name] = (len(header) + len(data), time.time())
+            total = sum(size for size, _ in index.values())
+            if total > self.disk_max_bytes:
+                for old_name, (size, _) in sorted(index.items(), key=lambda item: item[1][1]):
+                    if total <= self.disk_max_bytes:
+                        break
+                    self._remove_disk(index, old_name)
+                    total -= size
+
+    async def get(self, media_id):
+        cached = self._get_memory(media_id)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        if self.disk_dir:
+            try:
+                row = await asyncio.to_thread(self._disk_get, media_id)
+                if row:
+                    data, mime_type, expires_at = row
+                    self._put_memory(media_id, data, mime_type, expires_at)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return data, mime_type
+            except Exception as e:
+                media_log.error("Error reading media cache from disk: %s", e)
+        self.misses += 1
+        return None
+
+    async def put(self, media_id, data, mime_type):
+        self._put_memory(media_id, data, mime_type, time.time() + self.ttl)
+        if self.disk_dir:
+            try:
+                await asyncio.to_thread(self._disk_put, media_id, data, mime_type)
+            except Exception as e:
+                media_log.error("Error writing media cache to disk: %s", e)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._total_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+        }
+
+media_cache = None
+if MEDIA_CACHE_ENABLED:
+    media_cache = MediaCache(
+        MEDIA_CACHE_MAX_BYTES,
+        MEDIA_CACHE_TTL,
+        MEDIA_CACHE_DIR or None,
+        MEDIA_CACHE_DISK_MAX_BYTES,
+    )
+
+# Riwayat hasil ekstraksi yang berhasil, dapat dicari dan di-export ulang
+IDENTIFIER_STRIP_CHARS = re.compile(r"[^0-9A-Za-z]")
+
+def normalize_identifier(value):
+    """NIK/nomor KK/nomor SIM tanpa spasi dan tanda baca, huruf besar"""
+    return IDENTIFIER_STRIP_CHARS.sub("", value).upper()
+
+class ExtractionHistory:
+    """
+    Riwayat hasil ekstraksi yang berhasil di SQLite (mode WAL).
+
+    Setiap baris menyimpan respons extractor lengkap beserta chat, jenis
+    dokumen, nama pemilik dan waktu, sehingga hasil dapat ditampilkan atau
+    di-export ulang tanpa memanggil extractor. Nomor identitas (NIK, nomor KK,
+    nomor SIM, ...) diindeks di tabel terpisah; satu KK dapat ditemukan dari NIK
+    anggota mana pun. Gambar yang sama diproses ulang di chat yang sama hanya
+    memperbarui baris lamanya.
+
+    record() tidak melakukan I/O: hasil dikumpulkan lalu ditulis per batch di
+    thread oleh task latar belakang. Query selalu menulis hasil yang tertunda
+    lebih dulu. Hasil yang lebih tua dari retention (detik, 0 = selamanya)
+    dihapus saat startup dan setiap PURGE_INTERVAL detik.
+    """
+
+    PURGE_INTERVAL = 3600
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS extraction_history ("
+        "id INTEGER PRIMARY KEY, created_at REAL NOT NULL, chat TEXT NOT NULL, "
+        "doc_type TEXT NOT NULL, media_hash TEXT, job_id TEXT, owner_name TEXT, "
+        "id_number TEXT, response TEXT NOT NULL)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS extraction_history_media "
+        "ON extraction_history (chat, doc_type, media_hash)",
+        "CREATE INDEX IF NOT EXISTS extraction_history_chat ON extraction_history (chat, created_at)",
+        "CREATE INDEX IF NOT EXISTS extraction_history_doc_type ON extraction_history (doc_type, created_at)",
+        "CREATE INDEX IF NOT EXISTS extraction_history_created ON extraction_history (created_at)",
+        "CREATE TABLE IF NOT EXISTS extraction_history_ids ("
+        "value TEXT NOT NULL, history_id INTEGER NOT NULL, PRIMARY KEY (value, history_id)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS extraction_history_ids_entry ON extraction_history_ids (history_id)",
+    )
+
+    LIST_COLUMNS = "h.id, h.created_at, h.doc_type, h.owner_name, h.id_number"
+
+    def __init__(self, db_path, retention, flush_interval, batch_size):
+        self.db_path = db_path
+        self.retention = retention
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending = []
+        self._wakeup = None
+        self._task = None
+        self._last_purge = 0.0
+        self.written = 0
+        self.failed = 0
+        self.purged = 0
+        # Database dibuka saat pertama dipakai (di thread), bukan saat import
+        self._db = None
+        self._db_lock = threading.Lock()
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def _connection(self):
+        # Dipanggil dengan _db_lock dipegang
+        if self._db is None:
+            # Berisi data pribadi: file hanya dapat dibaca pemilik proses (file WAL
+            # dan shm yang dibuat SQLite mengikuti mode file database)
+            os.close(os.open(self.db_path, os.O_RDWR | os.O_CREAT, 0o600))
+            os.chmod(self.db_path, 0o600)
+            db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.SCHEMA:
+                db.execute(statement)
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _cutoff(self):
+        return time.time() - self.retention if self.retention else 0.0
+
+    def record(self, chat, doc, response, media_hash=None):
+        """Mencatat hasil ekstraksi; ditulis ke disk pada flush berikutnya"""
+        self._pending.append((time.time(), chat, doc.key, media_hash, job_id_var.get(), response))
+        if len(self._pending) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def _write(self, batch):
+        rows = []
+        for created_at, chat, doc_key, media_hash, job_id, response in batch:
+            doc = DOCUMENT_TYPES[doc_key]
+            parsed = get_parsed_data(response) or {}
+            owner_name = doc.get_owner_name(parsed)
+            identifiers = doc.get_identifiers(parsed)
+            rows.append((
+                (created_at, chat, doc_key, media_hash, job_id,
+                 owner_name if isinstance(owner_name, str) else None,
+                 identifiers[0] if identifiers else None,
+                 json.dumps(response, ensure_ascii=False)),
+                identifiers,
+            ))
+        with self._db_lock:
+            db = self._connection()
+            with db:
+                for row, identifiers in rows:
+                    history_id = db.execute(
+                        "INSERT INTO extraction_history (created_at, chat, doc_type, media_hash, job_id, "
+                        "owner_name, id_number, response) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (chat, doc_type, media_hash) DO UPDATE SET "
+                        "created_at = excluded.created_at, job_id = excluded.job_id, "
+                        "owner_name = excluded.owner_name, id_number = excluded.id_number, "
+                        "response = excluded.response RETURNING id",
+                        row,
+                    ).fetchone()[0]
+                    db.execute("DELETE FROM extraction_history_ids WHERE history_id = ?", (history_id,))
+                    db.executemany(
+                        "INSERT OR IGNORE INTO extraction_history_ids (value, history_id) VALUES (?, ?)",
+                        [(normalize_identifier(value), history_id) for value in identifiers],
+                    )
+
+    def _purge(self):
+        cutoff = self._cutoff()
+        with self._db_lock:
+            db = self._connection()
+            with db:
+                db.execute(
+                    "DELETE FROM extraction_history_ids WHERE history_id IN "
+                    "(SELECT id FROM extraction_history WHERE created_at < ?)",
+                    (cutoff,),
+                )
+                return db.execute("DELETE FROM extraction_history WHERE created_at < ?", (cutoff,)).rowcount
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        try:
+            await asyncio.to_thread(self._write, batch)
+            self.written += len(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            log.error("Error writing %s extraction history entries: %s", len(batch), e)
+
+    async def purge(self):
+        self._last_purge = time.monotonic()
+        if not self.retention:
+            return
+        try:
+            deleted = await asyncio.to_thread(self._purge)
+        except Exception as e:
+            log.error("Error purging extraction history: %s", e)
+            return
+        self.purged += deleted
+        if deleted:
+            log.info("Purged %s extraction history entries older than %.0f days", deleted, self.retention / 86400)
+
+    async def _run(self):
+        await self.purge()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            if time.monotonic() - self._last_purge >= self.PURGE_INTERVAL:
+                await self.purge()
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+            self._db = None
+
+    def _recent(self, chat, doc_type, limit):
+        sql = f"SELECT {self.LIST_COLUMNS} FROM extraction_history h WHERE h.chat = ? AND h.created_at >= ?"
+        params = [chat, self._cutoff()]
+        if doc_type:
+            sql += " AND h.doc_type = ?"
+            params.append(doc_type)
+        with self._db_lock:
+            return self._connection().execute(sql + " ORDER BY h.created_at DESC LIMIT ?", params + [limit]).fetchall()
+
+    def _search(self, value, chat, limit):
+        # Pencarian prefix memakai indeks (value, history_id)
+        sql = (f"SELECT DISTINCT {self.LIST_COLUMNS} FROM extraction_history_ids i "
+               "JOIN extraction_history h ON h.id = i.history_id "
+               "WHERE i.value >= ? AND i.value < ? AND h.created_at >= ?")
+        params = [value, value + "\x7f", self._cutoff()]
+        if chat is not None:
+            sql += " AND h.chat = ?"
+            params.append(chat)
+        with self._db_lock:
+            return self._connection().execute(sql + " ORDER BY h.created_at DESC LIMIT ?", params + [limit]).fetchall()
+
+    def _get(self, entry_id, chat):
+        sql = "SELECT doc_type, created_at, response FROM extraction_history WHERE id = ? AND created_at >= ?"
+        params = [entry_id, self._cutoff()]
+        if chat is not None:
+            sql += " AND chat = ?"
+            params.append(chat)
+        with self._db_lock:
+            row = self._connection().execute(sql, params).fetchone()
+        if row is None:
+            return None
+        doc_type, created_at, serialized = row
+        return doc_type, created_at, json.loads(serialized)
+
+    async def _query(self, fn, *args):
+        await self.flush()
+        return await asyncio.to_thread(fn, *args)
+
+    async def recent(self, chat, doc_type=None, limit=10):
+        """Hasil terbaru di chat: list (id, created_at, doc_type, owner_name, id_number)"""
+        return await self._query(self._recent, chat, doc_type, limit)
+
+    async def search(self, value, chat=None, limit=10):
+        """Hasil dengan nomor identitas berawalan value; chat=None mencari di semua chat"""
+        return await self._query(self._search, normalize_identifier(value), chat, limit)
+
+    async def get(self, entry_id, chat=None):
+        """(doc_type, created_at, response) atau None jika tidak ada / bukan milik chat"""
+        return await self._query(self._get, entry_id, chat)
+
+extraction_history = None
+if HISTORY_ENABLED:
+    extraction_history = ExtractionHistory(
+        HISTORY_DB_PATH,
+        HISTORY_RETENTION_DAYS * 86400,
+        HISTORY_FLUSH_INTERVAL,
+        HISTORY_BATCH_SIZE,
+    )
+
+def get_quoted_file_sha256(quoted_message):
+    """Mengembalikan fileSHA256 (hex) dari imageMessage yang dikutip, jika ada"""
+    try:
+        file_sha = quoted_message.imageMessage.fileSHA256
+        if file_sha:
+            return file_sha.hex()
+    except Exception:
+        pass
+    return None
+
+# Single-flight: permintaan identik yang sedang berjalan digabung menjadi satu
+class SingleFlight:
+    """
+    Menggabungkan pemanggilan identik yang sedang berjalan (in-flight).
+
+    Pemanggil pertama untuk sebuah key menjalankan fungsi; pemanggil berikutnya
+    dengan key yang sama menunggu future milik pemanggil pertama dan menerima
+    hasil (atau exception) yang sama. Key dilepas begitu pemanggilan selesai,
+    jadi ini bukan cache.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+    async def do(self, key, fn):
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            metrics.inc("singleflight_total", flight=self.name, role="coalesced")
+            log.info("Coalesced %s request for in-flight key %s", self.name, str(key)[:40])
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # Pemanggil pertama dibatalkan (mis. kalah race), jalankan sendiri
+                return await self.do(key, fn)
+
+        future = asyncio.get_running_loop().create_future()
+        # Hindari warning "exception was never retrieved" jika tidak ada follower
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = future
+        self.leaders += 1
+        metrics.inc("singleflight_total", flight=self.name, role="leader")
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "leaders": self.leaders, "coalesced": self.coalesced}
+
+download_flight = SingleFlight("download")
+extraction_flight = SingleFlight("extraction")
+
+def get_media_identity(quoted_message):
+    """
+    Identitas stabil gambar yang dikutip: fileSHA256, atau directPath+mediaKey.
+    Mengembalikan None jika tidak ada yang tersedia.
+    """
+    file_sha = get_quoted_file_sha256(quoted_message)
+    if file_sha:
+        return f"sha256:{file_sha}"
+    try:
+        image = quoted_message.imageMessage
+        if image.directPath and image.mediaKey:
+            return f"path:{image.directPath}:{image.mediaKey.hex()}"
+    except Exception:
+        pass
+    return None
+
+async def download_media_coalesced(client, quoted_message, quoted_type):
+    """
+    download_media dengan single-flight berdasarkan identitas media; bytes yang
+    sudah pernah di-download diambil dari media_cache
+    """
+    media_id = get_media_identity(quoted_message)
+
+    async def download():
+        with metrics.timer("stage_seconds", stage="download"), job_profiler.trace_memory("download"):
+            if media_id is not None and media_cache is not None:
+                cached = await media_cache.get(media_id)
+                metrics.inc("media_cache_requests_total", result="miss" if cached is None else "hit")
+                if cached is not None:
+                    data, mime_type = cached
+                    media_log.info("Media cache hit for %s (%s bytes)", media_id[:24], len(data))
+                    metrics.inc("download_method_total", method="cache")
+                    return MediaDownload(data, mime_type, make_media_file_name("image_cached", ".jpg"), "cache")
+            media = await download_media(client, quoted_message, quoted_type)
+            # Thumbnail resolusi rendah tidak di-cache agar perintah berikutnya mencoba lagi
+            if media is not None and not media.low_resolution and media_id is not None and media_cache is not None:
+                await media_cache.put(media_id, media.data, media.mime_type)
+            return media
+
+    if media_id is None:
+        return await download()
+    return await download_flight.do(media_id, download)
+
+def is_cacheable_response(response):
+    # Hanya respons sukses dari API yang di-cache (termasuk status not_X), error tidak
+    return isinstance(response, dict) and response.get("status") == "success"
+
+async def lookup_cached_extraction(quoted_message, doc_type):
+    """Cek cache sebelum download memakai fileSHA256 dari WhatsApp"""
+    if extraction_cache is None:
+        return None
+    file_sha = get_quoted_file_sha256(quoted_message)
+    if not file_sha:
+        return None
+    response = await extraction_cache.get(file_sha, doc_type)
+    metrics.inc("cache_requests_total", result="miss" if response is None else "hit")
+    if response is not None:
+        log.info("Extraction cache hit for %s (fileSHA256 %s)", doc_type, file_sha[:12])
+    return response
+
+def record_extraction_history(chat, doc, response, image_message):
+    """Simpan hasil ekstraksi yang berhasil ke riwayat (tanpa menunggu I/O)"""
+    if extraction_history is None or get_parsed_status(response) != "success":
+        return
+    extraction_history.record(jid_key(chat), doc, response, get_quoted_file_sha256(image_message))
+
+# Preprocessing gambar sebelum upload (opsional, membutuhkan Pillow)
+def preprocess_image_bytes(media_bytes, max_edge, quality):
+    """
+    Memperbaiki orientasi EXIF, memperkecil sisi terpanjang ke max_edge dan
+    meng-encode ulang sebagai JPEG. Dijalankan di process pool.
+
+    Returns:
+        Tuple (bytes hasil, True) jika hasilnya lebih kecil, atau (None, False)
+        jika gambar asli sebaiknya dipakai apa adanya
+    """
+    import io
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(media_bytes)) as img:
+        img = ImageOps.exif_transpose(img)
+        if max(img.size) > max_edge:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+
+    data = out.getvalue()
+    if len(data) >= len(media_bytes):
+        return None, False
+    return data, True
+
+_image_pool = None
+preprocess_stats = {"images": 0, "bytes_in": 0, "bytes_out": 0, "seconds": 0.0}
+
+def get_image_pool():
+    global _image_pool
+    if _image_pool is None:
+        _image_pool = ProcessPoolExecutor(max_workers=IMAGE_PREPROCESS_WORKERS)
+    return _image_pool
+
+def shutdown_image_pool():
+    global _image_pool
+    if _image_pool is not None:
+        _image_pool.shutdown(wait=False, cancel_futures=True)
+        _image_pool = None
+
+async def preprocess_media(doc_type, media_bytes, mime_type):
+    """Mengecilkan payload gambar sebelum di-upload; mengembalikan (bytes, mime_type)"""
+    if not IMAGE_PREPROCESS_ENABLED or not PIL_AVAILABLE:
+        return media_bytes, mime_type
+    if len(media_bytes) < IMAGE_PREPROCESS_MIN_BYTES:
+        return media_bytes, mime_type
+
+    max_edge = IMAGE_MAX_EDGE.get(doc_type, max(IMAGE_MAX_EDGE.values()))
+    started = time.monotonic()
+    try:
+        loop = asyncio.get_running_loop()
+        data, changed = await loop.run_in_executor(
+            get_image_pool(), preprocess_image_bytes, bytes(media_bytes), max_edge, IMAGE_JPEG_QUALITY
+        )
+    except Exception as e:
+        media_log.error("Error preprocessing image, sending original: %s", e)
+        return media_bytes, mime_type
+
+    elapsed = time.monotonic() - started
+    metrics.observe("stage_seconds", elapsed, stage="preprocess")
+    if not changed:
+        media_log.info("Image preprocessing kept original (%s bytes, %.0f ms)", len(media_bytes), elapsed * 1000)
+        return media_bytes, mime_type
+
+    preprocess_stats["images"] += 1
+    preprocess_stats["bytes_in"] += len(media_bytes)
+    preprocess_stats["bytes_out"] += len(data)
+    preprocess_stats["seconds"] += elapsed
+    metrics.inc("preprocess_images_total")
+    metrics.inc("preprocess_bytes_total", len(media_bytes), direction="in")
+    metrics.inc("preprocess_bytes_total", len(data), direction="out")
+    saved = len(media_bytes) - len(data)
+    media_log.info("Preprocessed %s image: %s -> %s bytes (saved %s bytes, %s%%) in %.0f ms",
+                   doc_type, len(media_bytes), len(data), saved, saved * 100 // len(media_bytes), elapsed * 1000)
+    return data, "image/jpeg"
+
+async def call_extractor(doc, media_bytes, mime_type, file_name):
+    media_bytes, mime_type = await preprocess_media(doc.key, media_bytes, mime_type)
+    started = time.monotonic()
+    with job_profiler.trace_memory("extractor"):
+        response = await query_extractor(doc, media_bytes, mime_type, file_name)
+    elapsed = time.monotonic() - started
+    metrics.observe("stage_seconds", elapsed, stage="extractor")
+    metrics.inc("extractions_total", doc_type=doc.key, outcome=get_parsed_status(response) or "error")
+    log.info("%s extractor round-trip took %.0f ms for %s bytes", doc.name, elapsed * 1000, len(media_bytes))
+    return response
+
+async def query_extractor_cached(doc, media_bytes, mime_type, file_name):
+    """
+    Memanggil extractor dengan cache berbasis SHA-256 dari media_bytes.
+
+    SHA-256 dari gambar hasil download sama dengan fileSHA256 WhatsApp, sehingga
+    hasil yang disimpan di sini juga ditemukan oleh lookup_cached_extraction.
+    Pemanggilan identik (hash + jenis dokumen) yang sedang berjalan digabung
+    melalui extraction_flight.
+    """
+    media_hash = hashlib.sha256(media_bytes).hexdigest()
+    if extraction_cache is None:
+        return await extraction_flight.do(
+            (media_hash, doc.key), lambda: call_extractor(doc, media_bytes, mime_type, file_name)
+        )
+
+    response = await extraction_cache.get(media_hash, doc.key)
+    metrics.inc("cache_requests_total", result="miss" if response is None else "hit")
+    if response is not None:
+        log.info("Extraction cache hit for %s (sha256 %s)", doc.key, media_hash[:12])
+        return response
+
+    async def extract_and_store():
+        response = await call_extractor(doc, media_bytes, mime_type, file_name)
+        if is_cacheable_response(response):
+            await extraction_cache.put(media_hash, doc.key, response)
+        return response
+
+    # Permintaan identik yang sedang berjalan cukup menunggu hasil yang sama
+    return await extraction_flight.do((media_hash, doc.key), extract_and_store)
+
+# Helper function untuk mendapatkan pesan yang dikutip dan jenisnya
+async def get_quoted_message_info(message):
+    started = time.monotonic()
+    has_quoted = False
+    quoted_message = None
+    quoted_type = None
+    
+    try:
+        # Check untuk extended text message
+        if (hasattr(message.Message, 'extendedTextMessage') and 
+            hasattr(message.Message.extendedTextMessage, 'contextInfo') and
+            hasattr(message.Message.extendedTextMessage.contextInfo, 'quotedMessage')):
+            
+            quoted_message = message.Message.extendedTextMessage.contextInfo.quotedMessage
+            has_quoted = True
+            
+            # Coba gunakan thundra_io untuk deteksi tipe
+            try:
+                from thundra_io.utils import get_message_type
+                from thundra_io.types import MediaMessageType
+                msg_type = get_message_type(quoted_message)
+                if isinstance(msg_type, MediaMessageType):
+                    quoted_type = msg_type.__class__.__name__.lower().replace('message', '')
+                    media_log.info("Detected quoted %s message using thundra_io", quoted_type)
+            except Exception as e:
+                media_log.error("Error using thundra_io for type detection: %s", e)
+            
+            # Fallback ke metode deteksi lama jika thundra_io gagal
+            if not quoted_type:
+                if hasattr(quoted_message, 'videoMessage'):
+                    quoted_type = "video"
+                    media_log.info("Detected quoted video message")
+                elif hasattr(quoted_message, 'audioMessage'):
+                    quoted_type = "audio"
+                    media_log.info("Detected quoted audio message")
+                elif hasattr(quoted_message, 'imageMessage'):
+                    quoted_type = "image"
+                    media_log.info("Detected quoted image message")
+                elif hasattr(quoted_message, 'documentMessage'):
+                    quoted_type = "document"
+                    media_log.info("Detected quoted document message")
+                else:
+                    media_log.info("Unknown quoted message type")
+                    # Dump field pesan (disampling, hanya saat DEBUG)
+                    if should_dump_diagnostics():
+                        diag_log.debug("Quoted message fields: %s", describe_fields(quoted_message))
+    
+    except Exception as e:
+        media_log.error("Error in get_quoted_message_info: %s", e)
+        media_log.error(traceback.format_exc())
+
+    metrics.observe("stage_seconds", time.monotonic() - started, stage="quoted_parse")
+    return has_quoted, quoted_message, quoted_type
+
+# Fungsi download langsung dari URL jika tersedia
+async def download_from_url(url, max_bytes=None):
+    """
+    Mengunduh media dari URL secara streaming menggunakan HTTP session bersama.
+
+    Download dibatalkan lebih awal jika Content-Length melebihi batas, atau jika
+    jumlah byte yang diterima melewati batas saat streaming. Data dikumpulkan
+    langsung ke satu bytearray (tanpa menggabungkan potongan bytes berulang).
+
+    Returns:
+        bytearray berisi isi media, atau None jika gagal
+    """
+    if max_bytes is None:
+        max_bytes = MEDIA_DOWNLOAD_MAX_BYTES
+    try:
+        media_log.info("Downloading from URL: %s", url)
+        import aiohttp
+        session = get_http_session()
+        timeout = aiohttp.ClientTimeout(total=MEDIA_DOWNLOAD_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        async with session.get(url, timeout=timeout) as response:
+            if response.status != 200:
+                media_log.error("Failed to download from URL: status code %s", response.status)
+                return None
+
+            content_length = response.content_length
+            if content_length is not None and content_length > max_bytes:
+                media_log.error("Refusing URL download: Content-Length %s exceeds limit %s", content_length, max_bytes)
+                return None
+
+            buffer = bytearray()
+            async for chunk in response.content.iter_chunked(MEDIA_DOWNLOAD_CHUNK_SIZE):
+                if len(buffer) + len(chunk) > max_bytes:
+                    media_log.error("Aborting URL download: body exceeds limit %s bytes", max_bytes)
+                    return None
+                buffer += chunk
+
+        media_log.info("Successfully downloaded %s bytes from URL", len(buffer))
+        return buffer
+    except asyncio.TimeoutError:
+        media_log.error("Timeout downloading from URL after %ss", MEDIA_DOWNLOAD_TIMEOUT)
+        return None
+    except Exception as e:
+        media_log.error("Error downloading from URL: %s", e)
+        media_log.error(traceback.format_exc())
+        return None
+
+# Strategi download media: urutan metode adaptif dengan hedging
+class DownloadMethodStats:
+    """Riwayat terbaru satu metode download: hasil (sukses/gagal) dan latensi"""
+
+    def __init__(self, name, prior_rank):
+        self.name = name
+        self.prior_rank = prior_rank
+        self._outcomes = deque(maxlen=MEDIA_STRATEGY_WINDOW)
+        self._latencies = deque(maxlen=MEDIA_STRATEGY_WINDOW)
+        self.successes = 0
+        self.failures = 0
+        self.cancelled = 0
+
+    def record(self, ok, latency):
+        self._outcomes.append(ok)
+        if ok:
+            self.successes += 1
+            self._latencies.append(latency)
+        else:
+            self.failures += 1
+
+    def record_cancelled(self, elapsed):
+        # Kalah race: latensi sebenarnya minimal selama ini, dipakai sebagai batas bawah
+        self.cancelled += 1
+        self._latencies.append(elapsed)
+
+    @property
+    def samples(self):
+        return len(self._outcomes)
+
+    def success_rate(self):
+        # Laplace smoothing supaya satu kegagalan awal tidak langsung menjatuhkan metode
+        return (sum(self._outcomes) + 1) / (len(self._outcomes) + 2)
+
+    def latency_percentile(self, pct):
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+    def expected_cost(self):
+        """Perkiraan waktu sampai sukses (p50 / tingkat sukses); urutan awal jika sampel kurang"""
+        p50 = self.latency_percentile(50)
+        if self.samples < MEDIA_STRATEGY_MIN_SAMPLES or p50 is None:
+            return MEDIA_HEDGE_DELAY * (self.prior_rank + 1)
+        return p50 / self.success_rate()
+
+    def hedge_delay(self):
+        """Waktu tunggu sebelum metode berikutnya ikut dijalankan (p95 sukses, dibatasi)"""
+        p95 = self.latency_percentile(95)
+        if self.samples < MEDIA_STRATEGY_MIN_SAMPLES or p95 is None:
+            return MEDIA_HEDGE_DELAY
+        return min(MEDIA_HEDGE_MAX_DELAY, max(MEDIA_HEDGE_MIN_DELAY, p95))
+
+    def snapshot(self):
+        return {
+            "method": self.name,
+            "samples": self.samples,
+            "expected_cost": self.expected_cost(),
+            "successes": self.successes,
+            "failures": self.failures,
+            "cancelled": self.cancelled,
+            "success_rate": round(self.success_rate(), 3),
+            "p50": self.latency_percentile(50),
+            "p95": self.latency_percentile(95),
+            "hedge_delay": self.hedge_delay(),
+        }
+
+class DownloadStrategy:
+    """
+    Menjalankan metode download dengan urutan adaptif dan hedging.
+
+    Metode diurutkan dari perkiraan waktu sampai sukses terkecil (riwayat
+    terbaru per metode; urutan bawaan selama sampel belum cukup). Metode
+    pertama dijalankan; jika belum selesai setelah hedge_delay metode itu,
+    metode berikutnya ikut dijalankan, dan jika sebuah metode gagal metode
+    berikutnya langsung dimulai. Hasil valid pertama menang dan task lain
+    dibatalkan lalu ditunggu sampai selesai (metode yang berjalan di thread
+    tetap selesai di background, hasilnya dibuang).
+    """
+
+    def __init__(self, methods):
+        self.methods = {name: DownloadMethodStats(name, rank) for rank, name in enumerate(methods)}
+        self.hedges = 0
+
+    def ranked(self, names):
+        return sorted(names, key=lambda name: self.methods[name].expected_cost())
+
+    async def run(self, attempts):
+        """
+        Args:
+            attempts: dict nama metode -> fungsi async tanpa argumen yang
+                mengembalikan hasil (truthy) atau None jika gagal
+
+        Returns:
+            Hasil metode pemenang, atau None jika semua metode gagal
+        """
+        waiting = self.ranked(attempts)
+        pending = {}  # task -> (nama metode, waktu mulai)
+        last_launch = None
+
+        def launch():
+            nonlocal last_launch
+            name = waiting.pop(0)
+            last_launch = (name, time.monotonic())
+            pending[asyncio.ensure_future(attempts[name]())] = last_launch
+            media_log.info("Trying %s download", name)
+
+        launch()
+        try:
+            while pending:
+                timeout = None
+                if waiting:
+                    name, started = last_launch
+                    timeout = max(0.0, self.methods[name].hedge_delay() - (time.monotonic() - started))
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.hedges += 1
+                    metrics.inc("download_hedges_total")
+                    media_log.info("%s download still running after %.1fs, hedging with %s",
+                                   last_launch[0], time.monotonic() - last_launch[1], waiting[0])
+                    launch()
+                    continue
+
+                winner = None
+                for task in done:
+                    name, started = pending.pop(task)
+                    elapsed = time.monotonic() - started
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        media_log.error("Error in %s download: %s", name, e)
+                        media_log.error(traceback.format_exc())
+                        result = None
+                    self.methods[name].record(bool(result), elapsed)
+                    metrics.inc("download_attempts_total", method=name, result="success" if result else "failed")
+                    if result and winner is None:
+                        winner = result
+                    elif not result:
+                        media_log.warning("%s download failed after %.0f ms", name, elapsed * 1000)
+                if winner is not None:
+                    return winner
+                if waiting:
+                    launch()
+            return None
+        finally:
+            for task, (name, started) in pending.items():
+                task.cancel()
+                self.methods[name].record_cancelled(time.monotonic() - started)
+                metrics.inc("download_attempts_total", method=name, result="cancelled")
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def snapshot(self):
+        """Urutan metode saat ini beserta riwayat yang mendasarinya, untuk /health"""
+        order = self.ranked(self.methods)
+        return {
+            "order": order,
+            "hedges": self.hedges,
+            "methods": [self.methods[name].snapshot() for name in order],
+        }
+
+media_download_strategy = DownloadStrategy(("thundra_io", "download_any", "url"))
+
+@dataclass
+class MediaDownload:
+    """Hasil download media; low_resolution=True jika hanya thumbnail JPEG yang didapat"""
+    data: bytes
+    mime_type: str
+    file_name: str
+    method: str
+    low_resolution: bool = False
+
+LOW_RESOLUTION_NOTICE = (
+    "⚠️ Gambar asli gagal diunduh, ekstraksi memakai thumbnail beresolusi rendah "
+    "sehingga hasilnya mungkin tidak akurat."
+)
+
+def fetch_thundra_content(quoted_message):
+    """Download lewat thundra_io (blocking, dijalankan di thread); (bytes, mime_type, ekstensi) atau None"""
+    from thundra_io.utils import get_message_type
+    from thundra_io.types import MediaMessageType
+    from thundra_io.storage.file import File
+    msg_type = get_message_type(quoted_message)
+    if not isinstance(msg_type, MediaMessageType):
+        media_log.warning("thundra_io did not detect a media message type")
+        return None
+
+    # Buat File object dari message
+    file_obj = File.from_message(msg_type)
+    if not (hasattr(file_obj, 'get_content') and callable(file_obj.get_content)):
+        media_log.warning("thundra_io File object doesn't have get_content method")
+        return None
+    media_bytes = file_obj.get_content()
+    if not media_bytes:
+        return None
+
+    # Set default extension dan mime_type, lalu pakai info dari file_obj jika ada
+    mime_type = file_obj.mime_type if hasattr(file_obj, 'mime_type') else "image/jpeg"
+    extension = ".jpg"
+    if hasattr(file_obj, 'get_extension') and callable(file_obj.get_extension):
+        extension = file_obj.get_extension() or extension
+    return media_bytes, mime_type, extension
+
+# Fungsi untuk mengunduh media (image)
+async def download_media(client, quoted_message, quoted_type):
+    """
+    Mengunduh gambar yang dikutip lewat media_download_strategy (thundra_io,
+    download_any dan URL langsung, dengan hedging). JPEGThumbnail hanya
+    dipakai jika semua metode gagal, sebagai hasil low_resolution.
+
+    Returns:
+        MediaDownload, atau None jika gambar tidak dapat diunduh
+    """
+    try:
+        media_log.info("Starting download process for %s", quoted_type)
+        
+        # Hanya fokus pada image untuk Extractor
+        if quoted_type != "image":
+            media_log.info("Media type %s not supported for extraction, only images are supported", quoted_type)
+            return None
+        if not hasattr(quoted_message, 'imageMessage'):
+            media_log.error("Image message attribute not found")
+            return None
+
+        media_obj = quoted_message.imageMessage
+        mime_type = getattr(media_obj, 'mimetype', "image/jpeg")
+
+        # Debug: dump field media_obj (disampling, hanya saat DEBUG; thumbnail & mediaKey diredaksi)
+        if should_dump_diagnostics():
+            diag_log.debug("Media object fields for image: %s", describe_fields(media_obj))
+
+        async def via_thundra():
+            result = await asyncio.to_thread(fetch_thundra_content, quoted_message)
+            if result is None:
+                return None
+            media_bytes, thundra_mime_type, extension = result
+            return MediaDownload(media_bytes, thundra_mime_type, make_media_file_name("image_thundra", extension), "thundra_io")
+
+        async def via_download_any():
+            from neonize.proto.waE2E.WAWebProtobufsE2E_pb2 import Message
+            message = Message()
+            message.imageMessage.CopyFrom(media_obj)
+            media_bytes = await client.download_any(message)
+            if not media_bytes:
+                return None
+            return MediaDownload(media_bytes, mime_type, make_media_file_name("image", ".jpg"), "download_any")
+
+        url = getattr(media_obj, 'URL', None) or getattr(media_obj, 'url', None)
+
+        async def via_url():
+            media_bytes = await download_from_url(url)
+            if not media_bytes:
+                return None
+            return MediaDownload(media_bytes, mime_type, make_media_file_name("image_url", ".jpg"), "url")
+
+        attempts = {"thundra_io": via_thundra, "download_any": via_download_any}
+        if url:
+            attempts["url"] = via_url
+        media = await media_download_strategy.run(attempts)
+        if media is not None:
+            media_log.info("Successfully downloaded image using %s: %s bytes", media.method, len(media.data))
+            metrics.inc("download_method_total", method=media.method)
+            return media
+
+        # Fallback eksplisit: thumbnail beresolusi rendah, ditandai low_resolution
+        if MEDIA_THUMBNAIL_FALLBACK and media_obj.JPEGThumbnail:
+            thumbnail_bytes = media_obj.JPEGThumbnail
+            media_log.warning("All full-resolution downloads failed, using %s-byte JPEGThumbnail", len(thumbnail_bytes))
+            metrics.inc("download_method_total", method="thumbnail")
+            return MediaDownload(thumbnail_bytes, "image/jpeg", make_media_file_name("image_thumbnail", ".jpg"),
+                                 "thumbnail", low_resolution=True)
+
+        media_log.error("All download methods failed for image")
+        metrics.inc("download_method_total", method="failed")
+        return None
+
+    except Exception as e:
+        media_log.error("Error in download_media: %s", e)
+        media_log.error(traceback.format_exc())
+        return None
+
+# Encoder body request extractor tanpa membangun string base64 dan dict JSON utuh
+def build_extractor_request(action, media_bytes, mime_type, file_name):
+    """
+    Menyiapkan argumen session.post() untuk API extractor.
+
+    Pada mode "stream" (default), envelope JSON ditulis sebagai prefix/suffix
+    bytes dan field fileData di-encode base64 per potongan langsung ke body
+    request, sehingga tidak ada string base64 utuh maupun hasil serialisasi
+    json= di memori. Content-Length dihitung di depan agar request tidak
+    memakai chunked transfer encoding. Mode "json" mempertahankan payload lama.
+    """
+    headers = {"Content-Type": "application/json"}
+    if UPLOAD_MODE == "json":
+        with metrics.timer("stage_seconds", stage="encode"):
+            file_data = base64.b64encode(media_bytes).decode('utf-8')
+        payload = {
+            "action": action,
+            "fileData": file_data,
             "fileName": file_name,
             "mimeType": mime_type
         }
-        
-        headers = {
-            "Content-Type": "application/json"
+        return {"json": payload, "headers": headers}
+
+    prefix = (
+        '{"action": ' + json.dumps(action)
+        + ', "fileName": ' + json.dumps(file_name)
+        + ', "mimeType": ' + json.dumps(mime_type)
+        + ', "fileData": "'
+    ).encode('utf-8')
+    suffix = b'"}'
+    b64_length = 4 * ((len(media_bytes) + 2) // 3)
+    headers["Content-Length"] = str(len(prefix) + b64_length + len(suffix))
+    return {"data": iter_base64_json_body(prefix, media_bytes, suffix), "headers": headers}
+
+async def iter_base64_json_body(prefix, media_bytes, suffix):
+    yield prefix
+    view = memoryview(media_bytes)
+    # Ukuran potongan kelipatan 3 (minimal 3) supaya tidak ada padding di tengah data base64
+    step = max(3, UPLOAD_CHUNK_SIZE - (UPLOAD_CHUNK_SIZE % 3))
+    # Waktu encode dijumlahkan per potongan (tanpa waktu tunggu jaringan)
+    encode_seconds = 0.0
+    for offset in range(0, len(view), step):
+        started = time.monotonic()
+        chunk = base64.b64encode(view[offset:offset + step])
+        encode_seconds += time.monotonic() - started
+        yield chunk
+    metrics.observe("stage_seconds", encode_seconds, stage="encode")
+    yield suffix
+
+def decode_response_body(body):
+    """Parse JSON langsung dari bytes respons (tanpa decode ke str terlebih dulu)"""
+    return json.loads(body)
+
+def preview_response_body(body, limit=500):
+    return bytes(body[:limit]).decode('utf-8', 'replace')
+
+# Circuit breaker dan latensi per endpoint extractor
+class EndpointHealth:
+    """
+    Status ketahanan satu endpoint extractor.
+
+    Circuit breaker: setelah failure_threshold kegagalan berturut-turut,
+    circuit terbuka (open) dan request langsung ditolak selama reset_timeout.
+    Setelah itu satu request percobaan diizinkan (half_open); jika berhasil
+    circuit kembali closed, jika gagal circuit terbuka lagi.
+
+    Timeout adaptif: setelah cukup sampel, timeout = p95 latensi sukses dikali
+    ADAPTIVE_TIMEOUT_MULTIPLIER, dibatasi antara ADAPTIVE_TIMEOUT_MIN dan
+    timeout maksimum yang dikonfigurasi untuk jenis dokumen.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, doc_key, url, max_timeout):
+        self.doc_key = doc_key
+        self.url = url
+        self.max_timeout = max_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def _transition(self, state):
+        if state != self.state:
+            http_log.warning("Circuit for %s endpoint %s changed %s -> %s", self.doc_key, self.url, self.state, state)
+            self.state = state
+
+    def allow_request(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < BREAKER_RESET_TIMEOUT:
+                self.rejected += 1
+                return False
+            self._transition(self.HALF_OPEN)
+        # Half-open: hanya satu request percobaan dalam satu waktu
+        if self._probe_in_flight:
+            self.rejected += 1
+            return False
+        self._probe_in_flight = True
+        return True
+
+    def release_probe(self):
+        # Dipanggil jika request percobaan dibatalkan sebelum ada hasil
+        self._probe_in_flight = False
+
+    def retry_after(self):
+        if self.state != self.OPEN:
+            return 0
+        return max(0, BREAKER_RESET_TIMEOUT - (time.monotonic() - self.opened_at))
+
+    def record_success(self, latency):
+        self._probe_in_flight = False
+        self.successes += 1
+        self.consecutive_failures = 0
+        self._latencies.append(latency)
+        self._transition(self.CLOSED)
+
+    def record_failure(self):
+        self._probe_in_flight = False
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= BREAKER_FAILURE_THRESHOLD:
+            self.opened_at = time.monotonic()
+            self._transition(self.OPEN)
+
+    def latency_percentile(self, pct):
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+    def current_timeout(self):
+        if len(self._latencies) < ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+            return self.max_timeout
+        p95 = self.latency_percentile(95)
+        return min(self.max_timeout, max(ADAPTIVE_TIMEOUT_MIN, p95 * ADAPTIVE_TIMEOUT_MULTIPLIER))
+
+    def snapshot(self):
+        return {
+            "doc_type": self.doc_key,
+            "url": self.url,
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "successes": self.successes,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "p50": self.latency_percentile(50),
+            "p95": self.latency_percentile(95),
+            "timeout": self.current_timeout(),
+            "retry_after": self.retry_after(),
         }
-        
-        log.info("Sending request to Ijazah Extractor API...")
-        log.info(f"API URL: {IJAZAH_API_URL}")
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(IJAZAH_API_URL, json=payload, headers=headers) as response:
-                response_text = await response.text()
-                
-                # Log the raw response for debugging
-                log.info(f"Raw response status: {response.status}")
-                log.info(f"Raw response headers: {response.headers}")
-                # Log first 500 chars of response text to avoid flooding logs
-                log.info(f"Raw response text (first 500 chars): {response_text[:500]}")
-                
-                if response.status == 200:
-                    try:
-                        response_json = json.loads(response_text)
-                        log.info("Successfully got response from Ijazah Extractor API")
-                        return response_json
-                    except json.JSONDecodeError as e:
-                        log.error(f"Error parsing JSON response: {e}")
-                        log.error(f"Response text: {response_text}")
-                        return {"status": "error", "message": f"Error parsing JSON response: {str(e)}", "code": 500}
-                else:
-                    log.error(f"Ijazah Extractor API error: {response_text}")
-                    return {"status": "error", "message": f"Error dari Ijazah Extractor API: Status {response.status}.", "code": response.status}
+
+endpoint_health = {}
+
+def get_endpoint_health(doc, url):
+    key = (doc.key, url)
+    health = endpoint_health.get(key)
+    if health is None:
+        health = EndpointHealth(doc.key, url, EXTRACTOR_TIMEOUTS.get(doc.key, DEFAULT_HTTP_TIMEOUT))
+        endpoint_health[key] = health
+    return health
+
+def get_breaker_states():
+    """Snapshot status circuit breaker semua endpoint, untuk monitoring"""
+    return [health.snapshot() for health in endpoint_health.values()]
+
+# Status circuit sebagai angka untuk gauge: 0 closed, 1 half_open, 2 open
+BREAKER_STATE_VALUES = {EndpointHealth.CLOSED: 0, EndpointHealth.HALF_OPEN: 1, EndpointHealth.OPEN: 2}
+
+metrics.gauge_family(
+    "endpoint_breaker_state",
+    "Circuit breaker state per extractor endpoint (0 closed, 1 half_open, 2 open)",
+    lambda: [({"doc_type": health.doc_key, "endpoint": health.url}, BREAKER_STATE_VALUES[health.state])
+             for health in endpoint_health.values()],
+)
+
+# Prioritas antrean extractor: angka kecil dilayani lebih dulu
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_SPECULATIVE = 2
+extractor_priority_var = contextvars.ContextVar("extractor_priority", default=PRIORITY_INTERACTIVE)
+
+async def with_extractor_priority(priority, coro):
+    """Menjalankan coroutine dengan prioritas antrean extractor tertentu"""
+    token = extractor_priority_var.set(priority)
+    try:
+        return await coro
+    finally:
+        extractor_priority_var.reset(token)
+
+def quota_day():
+    """Tanggal hari kuota (YYYY-MM-DD) dan detik hingga hari kuota berikutnya"""
+    day_index, into_day = divmod(time.time() + EXTRACTOR_QUOTA_UTC_OFFSET * 3600, 86400)
+    return datetime.fromtimestamp(day_index * 86400, timezone.utc).strftime("%Y-%m-%d"), 86400 - into_day
+
+def get_rate_limit_setting(doc_key, name, default):
+    # Override per jenis dokumen, mis. KTP_API_RPS, lalu default EXTRACTOR_*
+    value = os.environ.get(f"{doc_key.upper()}_API_{name}", "").strip()
+    return type(default)(value) if value else default
+
+class EndpointLimiter:
+    """
+    Pembatas laju satu endpoint (deployment) extractor.
+
+    Token bucket (rps, burst) membatasi laju request baru, max_in_flight
+    membatasi request yang berjalan bersamaan dan daily_quota membatasi jumlah
+    request per hari kuota; 0 berarti tanpa batas. Request yang belum boleh
+    jalan menunggu di antrean prioritas (angka kecil lebih dulu, FIFO untuk
+    prioritas yang sama) alih-alih dikirim lalu ditolak dengan 429.
+    """
+
+    def __init__(self, url, rps, burst, max_in_flight, daily_quota):
+        self.url = url
+        self.rps = rps
+        self.burst = max(1, burst)
+        self.max_in_flight = max_in_flight
+        self.daily_quota = daily_quota
+        self.tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.quota_day = quota_day()[0]
+        self.quota_used = 0
+        # Pemakaian yang belum ditulis ke extractor_quota_store
+        self.quota_unsaved = 0
+        self._waiters = []  # heap (priority, seq, future)
+        self._seq = 0
+        self._timer = None
+        self.started = 0
+        self.queued = 0
+        self.limited = 0
+
+    @property
+    def waiting(self):
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def roll_quota_day(self):
+        day = quota_day()[0]
+        if day != self.quota_day:
+            self.quota_day = day
+            self.quota_used = 0
+            self.quota_unsaved = 0
+
+    def quota_remaining(self):
+        if not self.daily_quota:
+            return None
+        self.roll_quota_day()
+        return max(0, self.daily_quota - self.quota_used)
+
+    def _refill(self, now):
+        if self.rps > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self._refilled) * self.rps)
+        self._refilled = now
+
+    def _start_delay(self):
+        """Detik hingga request berikutnya boleh dimulai, None jika menunggu slot in-flight"""
+        now = time.monotonic()
+        self._refill(now)
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return None
+        delay = max(0.0, self.paused_until - now)
+        if self.rps > 0 and self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.rps)
+        if self.quota_remaining() == 0:
+            delay = max(delay, quota_day()[1])
+        return delay
+
+    def _take(self):
+        if self.rps > 0:
+            self.tokens -= 1
+        self.in_flight += 1
+        self.started += 1
+        self.roll_quota_day()
+        self.quota_used += 1
+        self.quota_unsaved += 1
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters:
+            if self._waiters[0][2].done():
+                # Waiter yang dibatalkan dibuang saat sampai di depan antrean
+                heapq.heappop(self._waiters)
+                continue
+            delay = self._start_delay()
+            if delay is None:
+                return  # release() memanggil _dispatch lagi saat slot kosong
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            _, _, future = heapq.heappop(self._waiters)
+            self._take()
+            future.set_result(None)
+
+    async def acquire(self, priority=PRIORITY_INTERACTIVE):
+        """Menunggu giliran; setiap acquire yang berhasil wajib diikuti release()"""
+        if not self._waiters and self._start_delay() == 0:
+            self._take()
+            return
+        self.queued += 1
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Giliran sudah diberikan sebelum pembatalan diproses
+                self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        if self._waiters:
+            self._dispatch()
+
+    def pause(self, seconds):
+        """Menahan request baru, mis. setelah endpoint membalas 429"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def estimate_wait(self, priority, service_time):
+        """
+        Perkiraan detik hingga request baru dengan prioritas ini dimulai.
+        service_time adalah perkiraan lama satu request (p50 latensi endpoint).
+        """
+        ahead = sum(1 for p, _, future in self._waiters if p <= priority and not future.done())
+        remaining = self.quota_remaining()
+        if remaining is not None and remaining <= ahead:
+            return quota_day()[1]
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.paused_until - now)
+        if self.rps > 0:
+            wait = max(wait, (ahead + 1 - self.tokens) / self.rps)
+        if self.max_in_flight:
+            # Slot dianggap kosong bergiliran setiap service_time / max_in_flight
+            excess = self.in_flight + ahead + 1 - self.max_in_flight
+            if excess > 0:
+                wait = max(wait, excess * service_time / self.max_in_flight)
+        return wait
+
+    def snapshot(self):
+        return {
+            "url": self.url,
+            "rps": self.rps,
+            "tokens": round(self.tokens, 2),
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "waiting": self.waiting,
+            "quota_day": self.quota_day,
+            "quota_used": self.quota_used,
+            "daily_quota": self.daily_quota,
+            "started": self.started,
+            "queued": self.queued,
+            "limited": self.limited,
+        }
+
+endpoint_limiters = {}
+
+def get_endpoint_limiter(doc, url):
+    # Satu limiter per URL: deployment yang dipakai beberapa jenis dokumen berbagi kuota
+    limiter = endpoint_limiters.get(url)
+    if limiter is None:
+        limiter = EndpointLimiter(
+            url,
+            get_rate_limit_setting(doc.key, "RPS", EXTRACTOR_RPS),
+            get_rate_limit_setting(doc.key, "BURST", EXTRACTOR_BURST),
+            get_rate_limit_setting(doc.key, "MAX_IN_FLIGHT", EXTRACTOR_MAX_IN_FLIGHT),
+            get_rate_limit_setting(doc.key, "DAILY_QUOTA", EXTRACTOR_DAILY_QUOTA),
+        )
+        if extractor_quota_store is not None:
+            limiter.quota_used = extractor_quota_store.used_today(url)
+        endpoint_limiters[url] = limiter
+    return limiter
+
+class ExtractorQuotaStore:
+    """
+    Pemakaian kuota harian per endpoint di SQLite (mode WAL).
+
+    Limiter mencatat pemakaian di memori; flush() berkala menambahkan selisihnya
+    ke database di thread lalu membaca total terbaru, sehingga kuota tetap
+    terhitung setelah restart dan dibagi antar shard yang memakai file yang sama.
+    """
+
+    def __init__(self, db_path, flush_interval):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self._day = None
+        self._totals = {}
+        self._task = None
+        self._db = None
+        self._db_lock = threading.Lock()
+
+    def _connection(self):
+        # Dipanggil dengan _db_lock dipegang
+        if self._db is None:
+            db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS extractor_quota ("
+                "endpoint TEXT NOT NULL, day TEXT NOT NULL, used INTEGER NOT NULL, "
+                "PRIMARY KEY (endpoint, day))"
+            )
+            db.commit()
+            self._db = db
+        return self._db
+
+    def used_today(self, url):
+        return self._totals.get(url, 0) if self._day == quota_day()[0] else 0
+
+    def _sync(self, day, deltas):
+        with self._db_lock:
+            db = self._connection()
+            with db:
+                db.executemany(
+                    "INSERT INTO extractor_quota (endpoint, day, used) VALUES (?, ?, ?) "
+                    "ON CONFLICT (endpoint, day) DO UPDATE SET used = used + excluded.used",
+                    [(url, day, used) for url, used in deltas.items() if used],
+                )
+                db.execute("DELETE FROM extractor_quota WHERE day < ?", (day,))
+                return dict(db.execute("SELECT endpoint, used FROM extractor_quota WHERE day = ?", (day,)).fetchall())
+
+    async def flush(self, limiters):
+        day = quota_day()[0]
+        deltas = {}
+        for limiter in limiters:
+            limiter.roll_quota_day()
+            deltas[limiter.url] = deltas.get(limiter.url, 0) + limiter.quota_unsaved
+            limiter.quota_unsaved = 0
+        if self._day == day and not any(deltas.values()):
+            # Tidak ada pemakaian baru: lewati transaksi tulis
+            return
+        try:
+            totals = await asyncio.to_thread(self._sync, day, deltas)
+        except Exception as e:
+            log.error("Error saving extractor quota usage: %s", e)
+            for limiter in limiters:
+                if limiter.quota_day == day:
+                    limiter.quota_unsaved += deltas.get(limiter.url, 0)
+                    deltas[limiter.url] = 0
+            return
+        self._day, self._totals = day, totals
+        for limiter in limiters:
+            # Total dari database sudah termasuk pemakaian shard lain
+            if limiter.quota_day == day:
+                limiter.quota_used = totals.get(limiter.url, 0) + limiter.quota_unsaved
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush(list(endpoint_limiters.values()))
+
+    async def start(self):
+        # Pemakaian hari ini dibaca sebelum request pertama dikirim
+        await self.flush(list(endpoint_limiters.values()))
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush(list(endpoint_limiters.values()))
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+            self._db = None
+
+def daily_quota_configured():
+    # Kuota global atau override per jenis dokumen, mis. KTP_API_DAILY_QUOTA=20000
+    if EXTRACTOR_DAILY_QUOTA > 0:
+        return True
+    return any(
+        name.endswith("_API_DAILY_QUOTA") and value.strip() and int(value) > 0
+        for name, value in os.environ.items()
+    )
+
+extractor_quota_store = None
+if EXTRACTOR_QUOTA_DB_PATH and daily_quota_configured():
+    extractor_quota_store = ExtractorQuotaStore(EXTRACTOR_QUOTA_DB_PATH, EXTRACTOR_QUOTA_FLUSH_INTERVAL)
+
+def format_wait_minutes(seconds):
+    return f"{max(1, int(-(-seconds // 60)))} menit"
+
+def backoff_delay(attempt):
+    # Exponential backoff dengan full jitter
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+# Fungsi untuk mengirim gambar ke satu endpoint API Extractor
+async def query_extractor_endpoint(doc, url, media_bytes, mime_type, file_name, timeout=None):
+    try:
+        http_log.info("Sending image to %s Extractor API, type: %s, size: %s bytes", doc.name, mime_type, len(media_bytes))
+
+        # Siapkan body request (base64 di-stream langsung ke body)
+        request_kwargs = build_extractor_request(doc.action, media_bytes, mime_type, file_name)
+
+        http_log.info("Sending request to %s Extractor API...", doc.name)
+
+        session = get_http_session()
+        async with session.post(url, timeout=get_extractor_timeout(doc.key, timeout),
+                                **request_kwargs) as response:
+            response_body = await response.read()
+
+            # Log the raw response for debugging (preview hanya dibuat jika DEBUG aktif)
+            if http_log.isEnabledFor(logging.DEBUG):
+                http_log.debug("Raw response status: %s, text (first 500 chars): %s",
+                               response.status, preview_response_body(response_body))
+
+            if response.status == 200:
+                try:
+                    response_json = decode_response_body(response_body)
+                    http_log.info("Successfully got response from %s Extractor API", doc.name)
+                    return response_json
+                except ValueError as e:
+                    http_log.error("Error parsing JSON response: %s", e)
+                    http_log.error("Response text: %s", preview_response_body(response_body))
+                    return {"status": "error", "message": f"Error parsing JSON response: {str(e)}", "code": 500}
+            else:
+                http_log.error("%s Extractor API error: %s", doc.name, preview_response_body(response_body))
+                return {"status": "error", "message": f"Error dari {doc.name} Extractor API: Status {response.status}.", "code": response.status}
+    except asyncio.TimeoutError:
+        http_log.error("Timeout waiting for %s Extractor API", doc.name)
+        return {"status": "error", "message": f"Timeout menunggu {doc.name} Extractor API.", "code": 504}
     except Exception as e:
-        log.error(f"Exception in query_ijazah_extractor: {e}")
-        log.error(traceback.format_exc())
+        http_log.error("Exception in %s extractor query: %s", doc.name, e)
+        http_log.error(traceback.format_exc())
         return {"status": "error", "message": f"Error: {str(e)}", "code": 500}
-        
-        
-# Fungsi untuk memformat data Ijazah untuk ditampilkan di WhatsApp
-def format_ijazah_response(response):
+
+def is_retryable_response(response):
+    # Error jaringan/server (5xx) dan rate limit (429) boleh dialihkan ke endpoint lain
+    if response.get("status") != "error":
+        return False
+    code = response.get("code", 500)
+    return code >= 500 or code == 429
+
+# Fungsi untuk mengirim gambar ke API Extractor sesuai jenis dokumen
+async def query_extractor(doc, media_bytes, mime_type, file_name):
+    """
+    Mengirim gambar ke endpoint extractor milik jenis dokumen doc.
+
+    Endpoint dicoba mulai dari perkiraan antrean rate limit terpendek (urutan
+    konfigurasi jika sama); endpoint yang circuit-nya terbuka atau antreannya
+    melebihi EXTRACTOR_MAX_WAIT dilewati. Setiap request menunggu giliran di
+    limiter endpoint sesuai extractor_priority_var. Kegagalan yang aman diulang
+    (timeout, 5xx, 429) dicoba lagi hingga RETRY_MAX_ATTEMPTS kali dengan
+    backoff ber-jitter sebelum pindah ke endpoint berikutnya; hanya timeout dan
+    5xx yang dihitung gagal oleh circuit breaker, error 4xx lain netral. Jika
+    tidak ada endpoint yang dapat dipakai, langsung mengembalikan error tanpa
+    menunggu.
+    """
+    response = None
+    retry_after = None
+    limited_wait = None
+    priority = extractor_priority_var.get()
+
+    def projected_wait(url):
+        # p50 latensi endpoint sebagai perkiraan lama satu request (5 detik sebelum ada sampel)
+        service_time = get_endpoint_health(doc, url).latency_percentile(50) or 5.0
+        return get_endpoint_limiter(doc, url).estimate_wait(priority, service_time)
+
+    for url in sorted(doc.endpoints, key=projected_wait):
+        health = get_endpoint_health(doc, url)
+        limiter = get_endpoint_limiter(doc, url)
+        for attempt in range(RETRY_MAX_ATTEMPTS + 1):
+            wait = projected_wait(url)
+            if wait > EXTRACTOR_MAX_WAIT:
+                limiter.limited += 1
+                metrics.inc("extractor_limited_total", doc_type=doc.key)
+                limited_wait = wait if limited_wait is None else min(limited_wait, wait)
+                http_log.warning("%s endpoint %s is rate limited (projected wait %.0fs), skipping", doc.name, url, wait)
+                break
+
+            if not health.allow_request():
+                wait = health.retry_after()
+                retry_after = wait if retry_after is None else min(retry_after, wait)
+                http_log.warning("Circuit open for %s endpoint %s, skipping", doc.name, url)
+                break
+
+            try:
+                with metrics.timer("stage_seconds", stage="rate_limit"):
+                    await limiter.acquire(priority)
+            except asyncio.CancelledError:
+                health.release_probe()
+                raise
+            started = time.monotonic()
+            try:
+                response = await query_extractor_endpoint(doc, url, media_bytes, mime_type, file_name,
+                                                          timeout=health.current_timeout())
+            except asyncio.CancelledError:
+                health.release_probe()
+                raise
+            finally:
+                limiter.release()
+            if response.get("status") != "error":
+                health.record_success(time.monotonic() - started)
+                return response
+            if not is_retryable_response(response):
+                # Error sisi klien (4xx) bukan tanda endpoint bermasalah: netral bagi circuit breaker
+                health.release_probe()
+                return response
+
+            if response.get("code") == 429:
+                # Sudah ditangani limiter (jeda request baru), bukan kegagalan circuit breaker
+                http_log.warning("%s endpoint %s returned 429, pausing new requests for %.0fs",
+                                 doc.name, url, EXTRACTOR_429_PAUSE)
+                limiter.pause(EXTRACTOR_429_PAUSE)
+                health.release_probe()
+            else:
+                health.record_failure()
+            if attempt < RETRY_MAX_ATTEMPTS and health.state != EndpointHealth.OPEN:
+                delay = backoff_delay(attempt)
+                http_log.info("Retrying %s endpoint in %.2fs (attempt %s/%s)",
+                              doc.name, delay, attempt + 2, RETRY_MAX_ATTEMPTS + 1)
+                await asyncio.sleep(delay)
+            else:
+                break
+
+    if response is None and limited_wait is not None:
+        wait = limited_wait if retry_after is None else min(limited_wait, retry_after)
+        return {
+            "status": "error",
+            "message": f"Layanan ekstraksi {doc.label} sedang mencapai batas kapasitas/kuota. "
+                       f"Silakan coba lagi dalam {format_wait_minutes(wait)}.",
+            "code": 429,
+        }
+    if response is None:
+        wait = int(retry_after or BREAKER_RESET_TIMEOUT) + 1
+        return {
+            "status": "error",
+            "message": f"Layanan ekstraksi {doc.label} sedang gangguan. Silakan coba lagi dalam {wait} detik.",
+            "code": 503,
+        }
+    return response
+
+# Renderer hasil ekstraksi: template per jenis dokumen dikompilasi sekali saat startup
+NOT_DETECTED = 'Tidak terdeteksi'
+RULE_MARKDOWN = "━━━━━━━━━━━━━━━━━━━━━━\n"
+RULE_PLAIN = "-" * 40 + "\n"
+
+class DocumentRenderer:
+    """
+    Merender data parsed menjadi dua keluaran sekaligus dalam satu lintasan:
+    teks WhatsApp (markdown + emoji) dan teks polos untuk file TXT.
+
+    Template berupa list item yang dikompilasi sekali menjadi list operasi
+    dengan prefix/suffix yang sudah jadi, sehingga saat render hanya tersisa
+    lookup field dan penggabungan string.
+
+    Item template:
+        ("text", markdown, plain)              teks statis
+        ("blank",)                             baris kosong
+        ("rule",)                              garis pemisah
+        ("title", text, emoji_fn)              judul; emoji_fn(parsed) -> emoji
+        ("section", emoji, text)               judul bagian
+        ("field", emoji, label, key, opts)     baris field; opts: code, optional, source
+        ("custom", fn)                         fn(parsed, md, plain) untuk bagian dinamis
+        ("disclaimer", text)                   catatan penutup
+    """
+
+    def __init__(self, template):
+        self._ops = [self._compile(item) for item in template]
+        # Daftar (label, key, source) field untuk export tabel (CSV/XLSX)
+        self.fields = tuple((item[2], item[3], item[4].get("source")) for item in template if item[0] == "field")
+
+    @staticmethod
+    def _compile(item):
+        kind = item[0]
+        if kind == "text":
+            _, markdown, plain = item
+            return lambda parsed, md, pt: (md.append(markdown), pt.append(plain))
+        if kind == "blank":
+            return lambda parsed, md, pt: (md.append("\n"), pt.append("\n"))
+        if kind == "rule":
+            return lambda parsed, md, pt: (md.append(RULE_MARKDOWN), pt.append(RULE_PLAIN))
+        if kind == "title":
+            _, text, emoji_fn = item
+            plain = f"{text}\n"
+
+            def title(parsed, md, pt):
+                emoji = emoji_fn(parsed)
+                md.append(f"{emoji} *{text}* {emoji}\n")
+                pt.append(plain)
+            return title
+        if kind == "section":
+            _, emoji, text = item
+            markdown, plain = f"{emoji} *{text}* {emoji}\n", f"{text}\n"
+            return lambda parsed, md, pt: (md.append(markdown), pt.append(plain))
+        if kind == "field":
+            _, emoji, label, key, opts = item
+            code = opts.get("code", False)
+            optional = opts.get("optional", False)
+            source = opts.get("source")
+            md_prefix = f"{emoji} *{label}:* " + ("`" if code else "")
+            md_suffix = ("`" if code else "") + "\n"
+            plain_prefix = f"{label}: "
+
+            def render_field(parsed, md, pt):
+                data = (parsed.get(source) or {}) if source else parsed
+                if optional:
+                    value = data.get(key)
+                    if not value:
+                        return
+                else:
+                    value = data.get(key, NOT_DETECTED)
+                md.append(f"{md_prefix}{value}{md_suffix}")
+                pt.append(f"{plain_prefix}{value}\n")
+            return render_field
+        if kind == "custom":
+            return item[1]
+        if kind == "disclaimer":
+            _, text = item
+            markdown, plain = f"⚠️ *PERHATIAN:* _{text}_", f"PERHATIAN: {text}"
+            return lambda parsed, md, pt: (md.append(markdown), pt.append(plain))
+        raise ValueError(f"Unknown template item: {kind}")
+
+    def render(self, parsed):
+        """Mengembalikan tuple (teks WhatsApp, teks polos)"""
+        md, plain = [], []
+        for op in self._ops:
+            op(parsed, md, plain)
+        return "".join(md), "".join(plain)
+
+def template_field(emoji, label, key, **opts):
+    return ("field", emoji, label, key, opts)
+
+DISCLAIMER = "Gunakan informasi ini hanya untuk keperluan yang sah dan legal. Penyalahgunaan data pribadi dapat dikenakan sanksi hukum."
+
+KTP_RENDERER = DocumentRenderer([
+    ("title", "HASIL EKSTRAKSI KTP", lambda parsed: "🆔"),
+    ("rule",),
+    ("blank",),
+    template_field("📌", "NIK", "nik", code=True),
+    template_field("👤", "Nama", "nama"),
+    template_field("🎂", "TTL", "tempat_tanggal_lahir"),
+    template_field("⚧️", "Jenis Kelamin", "jenis_kelamin"),
+    template_field("🩸", "Golongan Darah", "golongan_darah"),
+    ("blank",),
+    ("section", "📍", "DOMISILI"),
+    template_field("🏠", "Alamat", "alamat"),
+    template_field("🏘️", "RT/RW", "rt_rw"),
+    template_field("🏙️", "Kel/Desa", "kel_desa"),
+    template_field("🌆", "Kecamatan", "kecamatan"),
+    ("blank",),
+    ("section", "ℹ️", "INFORMASI LAINNYA"),
+    template_field("🕌", "Agama", "agama"),
+    template_field("💍", "Status Perkawinan", "status_perkawinan"),
+    template_field("💼", "Pekerjaan", "pekerjaan"),
+    template_field("🌐", "Kewarganegaraan", "kewarganegaraan"),
+    template_field("⏱️", "Berlaku Hingga", "berlaku_hingga"),
+    template_field("📅", "Dikeluarkan di", "dikeluarkan_di"),
+    ("blank",),
+    ("rule",),
+    ("disclaimer", DISCLAIMER),
+])
+
+def index_by_name(items):
+    """Index nama -> entri pertama dengan nama tersebut (sama seperti next(...) berurutan)"""
+    index = {}
+    for item in items or []:
+        index.setdefault(item.get('nama'), item)
+    return index
+
+def kk_member_emoji(anggota, hubungan):
+    laki_laki = anggota.get('jenis_kelamin', '').lower() == "laki-laki"
+    if "kepala" in hubungan:
+        return "👨‍💼" if laki_laki else "👩‍💼"
+    if "suami" in hubungan:
+        return "👨"
+    if "istri" in hubungan:
+        return "👩"
+    if "anak" in hubungan:
+        return "👦" if laki_laki else "👧"
+    return "👤"
+
+def render_kk_members(parsed, md, plain):
+    anggota_keluarga = parsed.get('anggota_keluarga', [])
+    if not anggota_keluarga:
+        md.append("\n👥 *Anggota Keluarga:* Tidak terdeteksi\n")
+        plain.append("\nAnggota Keluarga: Tidak terdeteksi\n")
+        return
+
+    # Index nama -> status hubungan / orang tua dibangun sekali per KK
+    status_index = index_by_name(parsed.get('status_hubungan'))
+    orang_tua_index = index_by_name(parsed.get('orang_tua'))
+
+    md.append("\n👨‍👩‍👧‍👦 *ANGGOTA KELUARGA* 👨‍👩‍👧‍👦\n")
+    plain.append("\nANGGOTA KELUARGA\n")
+    total = len(anggota_keluarga)
+    for i, anggota in enumerate(anggota_keluarga, 1):
+        get = anggota.get
+        nama = get('nama')
+        status_hubungan = status_index.get(nama, {})
+        hubungan = status_hubungan.get('hubungan_keluarga', '').lower() if status_hubungan else ''
+        emoji = kk_member_emoji(anggota, hubungan)
+
+        nik = get('nik', NOT_DETECTED)
+        jenis_kelamin = get('jenis_kelamin', NOT_DETECTED)
+        ttl = f"{get('tempat_lahir', NOT_DETECTED)}, {get('tanggal_lahir', NOT_DETECTED)}"
+        agama = get('agama', NOT_DETECTED)
+        pendidikan = get('pendidikan', NOT_DETECTED)
+        pekerjaan = get('pekerjaan', NOT_DETECTED)
+        nama_text = get('nama', NOT_DETECTED)
+
+        md.append(
+            f"{emoji} *{i}. {nama_text}*\n"
+            f"   🆔 NIK: `{nik}`\n"
+            f"   ⚧️ Jenis Kelamin: {jenis_kelamin}\n"
+            f"   🎂 TTL: {ttl}\n"
+            f"   🕌 Agama: {agama}\n"
+            f"   🎓 Pendidikan: {pendidikan}\n"
+            f"   💼 Pekerjaan: {pekerjaan}\n"
+        )
+        plain.append(
+            f"{i}. {nama_text}\n"
+            f"   NIK: {nik}\n"
+            f"   Jenis Kelamin: {jenis_kelamin}\n"
+            f"   TTL: {ttl}\n"
+            f"   Agama: {agama}\n"
+            f"   Pendidikan: {pendidikan}\n"
+            f"   Pekerjaan: {pekerjaan}\n"
+        )
+
+        if status_hubungan:
+            pernikahan = status_hubungan.get('status_pernikahan', NOT_DETECTED)
+            hubungan_text = status_hubungan.get('hubungan_keluarga', NOT_DETECTED)
+            kewarganegaraan = status_hubungan.get('kewarganegaraan', NOT_DETECTED)
+            md.append(
+                f"   💍 Status Pernikahan: {pernikahan}\n"
+                f"   👨‍👩‍👧‍👦 Hubungan Keluarga: {hubungan_text}\n"
+                f"   🌐 Kewarganegaraan: {kewarganegaraan}\n"
+            )
+            plain.append(
+                f"   Status Pernikahan: {pernikahan}\n"
+                f"   Hubungan Keluarga: {hubungan_text}\n"
+                f"   Kewarganegaraan: {kewarganegaraan}\n"
+            )
+
+        orang_tua = orang_tua_index.get(nama)
+        if orang_tua:
+            ayah = orang_tua.get('ayah', NOT_DETECTED)
+            ibu = orang_tua.get('ibu', NOT_DETECTED)
+            md.append(
+                f"   👨‍👩 Orang Tua:\n"
+                f"   ┣ 👨 Ayah: {ayah}\n"
+                f"   ┗ 👩 Ibu: {ibu}\n"
+            )
+            plain.append(
+                f"   Orang Tua:\n"
+                f"   - Ayah: {ayah}\n"
+                f"   - Ibu: {ibu}\n"
+            )
+
+        if i < total:
+            md.append("\n")
+            plain.append("\n")
+
+def render_kk_issue_date(parsed, md, plain):
+    tanggal = parsed.get('tanggal_penerbitan')
+    if tanggal:
+        md.append(f"\n📅 *Tanggal Penerbitan:* {tanggal}\n")
+        plain.append(f"\nTanggal Penerbitan: {tanggal}\n")
+
+KK_RENDERER = DocumentRenderer([
+    ("title", "HASIL EKSTRAKSI KARTU KELUARGA", lambda parsed: "👨‍👩‍👧‍👦"),
+    ("rule",),
+    ("blank",),
+    template_field("📝", "Nomor KK", "nomor_kk", code=True),
+    template_field("🔢", "Kode Keluarga", "kode_keluarga"),
+    ("blank",),
+    ("section", "👑", "DATA KEPALA KELUARGA"),
+    template_field("👤", "Nama", "nama", source="kepala_keluarga"),
+    template_field("🆔", "NIK", "nik", code=True, source="kepala_keluarga"),
+    template_field("📍", "Alamat", "alamat", source="kepala_keluarga"),
+    template_field("🏘️", "RT/RW", "rt_rw", source="kepala_keluarga"),
+    template_field("🏙️", "Desa/Kelurahan", "desa_kelurahan", source="kepala_keluarga"),
+    template_field("🌆", "Kecamatan", "kecamatan", source="kepala_keluarga"),
+    template_field("🏢", "Kabupaten/Kota", "kabupaten_kota", source="kepala_keluarga"),
+    template_field("📮", "Kode Pos", "kode_pos", source="kepala_keluarga"),
+    template_field("🌏", "Provinsi", "provinsi", source="kepala_keluarga"),
+    ("custom", render_kk_members),
+    ("custom", render_kk_issue_date),
+    ("blank",),
+    ("rule",),
+    ("disclaimer", DISCLAIMER),
+])
+
+def ijazah_emoji(parsed):
+    jenis_ijazah = (parsed.get('jenis_ijazah') or '').upper()
+    if "SD" in jenis_ijazah or "SMP" in jenis_ijazah or "SMA" in jenis_ijazah or "SMK" in jenis_ijazah:
+        return "🏫"
+    return "🎓"
+
+IJAZAH_RENDERER = DocumentRenderer([
+    ("title", "HASIL EKSTRAKSI IJAZAH", ijazah_emoji),
+    ("rule",),
+    ("blank",),
+    template_field("🏆", "Jenis Ijazah", "jenis_ijazah"),
+    template_field("🏛️", "Kementerian Penerbit", "kementerian_penerbit"),
+    ("blank",),
+    ("section", "🏫", "INSTITUSI PENDIDIKAN"),
+    template_field("📍", "Nama Institusi", "nama_institusi"),
+    template_field("📊", "Akreditasi", "akreditasi"),
+    template_field("🎯", "Program Studi/Jurusan", "program_studi_jurusan"),
+    template_field("🏛️", "Institusi Asal", "institusi_asal"),
+    ("blank",),
+    ("section", "👤", "INFORMASI PEMILIK"),
+    template_field("📝", "Nama Peserta Didik", "nama_peserta_didik"),
+    template_field("🎂", "TTL", "tempat_tanggal_lahir"),
+    template_field("👨‍👩‍👧‍👦", "Nama Orang Tua", "nama_orang_tua"),
+    template_field("🔢", "Nomor Induk", "nomor_induk"),
+    ("blank",),
+    ("section", "📑", "INFORMASI DOKUMEN"),
+    template_field("📅", "Tanggal Penerbitan", "tanggal_penerbitan"),
+    template_field("✒️", "Pejabat Pengesah", "pejabat_pengesah"),
+    template_field("🆔", "Nomor Identitas Pejabat", "nomor_identitas_pejabat"),
+    template_field("📊", "Nomor Seri", "nomor_seri"),
+    ("blank",),
+    ("rule",),
+    ("disclaimer", "Gunakan informasi ini hanya untuk keperluan yang sah dan legal. Penyalahgunaan data dapat dikenakan sanksi hukum."),
+])
+
+def sim_emoji(parsed):
+    golongan_sim = parsed.get('golongan_sim', 'X') or 'X'
+    if "A" in golongan_sim:
+        return "🚗"  # Mobil penumpang
+    if "B" in golongan_sim:
+        return "🚐"  # Mobil barang/orang
+    if "C" in golongan_sim:
+        return "🏍️"  # Motor
+    if "D" in golongan_sim:
+        return "🚜"  # Traktor
+    return "🚘"
+
+SIM_RENDERER = DocumentRenderer([
+    ("title", "HASIL EKSTRAKSI SIM", sim_emoji),
+    ("rule",),
+    ("blank",),
+    template_field("🎫", "Nomor SIM", "nomor_sim", code=True),
+    template_field("🚦", "Golongan SIM", "golongan_sim"),
+    ("blank",),
+    ("section", "👤", "DATA PEMILIK"),
+    template_field("📝", "Nama", "nama"),
+    template_field("🎂", "TTL", "tempat_tanggal_lahir"),
+    template_field("⚧️", "Jenis Kelamin", "jenis_kelamin"),
+    template_field("🩸", "Golongan Darah", "golongan_darah"),
+    template_field("📏", "Tinggi", "tinggi"),
+    template_field("💼", "Pekerjaan", "pekerjaan"),
+    ("blank",),
+    ("section", "📍", "ALAMAT"),
+    template_field("🏠", "Alamat", "alamat"),
+    template_field("🏘️", "RT/RW", "rt_rw"),
+    template_field("🏙️", "Desa/Kelurahan", "desa_kelurahan", optional=True),
+    template_field("🌆", "Kecamatan", "kecamatan", optional=True),
+    template_field("🏢", "Kota", "kota", optional=True),
+    ("blank",),
+    ("section", "📄", "INFORMASI DOKUMEN"),
+    template_field("⏱️", "Berlaku Hingga", "berlaku_hingga"),
+    template_field("📍", "Dikeluarkan di", "dikeluarkan_di"),
+    template_field("🏛️", "Instansi Penerbit", "instansi_penerbit", optional=True),
+    ("blank",),
+    ("rule",),
+    ("disclaimer", DISCLAIMER),
+])
+
+# Fungsi untuk merender respons extractor (teks WhatsApp dan teks polos sekaligus)
+def render_extraction_response(doc, response):
+    """
+    Returns:
+        Tuple (teks WhatsApp, teks polos) untuk respons extractor
+    """
     try:
         if response["status"] == "error":
-            return f"❌ Error: {response['message']} (Code: {response['code']})"
-            
+            message = f"Error: {response['message']} (Code: {response['code']})"
+            return f"❌ {message}", message
+
         if response["status"] == "success":
             data = response["data"]
             analysis = data["analysis"]
             parsed = analysis["parsed"]
-            
-            if parsed["status"] == "not_ijazah":
-                return "❌ Dokumen yang dikirim bukan merupakan Ijazah pendidikan."
-                
+
+            if parsed["status"] == doc.not_status:
+                return f"❌ {doc.not_message}", doc.not_message
+
             if parsed["status"] == "success":
-                # Tentukan emoji berdasarkan jenis ijazah
-                jenis_ijazah = parsed.get('jenis_ijazah', '').upper()
-                ijazah_emoji = "🎓"
-                
-                if "SD" in jenis_ijazah:
-                    ijazah_emoji = "🏫"
-                elif "SMP" in jenis_ijazah:
-                    ijazah_emoji = "🏫"
-                elif "SMA" in jenis_ijazah or "SMK" in jenis_ijazah:
-                    ijazah_emoji = "🏫"
-                elif "D" in jenis_ijazah:
-                    ijazah_emoji = "🎓"
-                elif "S1" in jenis_ijazah:
-                    ijazah_emoji = "🎓"
-                elif "S2" in jenis_ijazah:
-                    ijazah_emoji = "🎓"
-                elif "S3" in jenis_ijazah:
-                    ijazah_emoji = "🎓"
-                
-                result = (
-                    f"{ijazah_emoji} *HASIL EKSTRAKSI IJAZAH* {ijazah_emoji}\n"
-                    "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-                    f"🏆 *Jenis Ijazah:* {parsed.get('jenis_ijazah', 'Tidak terdeteksi')}\n"
-                    f"🏛️ *Kementerian Penerbit:* {parsed.get('kementerian_penerbit', 'Tidak terdeteksi')}\n\n"
-                    "🏫 *INSTITUSI PENDIDIKAN* 🏫\n"
-                    f"📍 *Nama Institusi:* {parsed.get('nama_institusi', 'Tidak terdeteksi')}\n"
-                    f"📊 *Akreditasi:* {parsed.get('akreditasi', 'Tidak terdeteksi')}\n"
-                    f"🎯 *Program Studi/Jurusan:* {parsed.get('program_studi_jurusan', 'Tidak terdeteksi')}\n"
-                    f"🏛️ *Institusi Asal:* {parsed.get('institusi_asal', 'Tidak terdeteksi')}\n\n"
-                    "👤 *INFORMASI PEMILIK* 👤\n"
-                    f"📝 *Nama Peserta Didik:* {parsed.get('nama_peserta_didik', 'Tidak terdeteksi')}\n"
-                    f"🎂 *TTL:* {parsed.get('tempat_tanggal_lahir', 'Tidak terdeteksi')}\n"
-                    f"👨‍👩‍👧‍👦 *Nama Orang Tua:* {parsed.get('nama_orang_tua', 'Tidak terdeteksi')}\n"
-                    f"🔢 *Nomor Induk:* {parsed.get('nomor_induk', 'Tidak terdeteksi')}\n\n"
-                    "📑 *INFORMASI DOKUMEN* 📑\n"
-                    f"📅 *Tanggal Penerbitan:* {parsed.get('tanggal_penerbitan', 'Tidak terdeteksi')}\n"
-                    f"✒️ *Pejabat Pengesah:* {parsed.get('pejabat_pengesah', 'Tidak terdeteksi')}\n"
-                    f"🆔 *Nomor Identitas Pejabat:* {parsed.get('nomor_identitas_pejabat', 'Tidak terdeteksi')}\n"
-                    f"📊 *Nomor Seri:* {parsed.get('nomor_seri', 'Tidak terdeteksi')}\n\n"
-                    "━━━━━━━━━━━━━━━━━━━━━━\n"
-                    "⚠️ *PERHATIAN:* _Gunakan informasi ini hanya untuk keperluan yang sah dan legal. Penyalahgunaan data dapat dikenakan sanksi hukum._"
-                )
-                return result
-                
-        return "❌ Format respons tidak dikenal"
+                with metrics.timer("stage_seconds", stage="render"):
+                    return doc.render.render(parsed)
+
+        return "❌ Format respons tidak dikenal", "Format respons tidak dikenal"
+    except Exception as e:
+        log.error("Error formatting %s response: %s", doc.name, e)
+        log.error(traceback.format_exc())
+        message = f"Error saat memformat respons: {str(e)}"
+        return f"❌ {message}", message
+
+# Fungsi untuk memformat respons extractor untuk ditampilkan di WhatsApp
+def format_extraction_response(doc, response):
+    return render_extraction_response(doc, response)[0]
+
+# Registry jenis dokumen: endpoint, action, formatter dan field nama pemilik
+@dataclass(frozen=True)
+class DocumentType:
+    key: str
+    name: str
+    label: str
+    endpoints: tuple
+    action: str
+    render: object
+    owner_field: tuple
+    not_status: str
+    not_message: str
+    aliases: tuple = ()
+    description: str = ""
+    # Export tabel kustom: kolom dan fungsi rows(parsed) -> iterable tuple;
+    # jika kosong dipakai satu baris berisi field renderer
+    table_columns: tuple = ()
+    table_rows: object = None
+    # Nomor identitas yang diindeks di riwayat: fungsi identifiers(parsed) -> iterable
+    identifiers: object = None
+
+    def get_owner_name(self, parsed):
+        value = parsed
+        for field in self.owner_field:
+            if not isinstance(value, dict) or field not in value:
+                return None
+            value = value[field]
+        return value or None
+
+    def get_identifiers(self, parsed):
+        """Nomor identitas unik (string tidak kosong) dari hasil parsed"""
+        if self.identifiers is None:
+            return []
+        values = []
+        for value in self.identifiers(parsed):
+            if isinstance(value, str) and value.strip() and value.strip() not in values:
+                values.append(value.strip())
+        return values
+
+def get_endpoints(env_name, default_url):
+    # Beberapa deployment dapat dipisahkan koma, mis. KTP_API_URLS="url1,url2"
+    urls = [u.strip() for u in os.environ.get(env_name, "").split(",") if u.strip()]
+    return tuple(urls) if urls else (default_url,)
+
+DOCUMENT_TYPES = {}
+EXTRACTION_ROUTES = {}
+
+# Perintah yang dikenal untuk prefilter pesan masuk: perintah tanpa argumen
+# dicocokkan utuh, perintah berargumen (batch, admin) dari kata pertamanya
+COMMAND_WORDS = set()
+ARG_COMMAND_WORDS = {"batch"}
+
+# Format file export: ekstensi -> mimetype
+EXPORT_FORMATS = {
+    'txt': "text/plain",
+    'json': "application/json",
+    'csv': "text/csv",
+    'xlsx': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+def register_routes(command, doc_key):
+    COMMAND_WORDS.add(command)
+    EXTRACTION_ROUTES[command] = (doc_key, None)
+    for file_format in EXPORT_FORMATS:
+        EXTRACTION_ROUTES[f"{command}.{file_format}"] = (doc_key, file_format)
+        COMMAND_WORDS.add(f"{command}.{file_format}")
+
+def register_document_type(doc):
+    """Mendaftarkan jenis dokumen beserta perintah `x` dan `x.<format>` untuk setiap format export"""
+    DOCUMENT_TYPES[doc.key] = doc
+    for command in (doc.key,) + doc.aliases:
+        register_routes(command, doc.key)
+
+# Perintah `auto` dan `auto.<format>` untuk deteksi jenis dokumen otomatis
+register_routes("auto", "auto")
+
+# Kolom export tabel KK: satu baris per anggota keluarga
+KK_TABLE_COLUMNS = (
+    "Nomor KK", "Kepala Keluarga", "No", "Nama", "NIK", "Jenis Kelamin", "Tempat Lahir",
+    "Tanggal Lahir", "Agama", "Pendidikan", "Pekerjaan", "Status Pernikahan",
+    "Hubungan Keluarga", "Kewarganegaraan", "Ayah", "Ibu",
+)
+
+def kk_table_rows(parsed):
+    nomor_kk = parsed.get('nomor_kk', '')
+    kepala = (parsed.get('kepala_keluarga') or {}).get('nama', '')
+    status_index = index_by_name(parsed.get('status_hubungan'))
+    orang_tua_index = index_by_name(parsed.get('orang_tua'))
+    for i, anggota in enumerate(parsed.get('anggota_keluarga') or [], 1):
+        get = anggota.get
+        status = status_index.get(get('nama')) or {}
+        orang_tua = orang_tua_index.get(get('nama')) or {}
+        yield (
+            nomor_kk, kepala, i, get('nama', ''), get('nik', ''), get('jenis_kelamin', ''),
+            get('tempat_lahir', ''), get('tanggal_lahir', ''), get('agama', ''),
+            get('pendidikan', ''), get('pekerjaan', ''), status.get('status_pernikahan', ''),
+            status.get('hubungan_keluarga', ''), status.get('kewarganegaraan', ''),
+            orang_tua.get('ayah', ''), orang_tua.get('ibu', ''),
+        )
+
+def kk_identifiers(parsed):
+    # Nomor KK lalu NIK kepala keluarga dan setiap anggota
+    yield parsed.get('nomor_kk')
+    yield (parsed.get('kepala_keluarga') or {}).get('nik')
+    for anggota in parsed.get('anggota_keluarga') or []:
+        if isinstance(anggota, dict):
+            yield anggota.get('nik')
+
+register_document_type(DocumentType(
+    key="ktp",
+    name="KTP",
+    label="KTP",
+    endpoints=get_endpoints("KTP_API_URLS", KTP_API_URL),
+    action="process-ktp",
+    render=KTP_RENDERER,
+    owner_field=("nama",),
+    not_status="not_ktp",
+    not_message="Dokumen yang dikirim bukan merupakan KTP.",
+    aliases=("ptk",),
+    description="Ekstrak data dari gambar KTP (reply ke gambar KTP)",
+    identifiers=lambda parsed: (parsed.get('nik'),),
+))
+register_document_type(DocumentType(
+    key="kk",
+    name="KK",
+    label="Kartu Keluarga",
+    endpoints=get_endpoints("KK_API_URLS", KK_API_URL),
+    action="process-kk",
+    render=KK_RENDERER,
+    owner_field=("kepala_keluarga", "nama"),
+    not_status="not_kk",
+    not_message="Dokumen yang dikirim bukan merupakan Kartu Keluarga.",
+    description="Ekstrak data dari gambar Kartu Keluarga (reply ke gambar KK)",
+    table_columns=KK_TABLE_COLUMNS,
+    table_rows=kk_table_rows,
+    identifiers=kk_identifiers,
+))
+register_document_type(DocumentType(
+    key="ijazah",
+    name="Ijazah",
+    label="Ijazah",
+    endpoints=get_endpoints("IJAZAH_API_URLS", IJAZAH_API_URL),
+    action="process-ijazah",
+    render=IJAZAH_RENDERER,
+    owner_field=("nama_peserta_didik",),
+    not_status="not_ijazah",
+    not_message="Dokumen yang dikirim bukan merupakan Ijazah pendidikan.",
+    description="Ekstrak data dari gambar Ijazah (reply ke gambar Ijazah)",
+    identifiers=lambda parsed: (parsed.get('nomor_seri'), parsed.get('nomor_induk')),
+))
+register_document_type(DocumentType(
+    key="sim",
+    name="SIM",
+    label="SIM",
+    endpoints=get_endpoints("SIM_API_URLS", SIM_API_URL),
+    action="process-sim",
+    render=SIM_RENDERER,
+    owner_field=("nama",),
+    not_status="not_sim",
+    not_message="Dokumen yang dikirim bukan merupakan Surat Izin Mengemudi (SIM).",
+    description="Ekstrak data dari gambar SIM (reply ke gambar SIM)",
+    identifiers=lambda parsed: (parsed.get('nomor_sim'),),
+))
+
+# Deteksi otomatis jenis dokumen dengan menjalankan beberapa extractor sekaligus
+AUTO_DOC_TYPE = "auto"
+
+def get_parsed_status(response):
+    try:
+        return response["data"]["analysis"]["parsed"]["status"]
+    except (TypeError, KeyError):
+        return None
+
+def thumbnail_mean_color(image_message):
+    """Rata-rata warna RGB dari JPEGThumbnail (kecil, murah di-decode), atau None"""
+    if not PIL_AVAILABLE:
+        return None
+    try:
+        import io
+        from PIL import Image, ImageStat
+        thumbnail = image_message.imageMessage.JPEGThumbnail
+        if not thumbnail:
+            return None
+        with Image.open(io.BytesIO(thumbnail)) as img:
+            return ImageStat.Stat(img.convert("RGB")).mean
+    except Exception as e:
+        log.debug("Could not read thumbnail colour: %s", e)
+        return None
+
+def preclassify_document(image_message, exclude=()):
+    """
+    Pre-classifier lokal yang murah untuk mempersempit kandidat jenis dokumen.
+
+    Memakai rasio sisi dari width/height di imageMessage dan warna rata-rata
+    thumbnail (KTP berlatar biru, kartu KTP/SIM berukuran ID-1 ~1.59:1,
+    ijazah umumnya portrait). Hanya heuristik: hasilnya dipakai untuk urutan
+    percobaan, dan kandidat lain tetap dicoba jika kandidat utama gagal. Tanpa
+    sinyal sama sekali, kandidat utama tetap dibatasi AUTO_MAX_CANDIDATES
+    (urutan registry) agar tidak semua extractor dipanggil sekaligus.
+
+    Returns:
+        Tuple (kandidat utama, kandidat sisanya), masing-masing list DocumentType
+    """
+    scores = {key: 0.0 for key in DOCUMENT_TYPES if key not in exclude}
+    try:
+        width = image_message.imageMessage.width
+        height = image_message.imageMessage.height
+    except Exception:
+        width = height = 0
+
+    if width and height:
+        ratio = max(width, height) / min(width, height)
+        if height > width * 1.15:
+            for key, bonus in (("ijazah", 2.0), ("kk", 0.5)):
+                if key in scores:
+                    scores[key] += bonus
+        elif 1.45 <= ratio <= 1.75:
+            for key, bonus in (("ktp", 1.0), ("sim", 1.0), ("kk", 0.5)):
+                if key in scores:
+                    scores[key] += bonus
+
+    color = thumbnail_mean_color(image_message)
+    if color:
+        red, green, blue = color[:3]
+        if blue > red + 15 and blue >= green:
+            for key, bonus in (("ktp", 1.5), ("sim", 0.5)):
+                if key in scores:
+                    scores[key] += bonus
+
+    ordered = sorted(scores, key=lambda key: scores[key], reverse=True)
+    docs = [DOCUMENT_TYPES[key] for key in ordered]
+    return docs[:AUTO_MAX_CANDIDATES], docs[AUTO_MAX_CANDIDATES:]
+
+async def race_document_types(candidates, media_bytes, mime_type, file_name):
+    """
+    Mengirim gambar ke beberapa extractor sekaligus. Respons `success` pertama
+    menang dan request lain dibatalkan.
+
+    Returns:
+        Tuple (DocumentType, response) pemenang, atau (None, None)
+    """
+    # Kandidat selain yang pertama bersifat spekulatif dan mengalah di antrean rate limit
+    priority = extractor_priority_var.get()
+    tasks = {
+        asyncio.create_task(with_extractor_priority(
+            priority if index == 0 else max(priority, PRIORITY_SPECULATIVE),
+            query_extractor_cached(doc, media_bytes, mime_type, file_name),
+        )): doc
+        for index, doc in enumerate(candidates)
+    }
+    try:
+        while tasks:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                doc = tasks.pop(task)
+                if task.cancelled() or task.exception() is not None:
+                    continue
+                response = task.result()
+                if get_parsed_status(response) == "success":
+                    log.info("Auto-detect: %s extractor won the race", doc.name)
+                    return doc, response
+        return None, None
+    finally:
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+async def detect_document_type(client, image_message, exclude=()):
+    """
+    Mendeteksi jenis dokumen dari gambar.
+
+    Hasil cache dicek lebih dulu untuk semua kandidat, lalu gambar diunduh
+    sekali dan kandidat utama dari pre-classifier dijalankan bersamaan; jika
+    tidak ada yang cocok, kandidat sisanya dicoba.
+
+    Returns:
+        Tuple (DocumentType atau None, response atau None, berhasil_download,
+        low_resolution)
+    """
+    primary, rest = preclassify_document(image_message, exclude)
+    log.info("Auto-detect candidates: %s then %s", [d.key for d in primary], [d.key for d in rest])
+
+    for doc in primary + rest:
+        cached = await lookup_cached_extraction(image_message, doc.key)
+        if get_parsed_status(cached) == "success":
+            return doc, cached, True, False
+
+    media = await download_media_coalesced(client, image_message, "image")
+    if media is None:
+        return None, None, False, False
+
+    for candidates in (primary, rest):
+        if candidates:
+            doc, response = await race_document_types(candidates, media.data, media.mime_type, media.file_name)
+            if doc is not None:
+                return doc, response, True, media.low_resolution
+    return None, None, True, media.low_resolution
+
+async def handle_auto_extraction(client, chat, has_quoted, quoted_message, quoted_type, file_format, text):
+    if not has_quoted or quoted_type != "image":
+        await client.send_message(chat, f"❌ Silakan reply pesan gambar dokumen dengan perintah '{text}'")
+        return
+
+    try:
+        await client.send_message(chat, "🔎 Mendeteksi jenis dokumen...")
+        doc, response, downloaded, low_resolution = await detect_document_type(client, quoted_message)
+        if not downloaded:
+            await client.send_message(chat, "❌ Gagal mengunduh gambar")
+            return
+        if low_resolution:
+            await client.send_message(chat, LOW_RESOLUTION_NOTICE)
+        if doc is None:
+            labels = ", ".join(d.label for d in DOCUMENT_TYPES.values())
+            await client.send_message(chat, f"❌ Jenis dokumen tidak dapat dikenali (dicoba: {labels}).")
+            return
+
+        record_extraction_history(chat, doc, response, quoted_message)
+        markdown, plain_text = render_extraction_response(doc, response)
+        await client.send_message(chat, f"✅ Terdeteksi sebagai {doc.label}\n\n{markdown}")
+        if file_format:
+            await create_and_send_extraction_file(client, chat, response, doc.key, file_format, plain_text)
+    except Exception as e:
+        log.error("Error in auto extraction: %s", e)
+        log.error(traceback.format_exc())
+        await client.send_message(chat, f"❌ Error saat mendeteksi dokumen: {str(e)}")
+
+async def handle_document_extraction(client, chat, has_quoted, quoted_message, quoted_type, doc_type, file_format, text):
+    """
+    Menangani ekstraksi dokumen dengan opsi format file
+
+    Args:
+        client: NewAClient instance
+        chat: Chat ID
+        has_quoted: Boolean apakah pesan memiliki quote
+        quoted_message: Message yang dikutip
+        quoted_type: Tipe pesan yang dikutip
+        doc_type: Tipe dokumen (key di DOCUMENT_TYPES, mis. ktp, kk, ijazah, sim)
+        file_format: Format file untuk hasil (txt, json, csv, xlsx, atau None untuk tanpa file)
+        text: Teks pesan asli
+    """
+    doc = DOCUMENT_TYPES.get(doc_type.lower())
+    if doc is None:
+        await client.send_message(chat, f"❌ Tipe dokumen '{doc_type}' tidak dikenal")
+        return
+
+    if not has_quoted or quoted_type != "image":
+        await client.send_message(chat, f"❌ Silakan reply pesan gambar {doc.label} dengan perintah '{text}'")
+        return
+
+    started = time.monotonic()
+    try:
+        # Cek cache hasil ekstraksi sebelum mengunduh ulang gambar
+        response = await lookup_cached_extraction(quoted_message, doc.key)
+        if response is None:
+            await client.send_message(chat, f"📷 Mengunduh gambar {doc.label}...")
+
+            # Download gambar
+            download_started = time.monotonic()
+            media = await download_media_coalesced(client, quoted_message, quoted_type)
+            log.info("%s download stage took %.0f ms", doc.name, (time.monotonic() - download_started) * 1000)
+
+            if media is None:
+                await client.send_message(chat, "❌ Gagal mengunduh gambar")
+                return
+            if media.low_resolution:
+                await client.send_message(chat, LOW_RESOLUTION_NOTICE)
+
+            # Kirim ke API ekstraksi sesuai jenis dokumen
+            await client.send_message(chat, f"🔍 Mengekstrak data {doc.label}...")
+
+            response = await query_extractor_cached(doc, media.data, media.mime_type, media.file_name)
+
+        # Jika dokumen ternyata bukan jenis yang diminta, coba deteksi jenis lainnya
+        if AUTO_FALLBACK_ENABLED and get_parsed_status(response) == doc.not_status:
+            await client.send_message(chat, f"🔄 Dokumen bukan {doc.label}, mencoba mendeteksi jenis lainnya...")
+            detected, detected_response, _, _ = await detect_document_type(client, quoted_message, exclude=(doc.key,))
+            if detected is not None:
+                doc, response = detected, detected_response
+                await client.send_message(chat, f"✅ Terdeteksi sebagai {doc.label}")
+
+        record_extraction_history(chat, doc, response, quoted_message)
+
+        # Kirim hasil ekstraksi dalam format chatting (teks polos untuk file dirender sekaligus)
+        markdown, plain_text = render_extraction_response(doc, response)
+        await client.send_message(chat, markdown)
+
+        # Jika diminta format file, buat dan kirim filenya
+        if file_format:
+            await create_and_send_extraction_file(client, chat, response, doc.key, file_format, plain_text)
+
+    except Exception as e:
+        log.error("Error in %s extraction: %s", doc.name, e)
+        log.error(traceback.format_exc())
+        await client.send_message(chat, f"❌ Error saat memproses {doc.label}: {str(e)}")
+    finally:
+        log.info("%s extraction job finished in %.0f ms", doc.name, (time.monotonic() - started) * 1000)
+
+# Fungsi untuk membuat versi teks polos (tanpa markdown & emoji) dari hasil ekstraksi
+def format_plain_text(doc, data):
+    return render_extraction_response(doc, data)[1]
+
+# Export file hasil ekstraksi: konten dibangun di memori dan dikirim langsung sebagai bytes
+INVALID_FILENAME_CHARS = re.compile(r'[\\/*?:"<>|]')
+# Karakter kontrol yang tidak valid di XML (XLSX)
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def get_parsed_data(response):
+    """Bagian parsed dari respons extractor, atau None jika tidak ada"""
+    try:
+        parsed = response["data"]["analysis"]["parsed"]
+    except (TypeError, KeyError):
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+def get_export_table(doc):
+    """Kolom dan fungsi rows(parsed) untuk export CSV/XLSX"""
+    if doc.table_rows is not None:
+        return doc.table_columns, doc.table_rows
+
+    # Default: satu baris berisi field yang ditampilkan renderer
+    fields = doc.render.fields
+
+    def rows(parsed):
+        values = []
+        for _, key, source in fields:
+            data = (parsed.get(source) or {}) if source else parsed
+            values.append(data.get(key, ''))
+        yield tuple(values)
+    return tuple(label for label, _, _ in fields), rows
+
+def iter_table_rows(doc, responses, batch=False):
+    """
+    Menghasilkan baris tabel (header lebih dulu) satu per satu dari respons extractor.
+
+    Mode batch menambahkan kolom nomor gambar dan status, dan tetap menulis satu
+    baris untuk gambar yang gagal agar urutan hasil tidak hilang.
+    """
+    columns, rows = get_export_table(doc)
+    yield ("Gambar", "Status") + columns if batch else columns
+    empty = ("",) * len(columns)
+    for index, response in enumerate(responses, 1):
+        parsed = get_parsed_data(response)
+        if parsed is not None and parsed.get("status") == "success":
+            for row in rows(parsed):
+                yield (index, "success") + row if batch else row
+        elif batch:
+            if response is None:
+                status = "Gagal mengunduh gambar"
+            elif parsed is not None:
+                status = parsed.get("status", "")
+            else:
+                status = response.get("message", "error") if isinstance(response, dict) else "error"
+            yield (index, status) + empty
+
+def write_json(obj):
+    buffer = io.BytesIO()
+    for chunk in json.JSONEncoder(ensure_ascii=False, indent=2).iterencode(obj):
+        buffer.write(chunk.encode("utf-8"))
+    return buffer.getvalue()
+
+def write_csv(rows):
+    buffer = io.BytesIO()
+    # BOM UTF-8 agar Excel membaca karakter non-ASCII dengan benar
+    text = io.TextIOWrapper(buffer, encoding="utf-8-sig", newline="")
+    csv.writer(text).writerows(rows)
+    text.flush()
+    text.detach()
+    return buffer.getvalue()
+
+XLSX_STATIC_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Hasil" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+def xlsx_cell(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return f'<c><v>{value}</v></c>'
+    text = xml_escape(INVALID_XML_CHARS.sub("", "" if value is None else str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+def write_xlsx(rows):
+    """Menulis workbook satu sheet; baris di-stream langsung ke entri zip terkompresi"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as workbook:
+        for name, content in XLSX_STATIC_PARTS.items():
+            workbook.writestr(name, content)
+        with workbook.open("xl/worksheets/sheet1.xml", "w") as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            for row in rows:
+                sheet.write(("<row>" + "".join(map(xlsx_cell, row)) + "</row>").encode("utf-8"))
+            sheet.write(b'</sheetData></worksheet>')
+    return buffer.getvalue()
+
+def write_table(format_type, rows):
+    return write_csv(rows) if format_type == 'csv' else write_xlsx(rows)
+
+async def send_export_file(client, chat, content, file_name, format_type, caption):
+    log.info("Sending %s file %s (%s bytes)", format_type.upper(), file_name, len(content))
+    await client.send_document(chat, content, caption, filename=file_name, mimetype=EXPORT_FORMATS[format_type])
+
+# Fungsi utilitas untuk membuat file hasil ekstraksi dan mengirimkannya (dengan nama sesuai pemilik)
+async def create_and_send_extraction_file(client, chat, data, doc_type, format_type, plain_text=None):
+    """
+    Membuat file hasil ekstraksi (txt, json, csv atau xlsx) di memori dan mengirimkannya
+    dengan nama file yang menyertakan nama pemilik dokumen
+
+    Args:
+        client: NewAClient instance
+        chat: Chat ID tujuan
+        data: Data hasil ekstraksi yang akan disimpan ke file
+        doc_type: Jenis dokumen (ktp, kk, ijazah, sim)
+        format_type: Format file yang diinginkan (txt, json, csv atau xlsx)
+        plain_text: Teks polos yang sudah dirender (opsional, dirender ulang jika None)
+    """
+    try:
+        # Siapkan timestamp
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+        # Default nama jika tidak ditemukan
+        owner_name = "Untitled"
+
+        doc = DOCUMENT_TYPES.get(doc_type.lower())
+        if doc is None:
+            await client.send_message(chat, f"❌ Jenis dokumen '{doc_type}' tidak dikenal.")
+            return False
+
+        # Dapatkan nama pemilik dokumen sesuai field yang terdaftar di registry
+        parsed_data = get_parsed_data(data)
+        success = parsed_data is not None and parsed_data.get("status") == "success"
+        if success:
+            name = doc.get_owner_name(parsed_data)
+            if isinstance(name, str):
+                owner_name = name
+                log.info("Extracted %s owner name: %s", doc.name, owner_name)
+
+        # Bersihkan nama untuk digunakan dalam nama file (hapus karakter tidak valid)
+        clean_name = INVALID_FILENAME_CHARS.sub("", owner_name).strip().replace(' ', '_')
+        log.debug("Cleaned name for filename: %s", clean_name)
+
+        # Jika nama kosong setelah dibersihkan, gunakan "Untitled"
+        if not clean_name:
+            clean_name = "Untitled"
+
+        format_type = format_type.lower()
+        if format_type == 'json':
+            # Ambil hanya bagian parsed dari data untuk file JSON
+            if parsed_data is None:
+                await client.send_message(chat, "❌ Format data tidak valid untuk konversi ke JSON.")
+                return False
+            content = write_json(parsed_data)
+
+        elif format_type == 'txt':
+            clean_content = plain_text if plain_text is not None else format_plain_text(doc, data)
+
+            # Tambahkan nama pemilik dan info dokumen di header
+            header = (
+                f"Dokumen: {doc_type.upper()}\n"
+                f"Nama: {owner_name}\n"
+                f"Diekstrak pada: {datetime.now().strftime('%d-%m-%Y %H:%M:%S')}\n"
+                + "=" * 40 + "\n\n"
+            )
+            content = (header + clean_content).encode("utf-8")
+
+        elif format_type in ('csv', 'xlsx'):
+            if not success:
+                await client.send_message(chat, f"❌ Tidak ada data {doc.label} yang dapat dikonversi ke {format_type.upper()}.")
+                return False
+            content = write_table(format_type, iter_table_rows(doc, (data,)))
+
+        else:
+            await client.send_message(chat, f"❌ Format file '{format_type}' tidak didukung. Gunakan {', '.join(EXPORT_FORMATS)}.")
+            return False
+
+        label = format_type.upper()
+        await send_export_file(client, chat, content, f"{doc_type}_{clean_name}_{timestamp}.{format_type}", format_type,
+                               f"Hasil ekstraksi {doc_type.upper()} - {owner_name} ({label})")
+
+        # Beri tahu pengguna
+        await client.send_message(chat, f"✅ File {label} hasil ekstraksi {doc_type.upper()} untuk {owner_name} telah dikirim.")
+        return True
+
+    except Exception as e:
+        log.error("Error creating extraction file: %s", e)
+        log.error(traceback.format_exc())
+        await client.send_message(chat, f"❌ Error saat membuat file: {str(e)}")
+        return False
+
+async def on_connected(_: "NewAClient", __: "ConnectedEv"):
+    log.info("⚡ WhatsApp terhubung")
+    startup_timer.report_connected()
+
+async def on_message(client: "NewAClient", message: "MessageEv"):
+    await handle_message(client, message)
+
+def create_client_factory():
+    """Import neonize, membuat ClientFactory dan memasang handler event (dipanggil saat startup)"""
+    global client_factory
+    from neonize.aioze.client import ClientFactory, NewAClient
+    from neonize.events import ConnectedEv, MessageEv
+
+    instrument_client_sends(NewAClient)
+    client_factory = ClientFactory(DB_PATH)
+    client_factory.event(ConnectedEv)(on_connected)
+    client_factory.event(MessageEv)(on_message)
+    return client_factory
+
+# Scheduler job ekstraksi dengan antrean terbatas dan round-robin per chat/pengirim
+class ExtractionScheduler:
+    """
+    Antrean job ekstraksi yang dikerjakan oleh sejumlah worker tetap.
+
+    Job dikelompokkan per chat lalu per pengirim. Worker mengambil job secara
+    round-robin dua tingkat (antar chat, lalu antar pengirim dalam chat),
+    sehingga satu grup yang mengirim banyak perintah tidak menahan pengguna
+    lain. Jika antrean penuh, submit() mengembalikan None (backpressure).
+    """
+
+    def __init__(self, workers, max_queue):
+        self.num_workers = workers
+        self.max_queue = max_queue
+        self._chats = OrderedDict()  # chat_key -> OrderedDict(sender_key -> deque(job))
+        self._queued = 0
+        self._cond = None
+        self._workers = []
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    @property
+    def queued(self):
+        return self._queued
+
+    @property
+    def idle_workers(self):
+        return max(0, len(self._workers) - self.in_flight)
+
+    def start(self):
+        if self._workers:
+            return
+        self._cond = asyncio.Condition()
+        for i in range(self.num_workers):
+            self._workers.append(asyncio.create_task(self._worker(i)))
+        log.info("Extraction scheduler started with %s workers (queue max %s)", self.num_workers, self.max_queue)
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, chat_key, sender_key, job_factory):
+        """
+        Memasukkan job ke antrean.
+
+        Args:
+            chat_key: Key chat untuk fairness tingkat pertama
+            sender_key: Key pengirim untuk fairness di dalam chat
+            job_factory: Callable tanpa argumen yang mengembalikan coroutine
+
+        Returns:
+            Jumlah job yang harus menunggu worker sebelum job ini (0 berarti
+            langsung diproses), atau None jika antrean penuh
+        """
+        self.start()
+        if self._queued >= self.max_queue:
+            self.rejected += 1
+            return None
+        senders = self._chats.setdefault(chat_key, OrderedDict())
+        senders.setdefault(sender_key, deque()).append(job_factory)
+        self._queued += 1
+        waiting = max(0, self._queued - self.idle_workers)
+        async with self._cond:
+            self._cond.notify()
+        return waiting
+
+    def _pop_next(self):
+        chat_key, senders = self._chats.popitem(last=False)
+        sender_key, jobs = senders.popitem(last=False)
+        job_factory = jobs.popleft()
+        if jobs:
+            senders[sender_key] = jobs
+        if senders:
+            self._chats[chat_key] = senders
+        self._queued -= 1
+        return job_factory
+
+    async def _worker(self, index):
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self._queued > 0)
+                job_factory = self._pop_next()
+            self.in_flight += 1
+            started = time.monotonic()
+            try:
+                await job_factory()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error("Error in extraction worker %s: %s", index, e)
+                log.error(traceback.format_exc())
+            finally:
+                self.in_flight -= 1
+                self.completed += 1
+                metrics.observe("stage_seconds", time.monotonic() - started, stage="job")
+
+extraction_scheduler = ExtractionScheduler(JOB_WORKERS, JOB_QUEUE_MAX)
+
+def cache_hit_ratio():
+    hits = metrics.counter_value("cache_requests_total", result="hit")
+    total = hits + metrics.counter_value("cache_requests_total", result="miss")
+    return hits / total if total else 0.0
+
+metrics.gauge("queue_depth", "Extraction jobs waiting for a worker", lambda: extraction_scheduler.queued)
+metrics.gauge("jobs_in_flight", "Extraction jobs currently running", lambda: extraction_scheduler.in_flight)
+metrics.gauge("jobs_completed_total", "Extraction jobs finished", lambda: extraction_scheduler.completed, kind="counter")
+metrics.gauge("jobs_rejected_total", "Extraction jobs rejected because the queue was full",
+              lambda: extraction_scheduler.rejected, kind="counter")
+metrics.gauge("cache_hit_ratio", "Extraction cache hit ratio since startup", cache_hit_ratio)
+metrics.gauge("media_cache_bytes", "Bytes of downloaded media held in memory by the media cache",
+              lambda: media_cache.total_bytes if media_cache is not None else 0)
+metrics.gauge("extractor_waiting", "Extractor requests waiting for a rate-limit slot",
+              lambda: sum(limiter.waiting for limiter in endpoint_limiters.values()))
+metrics.gauge("history_writes_total", "Extraction results written to the history store",
+              lambda: extraction_history.written if extraction_history is not None else 0, kind="counter")
+metrics.gauge("history_pending", "Extraction results waiting for the next history batch write",
+              lambda: extraction_history.pending if extraction_history is not None else 0)
+metrics.gauge("startup_seconds", "Seconds from process start to the first WhatsApp connection",
+              lambda: startup_timer.connected_after or 0.0)
+
+def jid_key(jid):
+    return f"{jid.User}@{jid.Server}"
+
+async def enqueue_extraction_command(client, message, chat, text, process=None):
+    if process is None:
+        process = process_extraction_command
+    sender = message.Info.MessageSource.Sender
+    # ID pesan WhatsApp dipakai sebagai ID korelasi untuk semua log job ini
+    job_id = message.Info.ID or os.urandom(6).hex()
+    waiting = await extraction_scheduler.submit(
+        jid_key(chat),
+        jid_key(sender),
+        lambda: with_job_id(job_id, process(client, message, chat, text)),
+    )
+    if waiting is None:
+        log.warning("Extraction queue full (%s jobs), rejecting '%s'", extraction_scheduler.queued, text)
+        await client.send_message(chat, "⚠️ Bot sedang sibuk memproses banyak dokumen. Silakan coba lagi beberapa saat lagi.")
+    elif waiting > 0:
+        await client.send_message(chat, f"⏳ Permintaan masuk antrean (posisi {waiting}). Mohon tunggu...")
+
+async def process_extraction_command(client, message, chat, text):
+    """
+    Menjalankan perintah ekstraksi dokumen; dipanggil oleh worker scheduler
+    """
+    try:
+        doc_type, file_format = EXTRACTION_ROUTES[text.strip().lower()]
+        
+        # Get quoted message if any
+        has_quoted, quoted_message, quoted_type = await get_quoted_message_info(message)
+        
+        if doc_type == AUTO_DOC_TYPE:
+            await handle_auto_extraction(client, chat, has_quoted, quoted_message, quoted_type,
+                                         file_format, text.strip())
+            return
+        
+        await handle_document_extraction(client, chat, has_quoted, quoted_message, quoted_type,
+                                         doc_type, file_format, text.strip())
+    except Exception as e:
+        log.error("Error in extraction command: %s", e)
+        log.error(traceback.format_exc())
+
+# Gambar terbaru per chat, dipakai oleh perintah batch
+recent_images = OrderedDict()  # chat_key -> deque(Message)
+
+def remember_recent_image(chat, message):
+    key = jid_key(chat)
+    images = recent_images.pop(key, None)
+    if images is None:
+        images = deque(maxlen=BATCH_MAX_IMAGES)
+    images.append(message.Message)
+    recent_images[key] = images
+    while len(recent_images) > RECENT_IMAGE_CHATS:
+        recent_images.popitem(last=False)
+
+def parse_batch_command(text):
+    """
+    Parse perintah `batch <jenis>[.txt|.json|.csv|.xlsx] [N]`.
+
+    Returns:
+        Tuple (doc_type, file_format, count) atau None jika bukan perintah batch
+    """
+    parts = text.strip().lower().split()
+    if len(parts) not in (2, 3) or parts[0] != "batch":
+        return None
+    route = EXTRACTION_ROUTES.get(parts[1])
+    if route is None:
+        return None
+    count = BATCH_MAX_IMAGES
+    if len(parts) == 3:
+        if not parts[2].isdigit():
+            return None
+        count = max(1, min(BATCH_MAX_IMAGES, int(parts[2])))
+    doc_type, file_format = route
+    if doc_type not in DOCUMENT_TYPES:
+        return None
+    return doc_type, file_format, count
+
+async def extract_document_image(client, doc, image_message):
+    """
+    Cache lookup, download dan ekstraksi satu gambar.
+
+    Returns:
+        Tuple (response atau None jika download gagal, low_resolution)
+    """
+    response = await lookup_cached_extraction(image_message, doc.key)
+    if response is not None:
+        return response, False
+    media = await download_media_coalesced(client, image_message, "image")
+    if media is None:
+        return None, False
+    response = await query_extractor_cached(doc, media.data, media.mime_type, media.file_name)
+    return response, media.low_resolution
+
+# Dibagi semua job batch yang berjalan: total gambar batch yang diproses bersamaan
+# tetap BATCH_CONCURRENCY berapa pun jumlah worker scheduler
+batch_semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+async def handle_batch_extraction(client, chat, doc_type, file_format, count):
+    """
+    Mengekstrak N gambar terakhir di chat secara paralel (dibatasi
+    BATCH_CONCURRENCY untuk semua batch sekaligus) dan mengirim hasil setiap
+    gambar begitu selesai.
+    Jika file_format diisi, hasil digabung menjadi satu file di akhir.
+    """
+    doc = DOCUMENT_TYPES[doc_type]
+    images = list(recent_images.get(jid_key(chat), ()))[-count:]
+    if not images:
+        await client.send_message(chat, f"❌ Tidak ada gambar terbaru di chat ini. Kirim gambar {doc.label} lalu ketik 'batch {doc.key}'.")
+        return
+
+    total = len(images)
+    await client.send_message(chat, f"📚 Memproses {total} gambar {doc.label}...")
+    started = time.monotonic()
+
+    async def run(index, image_message):
+        async with batch_semaphore:
+            try:
+                return (index,) + await extract_document_image(client, doc, image_message)
+            except Exception as e:
+                log.error("Error in batch %s extraction for image %s: %s", doc.name, index, e)
+                log.error(traceback.format_exc())
+                return index, {"status": "error", "message": f"Error: {str(e)}", "code": 500}, False
+
+    results = [None] * total
+    plain_texts = [None] * total
+    for next_done in asyncio.as_completed([run(i, img) for i, img in enumerate(images, 1)]):
+        index, response, low_resolution = await next_done
+        results[index - 1] = response
+        if response is None:
+            await client.send_message(chat, f"📄 Gambar {index}/{total}: ❌ Gagal mengunduh gambar")
+        else:
+            record_extraction_history(chat, doc, response, images[index - 1])
+            markdown, plain_texts[index - 1] = render_extraction_response(doc, response)
+            notice = f"{LOW_RESOLUTION_NOTICE}\n\n" if low_resolution else ""
+            await client.send_message(chat, f"📄 Gambar {index}/{total}\n\n{notice}{markdown}")
+
+    log.info("Batch %s extraction of %s images finished in %.0f ms", doc.name, total, (time.monotonic() - started) * 1000)
+
+    if file_format:
+        await create_and_send_batch_file(client, chat, doc, results, file_format, plain_texts)
+
+async def create_and_send_batch_file(client, chat, doc, results, format_type, plain_texts):
+    """Menggabungkan hasil batch menjadi satu file (txt, json, csv atau xlsx) dan mengirimkannya"""
+    try:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        total = len(results)
+
+        if format_type == 'json':
+            content = write_json([get_parsed_data(response) for response in results])
+        elif format_type in ('csv', 'xlsx'):
+            content = write_table(format_type, iter_table_rows(doc, results, batch=True))
+        else:
+            buffer = io.BytesIO()
+            buffer.write((
+                f"Dokumen: {doc.name} (batch {total} gambar)\n"
+                f"Diekstrak pada: {datetime.now().strftime('%d-%m-%Y %H:%M:%S')}\n"
+                + "=" * 40 + "\n\n"
+            ).encode("utf-8"))
+            for index, body in enumerate(plain_texts, 1):
+                if index > 1:
+                    buffer.write(("\n\n" + "-" * 40 + "\n\n").encode("utf-8"))
+                if body is None:
+                    body = "Gagal mengunduh gambar"
+                buffer.write(f"[{index}/{total}]\n{body}".encode("utf-8"))
+            content = buffer.getvalue()
+
+        caption = f"Hasil ekstraksi batch {doc.name} - {total} gambar ({format_type.upper()})"
+        await send_export_file(client, chat, content, f"{doc.key}_batch_{timestamp}.{format_type}", format_type, caption)
+        return True
     except Exception as e:
-        log.error(f"Error formatting Ijazah response: {e}")
+        log.error("Error creating batch extraction file: %s", e)
         log.error(traceback.format_exc())
-        return f"❌ Error saat memformat respons: {str(e)}"
-        
-# Fungsi untuk mengirim gambar SIM ke API Extractor
-async def query_sim_extractor(media_bytes, mime_type, file_name):
+        await client.send_message(chat, f"❌ Error saat membuat file: {str(e)}")
+        return False
+
+async def process_batch_command(client, message, chat, text):
     try:
-        log.info(f"Sending image to SIM Extractor API, type: {mime_type}, size: {len(media_bytes)} bytes")
-        
-        # Encode media as base64
-        media_b64 = base64.b64encode(media_bytes).decode('utf-8')
-        
-        # Prepare payload
-        payload = {
-            "action": "process-sim",
-            "fileData": media_b64,
-            "fileName": file_name,
-            "mimeType": mime_type
-        }
-        
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        log.info("Sending request to SIM Extractor API...")
-        log.info(f"API URL: {SIM_API_URL}")
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(SIM_API_URL, json=payload, headers=headers) as response:
-                response_text = await response.text()
-                
-                # Log the raw response for debugging
-                log.info(f"Raw response status: {response.status}")
-                log.info(f"Raw response headers: {response.headers}")
-                # Log first 500 chars of response text to avoid flooding logs
-                log.info(f"Raw response text (first 500 chars): {response_text[:500]}")
-                
-                if response.status == 200:
-                    try:
-                        response_json = json.loads(response_text)
-                        log.info("Successfully got response from SIM Extractor API")
-                        return response_json
-                    except json.JSONDecodeError as e:
-                        log.error(f"Error parsing JSON response: {e}")
-                        log.error(f"Response text: {response_text}")
-                        return {"status": "error", "message": f"Error parsing JSON response: {str(e)}", "code": 500}
-                else:
-                    log.error(f"SIM Extractor API error: {response_text}")
-                    return {"status": "error", "message": f"Error dari SIM Extractor API: Status {response.status}.", "code": response.status}
+        doc_type, file_format, count = parse_batch_command(text)
+        await with_extractor_priority(PRIORITY_BATCH, handle_batch_extraction(client, chat, doc_type, file_format, count))
     except Exception as e:
-        log.error(f"Exception in query_sim_extractor: {e}")
+        log.error("Error in batch command: %s", e)
         log.error(traceback.format_exc())
-        return {"status": "error", "message": f"Error: {str(e)}", "code": 500}
 
-async def handle_document_extraction(client, chat, has_quoted, quoted_message, quoted_type, doc_type, file_format, text):
-    """
-    Menangani ekstraksi dokumen dengan opsi format file
-    
-    Args:
-        client: NewAClient instance
-        chat: Chat ID
-        has_quoted: Boolean apakah pesan memiliki quote
-        quoted_message: Message yang dikutip
-        quoted_type: Tipe pesan yang dikutip
-        doc_type: Tipe dokumen (ktp, kk, ijazah, sim)
-        file_format: Format file untuk hasil (txt, json, atau None untuk tanpa file)
-        text: Teks pesan asli
-    """
-    if not has_quoted or quoted_type != "image":
-        await client.send_message(chat, f"❌ Silakan reply pesan gambar {doc_type.upper()} dengan perintah '{text}'")
-        return
-        
-    await client.send_message(chat, f"📷 Mengunduh gambar {doc_type.upper()}...")
-    
-    try:
-        # Download gambar
-        media_bytes, mime_type, temp_path = await download_media(client, quoted_message, quoted_type)
+async def handle_ping_command(client, message, chat):
+    await client.reply_message("pong", message)
+
+async def handle_debug_command(client, message, chat):
+    # Get quoted message if any
+    has_quoted, quoted_message, quoted_type = await get_quoted_message_info(message)
+    if has_quoted:
+        # Debug quoted message
+        info = f"Debug untuk pesan {quoted_type}:\n"
         
-        if not media_bytes:
-            await client.send_message(chat, "❌ Gagal mengunduh gambar")
-            return
-            
-        # Kirim ke API ekstraksi sesuai jenis dokumen
-        await client.send_message(chat, f"🔍 Mengekstrak data {doc_type.upper()}...")
+        if quoted_type == "image":
+            # Cetak atribut-atribut image yang penting
+            imgmsg = quoted_message.imageMessage
+            info += "== IMAGE MESSAGE INFO ==\n"
+            for attr in ['URL', 'url', 'mimetype', 'fileLength', 'height', 'width', 'mediaKey', 'caption', 'JPEGThumbnail', 'directPath']:
+                if hasattr(imgmsg, attr):
+                    val = getattr(imgmsg, attr)
+                    if isinstance(val, (str, int, float, bool)):
+                        info += f"{attr}: {val}\n"
+                    else:
+                        info += f"{attr}: (binary present)\n"
+                else:
+                    info += f"{attr}: not present\n"
         
-        file_name = os.path.basename(temp_path)
+        # Tambahkan info dari thundra_io jika tersedia
+        try:
+            from thundra_io.utils import get_message_type
+            from thundra_io.types import MediaMessageType
+            from thundra_io.storage.file import File
+            msg_type = get_message_type(quoted_message)
+            if isinstance(msg_type, MediaMessageType):
+                info += "\n== THUNDRA_IO INFO ==\n"
+                info += f"MediaMessageType: {msg_type.__class__.__name__}\n"
+                
+                # Coba dapatkan info dari File object
+                try:
+                    file_obj = File.from_message(msg_type)
+                    info += "File object attributes:\n"
+                    
+                    # Periksa semua atribut yang mungkin dimiliki
+                    for attr_name in dir(file_obj):
+                        if not attr_name.startswith('_') and not callable(getattr(file_obj, attr_name)):
+                            try:
+                                attr_value = getattr(file_obj, attr_name)
+                                if isinstance(attr_value, (str, int, float, bool)):
+                                    info += f"  {attr_name}: {attr_value}\n"
+                                else:
+                                    info += f"  {attr_name}: (complex object)\n"
+                            except Exception as e:
+                                info += f"  {attr_name}: Error getting value: {str(e)}\n"
+                    
+                    # Periksa metode yang mungkin berguna
+                    info += "Available methods:\n"
+                    for method_name in ['get_content', 'get_extension', 'get_mime_type']:
+                        if hasattr(file_obj, method_name) and callable(getattr(file_obj, method_name)):
+                            info += f"  {method_name}: Available\n"
+                        else:
+                            info += f"  {method_name}: Not available\n"
+                except Exception as e:
+                    info += f"Error creating File object: {str(e)}\n"
+            else:
+                info += "\nNot a MediaMessageType according to thundra_io\n"
+        except Exception as e:
+            info += f"\nError using thundra_io: {str(e)}\n"
         
-        if doc_type.lower() == 'ktp':
-            response = await query_ktp_extractor(media_bytes, mime_type, file_name)
-            formatted_response = format_ktp_response(response)
-        elif doc_type.lower() == 'kk':
-            response = await query_kk_extractor(media_bytes, mime_type, file_name)
-            formatted_response = format_kk_response(response)
-        elif doc_type.lower() == 'ijazah':
-            response = await query_ijazah_extractor(media_bytes, mime_type, file_name)
-            formatted_response = format_ijazah_response(response)
-        elif doc_type.lower() == 'sim':
-            response = await query_sim_extractor(media_bytes, mime_type, file_name)
-            formatted_response = format_sim_response(response)
+        await client.send_message(chat, info)
+    else:
+        await client.send_message(chat, message.__str__())
+
+def build_help_text():
+    lines = [
+        "",
+        "*WhatsApp Dokumen Extractor Bot*",
+        "",
+        "*Perintah:*",
+        "- `ping` - Cek apakah bot aktif",
+        "- `debug` - Menampilkan detail pesan (reply ke media untuk melihat attributnya)",
+    ]
+    for doc in DOCUMENT_TYPES.values():
+        lines.append(f"- `{doc.key}` - {doc.description}")
+    lines.append("- `auto` - Deteksi jenis dokumen secara otomatis lalu ekstrak datanya")
+    lines.append(f"- `batch ktp [N]` - Ekstrak hingga {BATCH_MAX_IMAGES} gambar terakhir di chat sekaligus")
+    if extraction_history is not None:
+        lines.append("- `riwayat [jenis]` - Daftar hasil ekstraksi terakhir di chat ini")
+        lines.append("- `riwayat <no>` - Tampilkan ulang hasil (tambahkan `.json` dll. untuk filenya) tanpa ekstraksi ulang")
+        lines.append("- `cari <NIK/No. KK/No. SIM>` - Cari hasil ekstraksi sebelumnya")
+    lines.append("- `help` - Tampilkan bantuan ini")
+    lines += ["", "Tambahkan `.txt`, `.json`, `.csv` atau `.xlsx` (mis. `ktp.json`, `batch kk.xlsx`) untuk menerima hasil dalam bentuk file.", "", "*Contoh:*"]
+    for doc in DOCUMENT_TYPES.values():
+        lines.append(f"> Reply gambar {doc.label} dengan pesan \"{doc.key}\"")
+    lines += [
+        "> Tunggu proses ekstraksi selesai",
+        "> Data dokumen akan ditampilkan secara lengkap",
+        "",
+    ]
+    return "\n".join(lines)
+
+async def handle_help_command(client, message, chat):
+    await client.send_message(chat, build_help_text())
+
+def is_admin(message):
+    return message.Info.MessageSource.Sender.User in ADMIN_NUMBERS
+
+def parse_profile_command(args):
+    """`[cpu|cprofile|mem] [N | Ns | Nm]` -> (mode, jobs, seconds), None jika tidak valid"""
+    parts = args.split()
+    mode = "cpu"
+    if parts and parts[0] in PROFILE_MODES:
+        mode = parts.pop(0)
+    if len(parts) > 1:
+        return None
+    if not parts:
+        return mode, PROFILE_DEFAULT_JOBS, None
+    match = PROFILE_AMOUNT_RE.match(parts[0])
+    if not match or int(match.group(1)) <= 0:
+        return None
+    amount, unit = int(match.group(1)), match.group(2)
+    if not unit:
+        return mode, min(amount, PROFILE_MAX_JOBS), None
+    return mode, None, min(amount * (60 if unit == "m" else 1), PROFILE_MAX_WINDOW)
+
+async def handle_profile_command(client, message, chat, args):
+    if not args:
+        if job_profiler.active:
+            reply = (f"📊 Profiling *{job_profiler.mode}* aktif untuk {job_profiler.describe()}.\n"
+                     f"📁 Output: {job_profiler.session_dir}")
         else:
-            await client.send_message(chat, f"❌ Tipe dokumen '{doc_type}' tidak dikenal")
-            return
-        
-        # Kirim hasil ekstraksi dalam format chatting
-        await client.send_message(chat, formatted_response)
-        
-        # Jika diminta format file, buat dan kirim filenya
-        if file_format:
-            await create_and_send_extraction_file(client, chat, response, doc_type, file_format)
-            
-    except Exception as e:
-        log.error(f"Error in {doc_type} extraction: {e}")
-        log.error(traceback.format_exc())
-        await client.send_message(chat, f"❌ Error saat memproses {doc_type.upper()}: {str(e)}")
+            reply = "📊 Profiling tidak aktif."
+        await client.reply_message(reply, message)
+        return
 
+    if args == "stop":
+        profiled = job_profiler.profiled_jobs
+        session_dir = job_profiler.stop()
+        if session_dir is None:
+            await client.reply_message("📊 Profiling tidak aktif.", message)
+        else:
+            await client.reply_message(f"⏹️ Profiling dihentikan setelah {profiled} job.\n📁 Output: {session_dir}", message)
+        return
 
-# Fungsi untuk memformat data SIM untuk ditampilkan di WhatsApp
-def format_sim_response(response):
+    parsed = parse_profile_command(args)
+    if parsed is None:
+        await client.reply_message(
+            "❌ Format: `profile [cpu|cprofile|mem] [N | Ns | Nm]`, `profile stop`, atau `profile` untuk status.",
+            message,
+        )
+        return
+    mode, jobs, seconds = parsed
     try:
-        if response["status"] == "error":
-            return f"❌ Error: {response['message']} (Code: {response['code']})"
-            
-        if response["status"] == "success":
-            data = response["data"]
-            analysis = data["analysis"]
-            parsed = analysis["parsed"]
-            
-            if parsed["status"] == "not_sim":
-                return "❌ Dokumen yang dikirim bukan merupakan Surat Izin Mengemudi (SIM)."
-                
-            if parsed["status"] == "success":
-                # Tentukan emoji untuk golongan SIM
-                golongan_sim = parsed.get('golongan_sim', 'X')
-                sim_emoji = "🚘"
-                
-                if "A" in golongan_sim:
-                    sim_emoji = "🚗"  # Mobil penumpang
-                elif "B" in golongan_sim:
-                    sim_emoji = "🚐"  # Mobil barang/orang
-                elif "C" in golongan_sim:
-                    sim_emoji = "🏍️"  # Motor
-                elif "D" in golongan_sim:
-                    sim_emoji = "🚜"  # Traktor
-                
-                result = (
-                    f"{sim_emoji} *HASIL EKSTRAKSI SIM* {sim_emoji}\n"
-                    "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-                    f"🎫 *Nomor SIM:* `{parsed.get('nomor_sim', 'Tidak terdeteksi')}`\n"
-                    f"🚦 *Golongan SIM:* {parsed.get('golongan_sim', 'Tidak terdeteksi')}\n\n"
-                    "👤 *DATA PEMILIK* 👤\n"
-                    f"📝 *Nama:* {parsed.get('nama', 'Tidak terdeteksi')}\n"
-                    f"🎂 *TTL:* {parsed.get('tempat_tanggal_lahir', 'Tidak terdeteksi')}\n"
-                    f"⚧️ *Jenis Kelamin:* {parsed.get('jenis_kelamin', 'Tidak terdeteksi')}\n"
-                    f"🩸 *Golongan Darah:* {parsed.get('golongan_darah', 'Tidak terdeteksi')}\n"
-                    f"📏 *Tinggi:* {parsed.get('tinggi', 'Tidak terdeteksi')}\n"
-                    f"💼 *Pekerjaan:* {parsed.get('pekerjaan', 'Tidak terdeteksi')}\n\n"
-                    "📍 *ALAMAT* 📍\n"
-                    f"🏠 *Alamat:* {parsed.get('alamat', 'Tidak terdeteksi')}\n"
-                    f"🏘️ *RT/RW:* {parsed.get('rt_rw', 'Tidak terdeteksi')}\n"
-                )
-                
-                # Tambahkan desa/kelurahan jika ada
-                if parsed.get('desa_kelurahan'):
-                    result += f"🏙️ *Desa/Kelurahan:* {parsed.get('desa_kelurahan')}\n"
-                
-                # Tambahkan kecamatan jika ada
-                if parsed.get('kecamatan'):
-                    result += f"🌆 *Kecamatan:* {parsed.get('kecamatan')}\n"
-                
-                # Tambahkan kota jika ada
-                if parsed.get('kota'):
-                    result += f"🏢 *Kota:* {parsed.get('kota')}\n"
-                    
-                # Informasi dokumen
-                result += (
-                    f"\n📄 *INFORMASI DOKUMEN* 📄\n"
-                    f"⏱️ *Berlaku Hingga:* {parsed.get('berlaku_hingga', 'Tidak terdeteksi')}\n"
-                    f"📍 *Dikeluarkan di:* {parsed.get('dikeluarkan_di', 'Tidak terdeteksi')}\n"
-                )
-                
-                # Tambahkan instansi penerbit jika ada
-                if parsed.get('instansi_penerbit'):
-                    result += f"🏛️ *Instansi Penerbit:* {parsed.get('instansi_penerbit')}\n"
-                
-                # Tambahkan peringatan
-                result += (
-                    "\n━━━━━━━━━━━━━━━━━━━━━━\n"
-                    "⚠️ *PERHATIAN:* _Gunakan informasi ini hanya untuk keperluan yang sah dan legal. Penyalahgunaan data pribadi dapat dikenakan sanksi hukum._"
-                )
-                
-                return result
-                
-        return "❌ Format respons tidak dikenal"
+        session_dir = job_profiler.start(mode, jobs=jobs, seconds=seconds)
     except Exception as e:
-        log.error(f"Error formatting SIM response: {e}")
+        log.error("Error starting profiler: %s", e)
         log.error(traceback.format_exc())
-        return f"❌ Error saat memformat respons: {str(e)}"
+        await client.reply_message("❌ Gagal memulai profiling. Cek log bot.", message)
+        return
+    await client.reply_message(
+        f"✅ Profiling *{mode}* dimulai untuk {job_profiler.describe()}.\n📁 Output: {session_dir}", message
+    )
 
-# Fungsi utilitas untuk membuat file hasil ekstraksi dan mengirimkannya (dengan nama sesuai pemilik)
+HISTORY_ENTRY_RE = re.compile(r"^#?(\d+)(?:\.(\w+))?$")
 
-# Fungsi utilitas untuk membuat file hasil ekstraksi (dengan perbaikan nama file)
+def parse_history_command(args):
+    """
+    Argumen `riwayat`: kosong atau jenis dokumen -> ("list", doc_key atau None),
+    nomor hasil dengan format opsional -> ("show", id, format); None jika tidak valid
+    """
+    if not args:
+        return "list", None
+    match = HISTORY_ENTRY_RE.match(args)
+    if match:
+        entry_id, file_format = int(match.group(1)), match.group(2)
+        if file_format is not None and file_format not in EXPORT_FORMATS:
+            return None
+        return "show", entry_id, file_format
+    route = EXTRACTION_ROUTES.get(args)
+    if route is not None and route[0] in DOCUMENT_TYPES:
+        return "list", route[0]
+    return None
+
+def is_identifier_query(value):
+    # Nomor identitas didominasi angka; menghindari "cari makan dulu" dianggap pencarian
+    digits = sum(c.isdigit() for c in value)
+    return digits >= 4 and digits * 5 >= len(value) * 3
+
+def format_history_entries(title, rows):
+    lines = [title, ""]
+    for entry_id, created_at, doc_type, owner_name, id_number in rows:
+        doc = DOCUMENT_TYPES.get(doc_type)
+        details = " • ".join(filter(None, [doc.label if doc else doc_type.upper(), owner_name, id_number]))
+        when = datetime.fromtimestamp(created_at).strftime("%d-%m-%Y %H:%M")
+        lines.append(f"*#{entry_id}* {details} ({when})")
+    lines += ["", "Ketik `riwayat <no>` untuk menampilkan ulang, atau `riwayat <no>.json` (.txt/.csv/.xlsx) untuk menerima filenya."]
+    return "\n".join(lines)
+
+async def handle_history_command(client, message, chat, args):
+    # "riwayat" juga kata sehari-hari: argumen yang bukan format perintah diabaikan diam-diam
+    parsed = parse_history_command(args)
+    if extraction_history is None or parsed is None:
+        return
+
+    if parsed[0] == "list":
+        doc_type = parsed[1]
+        rows = await extraction_history.recent(jid_key(chat), doc_type, HISTORY_LIST_LIMIT)
+        label = f" {DOCUMENT_TYPES[doc_type].label}" if doc_type else ""
+        if not rows:
+            await client.send_message(chat, f"🗂️ Belum ada riwayat ekstraksi{label} di chat ini.")
+            return
+        await client.send_message(chat, format_history_entries(f"🗂️ *Riwayat ekstraksi{label}* ({len(rows)} terakhir)", rows))
+        return
+
+    _, entry_id, file_format = parsed
+    # Admin dapat membuka hasil dari chat mana pun, pengguna lain hanya dari chat ini
+    entry = await extraction_history.get(entry_id, None if is_admin(message) else jid_key(chat))
+    doc = DOCUMENT_TYPES.get(entry[0]) if entry is not None else None
+    if doc is None:
+        await client.send_message(chat, f"❌ Riwayat #{entry_id} tidak ditemukan.")
+        return
+    _, created_at, response = entry
+    markdown, plain_text = render_extraction_response(doc, response)
+    when = datetime.fromtimestamp(created_at).strftime("%d-%m-%Y %H:%M")
+    await client.send_message(chat, f"🗂️ Riwayat #{entry_id} ({doc.label}, {when})\n\n{markdown}")
+    if file_format:
+        await create_and_send_extraction_file(client, chat, response, doc.key, file_format, plain_text)
+
+async def handle_history_search_command(client, message, chat, args):
+    value = normalize_identifier(args)
+    if extraction_history is None or not is_identifier_query(value):
+        return
+    # Admin mencari di semua chat, pengguna lain hanya di chat ini
+    rows = await extraction_history.search(value, None if is_admin(message) else jid_key(chat), HISTORY_LIST_LIMIT)
+    if not rows:
+        await client.send_message(chat, f"🔎 Tidak ada riwayat ekstraksi dengan nomor {args}.")
+        return
+    await client.send_message(chat, format_history_entries(f"🔎 *Hasil pencarian {args}* ({len(rows)})", rows))
+
+# Perintah ringan yang langsung diproses tanpa melalui scheduler
+SIMPLE_COMMANDS = {
+    "ping": handle_ping_command,
+    "debug": handle_debug_command,
+    "help": handle_help_command,
+}
 
-async def create_and_send_extraction_file(client, chat, data, doc_type, format_type):
+# Perintah admin (nomor di ADMIN_NUMBERS), menerima argumen setelah nama perintah
+ADMIN_COMMANDS = {
+    "profile": handle_profile_command,
+}
+
+# Perintah ringan berargumen (query riwayat), langsung diproses tanpa scheduler;
+# hanya didaftarkan jika riwayat aktif agar obrolan "riwayat ..."/"cari ..." tidak dibalas
+ARG_COMMANDS = {}
+if extraction_history is not None:
+    ARG_COMMANDS.update({
+        "riwayat": handle_history_command,
+        "cari": handle_history_search_command,
+    })
+
+COMMAND_WORDS.update(SIMPLE_COMMANDS)
+ARG_COMMAND_WORDS.update(ARG_COMMANDS)
+ARG_COMMAND_WORDS.update(ADMIN_COMMANDS)
+
+# Jumlah pesan per hasil filter ingress (dibaca sebagai counter di /metrics)
+ingress_stats = {"received": 0, "dropped": 0, "images": 0, "filtered": 0, "commands": 0}
+
+metrics.gauge("ingress_messages_total", "Messages received by the ingress filter",
+              lambda: ingress_stats["received"], kind="counter")
+metrics.gauge("ingress_dropped_total", "Messages dropped by the chat/sender allow-lists",
+              lambda: ingress_stats["dropped"], kind="counter")
+metrics.gauge("ingress_images_total", "Image messages remembered for batch commands",
+              lambda: ingress_stats["images"], kind="counter")
+metrics.gauge("ingress_filtered_total", "Text messages skipped because they are not commands",
+              lambda: ingress_stats["filtered"], kind="counter")
+metrics.gauge("ingress_commands_total", "Messages routed as commands", lambda: ingress_stats["commands"], kind="counter")
+
+def ingress_allowed(source):
+    """Allow-list chat/pengirim; nomor admin selalu diizinkan"""
+    if INGRESS_IGNORE_FROM_ME and source.IsFromMe:
+        return False
+    if source.Sender.User in ADMIN_NUMBERS:
+        return True
+    if INGRESS_ALLOWED_CHATS and source.Chat.User not in INGRESS_ALLOWED_CHATS:
+        return False
+    return not INGRESS_ALLOWED_SENDERS or source.Sender.User in INGRESS_ALLOWED_SENDERS
+
+def match_command(text):
     """
-    Membuat file hasil ekstraksi dalam format txt atau json dan mengirimkannya
-    dengan nama file yang menyertakan nama pemilik dokumen
-    
-    Args:
-        client: NewAClient instance
-        chat: Chat ID tujuan
-        data: Data hasil ekstraksi yang akan disimpan ke file
-        doc_type: Jenis dokumen (ktp, kk, ijazah, sim)
-        format_type: Format file yang diinginkan (txt atau json)
+    Prefilter murah atas teks mentah: teks pendek yang berupa perintah dikenal
+    dikembalikan dalam bentuk ternormalisasi, selain itu None.
     """
+    if not text or len(text) > INGRESS_MAX_COMMAND_CHARS:
+        return None
+    command = text.strip().lower()
+    if command in COMMAND_WORDS or command.partition(" ")[0] in ARG_COMMAND_WORDS:
+        return command
+    return None
+
+async def handle_message(client, message):
     try:
-        # Siapkan timestamp
-        from datetime import datetime
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        ingress_stats["received"] += 1
+        source = message.Info.MessageSource
+        if (INGRESS_ALLOWED_CHATS or INGRESS_ALLOWED_SENDERS or INGRESS_IGNORE_FROM_ME) and not ingress_allowed(source):
+            ingress_stats["dropped"] += 1
+            return
         
-        # Default nama jika tidak ditemukan
-        owner_name = "Untitled"
+        # Simpan gambar terbaru untuk perintah batch
+        if message.Message.HasField("imageMessage"):
+            ingress_stats["images"] += 1
+            remember_recent_image(source.Chat, message)
+            return
         
-        # PERBAIKAN: Cek dan dapatkan nama pemilik dokumen dengan lebih teliti
-        if isinstance(data, dict) and "data" in data and "analysis" in data["data"] and "parsed" in data["data"]["analysis"]:
-            parsed_data = data["data"]["analysis"]["parsed"]
-            
-            # Pastikan status success dan cek nama berdasarkan jenis dokumen
-            if parsed_data.get("status") == "success":
-                if doc_type.lower() == "ktp" and "nama" in parsed_data:
-                    owner_name = parsed_data["nama"]
-                    log.info(f"Extracted KTP owner name: {owner_name}")
-                    
-                elif doc_type.lower() == "kk" and "kepala_keluarga" in parsed_data:
-                    if isinstance(parsed_data["kepala_keluarga"], dict) and "nama" in parsed_data["kepala_keluarga"]:
-                        owner_name = parsed_data["kepala_keluarga"]["nama"]
-                        log.info(f"Extracted KK owner name: {owner_name}")
-                    
-                elif doc_type.lower() == "ijazah" and "nama_peserta_didik" in parsed_data:
-                    owner_name = parsed_data["nama_peserta_didik"]
-                    log.info(f"Extracted Ijazah owner name: {owner_name}")
-                    
-                elif doc_type.lower() == "sim" and "nama" in parsed_data:
-                    owner_name = parsed_data["nama"]
-                    log.info(f"Extracted SIM owner name: {owner_name}")
+        # Obrolan biasa berhenti di sini; pesan yang dikutip baru diperiksa oleh handler perintah
+        text = message.Message.conversation or message.Message.extendedTextMessage.text
+        command = match_command(text)
+        if command is None:
+            ingress_stats["filtered"] += 1
+            return
+        ingress_stats["commands"] += 1
+        chat = source.Chat
         
-        # Bersihkan nama untuk digunakan dalam nama file (hapus karakter tidak valid)
-        import re
-        clean_name = re.sub(r'[\\/*?:"<>|]', "", owner_name).strip()
-        clean_name = clean_name.replace(' ', '_')
+        # Routing perintah O(1): ekstraksi masuk antrean scheduler, perintah ringan langsung diproses
+        if command in EXTRACTION_ROUTES:
+            await enqueue_extraction_command(client, message, chat, text)
+            return
         
-        # PERBAIKAN: Logging lebih detail untuk debugging nama file
-        log.info(f"Original owner name: {owner_name}")
-        log.info(f"Cleaned name for filename: {clean_name}")
+        if command.startswith("batch ") and parse_batch_command(command):
+            await enqueue_extraction_command(client, message, chat, text, process=process_batch_command)
+            return
         
-        # Jika nama kosong setelah dibersihkan, gunakan "Untitled"
-        if not clean_name:
-            clean_name = "Untitled"
-            log.info("Using 'Untitled' as name is empty after cleaning")
+        handler = SIMPLE_COMMANDS.get(command)
+        if handler is not None:
+            await handler(client, message, chat)
+            return
         
-        if format_type.lower() == 'json':
-            # Buat konten file JSON
-            import json
-            
-            # Pastikan kita memiliki data yang benar untuk JSON
-            if isinstance(data, dict) and "data" in data and "analysis" in data["data"] and "parsed" in data["data"]["analysis"]:
-                # Ambil hanya bagian parsed dari data untuk file JSON
-                json_data = data["data"]["analysis"]["parsed"]
-                
-                # PERBAIKAN: Pastikan nama file menggunakan clean_name
-                file_path = f"temp_media/{doc_type}_{clean_name}_{timestamp}.json"
-                log.info(f"Creating JSON file: {file_path}")
-                
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    json.dump(json_data, f, ensure_ascii=False, indent=2)
-                
-                # Kirim file
-                caption = f"Hasil ekstraksi {doc_type.upper()} - {owner_name} (JSON)"
-                await client.send_document(chat, file_path, caption)
-                
-                # Beri tahu pengguna
-                await client.send_message(chat, f"✅ File JSON hasil ekstraksi {doc_type.upper()} untuk {owner_name} telah dikirim.")
-                return True
-            else:
-                await client.send_message(chat, "❌ Format data tidak valid untuk konversi ke JSON.")
-                return False
-                
-        elif format_type.lower() == 'txt':
-            # Buat konten file TXT
-            # Gunakan fungsi format yang sudah ada untuk membuat konten yang rapi
-            
-            if doc_type.lower() == 'ktp':
-                formatted_content = format_ktp_response(data).replace('*', '').replace('_', '')
-            elif doc_type.lower() == 'kk':
-                formatted_content = format_kk_response(data).replace('*', '').replace('_', '')
-            elif doc_type.lower() == 'ijazah':
-                formatted_content = format_ijazah_response(data).replace('*', '').replace('_', '')
-            elif doc_type.lower() == 'sim':
-                formatted_content = format_sim_response(data).replace('*', '').replace('_', '')
+        name, _, args = command.partition(" ")
+        arg_handler = ARG_COMMANDS.get(name)
+        if arg_handler is not None:
+            await arg_handler(client, message, chat, args.strip())
+            return
+        
+        admin_handler = ADMIN_COMMANDS.get(name)
+        if admin_handler is not None:
+            if is_admin(message):
+                await admin_handler(client, message, chat, args.strip())
             else:
-                await client.send_message(chat, f"❌ Jenis dokumen '{doc_type}' tidak dikenal.")
-                return False
-            
-            # Hilangkan emoji dari teks untuk file txt
-            import re
-            emoji_pattern = re.compile("["
-                                       u"\U0001F600-\U0001F64F"  # emoticons
-                                       u"\U0001F300-\U0001F5FF"  # symbols & pictographs
-                                       u"\U0001F680-\U0001F6FF"  # transport & map symbols
-                                       u"\U0001F700-\U0001F77F"  # alchemical symbols
-                                       u"\U0001F780-\U0001F7FF"  # Geometric Shapes
-                                       u"\U0001F800-\U0001F8FF"  # Supplemental Arrows-C
-                                       u"\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
-                                       u"\U0001FA00-\U0001FA6F"  # Chess Symbols
-                                       u"\U0001FA70-\U0001FAFF"  # Symbols and Pictographs Extended-A
-                                       u"\U00002702-\U000027B0"  # Dingbats
-                                       u"\U000024C2-\U0001F251" 
-                                       "]+", flags=re.UNICODE)
-            
-            clean_content = emoji_pattern.sub(r'', formatted_content)
-            
-            # Bersihkan format dan tag lainnya
-            clean_content = clean_content.replace('`', '').replace('┣', '-').replace('┗', '-')
-            
-            # Tambahkan nama pemilik dan info dokumen di header
-            header = f"Dokumen: {doc_type.upper()}\n"
-            header += f"Nama: {owner_name}\n"
-            header += f"Diekstrak pada: {datetime.now().strftime('%d-%m-%Y %H:%M:%S')}\n"
-            header += "=" * 40 + "\n\n"
-            
-            # PERBAIKAN: Pastikan nama file menggunakan clean_name
-            file_path = f"temp_media/{doc_type}_{clean_name}_{timestamp}.txt"
-            log.info(f"Creating TXT file: {file_path}")
-            
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(header + clean_content)
-            
-            # Kirim file
-            caption = f"Hasil ekstraksi {doc_type.upper()} - {owner_name} (TXT)"
-            await client.send_document(chat, file_path, caption)
-            
-            # Beri tahu pengguna
-            await client.send_message(chat, f"✅ File TXT hasil ekstraksi {doc_type.upper()} untuk {owner_name} telah dikirim.")
-            return True
-            
-        else:
-            await client.send_message(chat, f"❌ Format file '{format_type}' tidak didukung. Gunakan 'txt' atau 'json'.")
-            return False
+                log.info("Ignoring admin command %s from %s", name, jid_key(message.Info.MessageSource.Sender))
             
     except Exception as e:
-        log.error(f"Error creating extraction file: {e}")
+        log.error("Error in message handler: %s", e)
         log.error(traceback.format_exc())
-        await client.send_message(chat, f"❌ Error saat membuat file: {str(e)}")
-        return False     
-        
-@client_factory.event(ConnectedEv)
-async def on_connected(_: NewAClient, __: ConnectedEv):
-    log.info("⚡ WhatsApp terhubung")
 
-@client_factory.event(MessageEv)
-async def on_message(client: NewAClient, message: MessageEv):
-    await handle_message(client, message)
+# Supervisor multi-proses: device dibagi ke beberapa worker shard
+def merge_shard_metrics(shard_texts):
+    """
+    Menggabungkan output /metrics beberapa shard menjadi satu eksposisi.
 
-async def handle_message(client, message):
-    try:
-        chat = message.Info.MessageSource.Chat
-        
-        # Extract text content
-        if hasattr(message.Message, 'conversation') and message.Message.conversation:
-            text = message.Message.conversation
-        elif hasattr(message.Message, 'extendedTextMessage') and message.Message.extendedTextMessage.text:
-            text = message.Message.extendedTextMessage.text
-        else:
-            text = ""
-        
-        # Get quoted message if any
-        has_quoted, quoted_message, quoted_type = await get_quoted_message_info(message)
-        
-        # Handle commands
-        if text.lower() == "ping":
-            await client.reply_message("pong", message)
-            
-        elif text.lower() == "debug":
-            if has_quoted:
-                # Debug quoted message
-                info = f"Debug untuk pesan {quoted_type}:\n"
-                
-                if quoted_type == "image":
-                    # Cetak atribut-atribut image yang penting
-                    imgmsg = quoted_message.imageMessage
-                    info += "== IMAGE MESSAGE INFO ==\n"
-                    for attr in ['URL', 'url', 'mimetype', 'fileLength', 'height', 'width', 'mediaKey', 'caption', 'JPEGThumbnail', 'directPath']:
-                        if hasattr(imgmsg, attr):
-                            val = getattr(imgmsg, attr)
-                            if isinstance(val, (str, int, float, bool)):
-                                info += f"{attr}: {val}\n"
-                            else:
-                                info += f"{attr}: (binary present)\n"
-                        else:
-                            info += f"{attr}: not present\n"
-                
-                # Tambahkan info dari thundra_io jika tersedia
-                try:
-                    msg_type = get_message_type(quoted_message)
-                    if isinstance(msg_type, MediaMessageType):
-                        info += "\n== THUNDRA_IO INFO ==\n"
-                        info += f"MediaMessageType: {msg_type.__class__.__name__}\n"
-                        
-                        # Coba dapatkan info dari File object
-                        try:
-                            file_obj = File.from_message(msg_type)
-                            info += "File object attributes:\n"
-                            
-                            # Periksa semua atribut yang mungkin dimiliki
-                            for attr_name in dir(file_obj):
-                                if not attr_name.startswith('_') and not callable(getattr(file_obj, attr_name)):
-                                    try:
-                                        attr_value = getattr(file_obj, attr_name)
-                                        if isinstance(attr_value, (str, int, float, bool)):
-                                            info += f"  {attr_name}: {attr_value}\n"
-                                        else:
-                                            info += f"  {attr_name}: (complex object)\n"
-                                    except Exception as e:
-                                        info += f"  {attr_name}: Error getting value: {str(e)}\n"
-                            
-                            # Periksa metode yang mungkin berguna
-                            info += "Available methods:\n"
-                            for method_name in ['get_content', 'get_extension', 'get_mime_type']:
-                                if hasattr(file_obj, method_name) and callable(getattr(file_obj, method_name)):
-                                    info += f"  {method_name}: Available\n"
-                                else:
-                                    info += f"  {method_name}: Not available\n"
-                        except Exception as e:
-                            info += f"Error creating File object: {str(e)}\n"
-                    else:
-                        info += "\nNot a MediaMessageType according to thundra_io\n"
-                except Exception as e:
-                    info += f"\nError using thundra_io: {str(e)}\n"
-                
-                await client.send_message(chat, info)
-            else:
-                await client.send_message(chat, message.__str__())
-        elif text.lower() == "ptk" or text.lower() == "ptk.txt" or text.lower() == "ptk.json":
-            file_format = None
-            if text.lower().endswith('.txt'):
-                file_format = 'txt'
-            elif text.lower().endswith('.json'):
-                file_format = 'json'
-                
-            await handle_document_extraction(client, chat, has_quoted, quoted_message, quoted_type, 
-                                           'ktp', file_format, text)
-        # Command untuk ekstrak KTP
-        elif text.lower() == "ktp":
-            if has_quoted and quoted_type == "image":
-                await client.send_message(chat, "📷 Mengunduh gambar KTP...")
-                
-                try:
-                    # Download gambar
-                    media_bytes, mime_type, temp_path = await download_media(client, quoted_message, quoted_type)
-                    
-                    if media_bytes:
-                        # Kirim ke API ekstraksi KTP
-                        await client.send_message(chat, "🔍 Mengekstrak data KTP...")
-                        
-                        file_name = os.path.basename(temp_path)
-                        response = await query_ktp_extractor(media_bytes, mime_type, file_name)
-                        
-                        # Format dan kirim respons
-                        formatted_response = format_ktp_response(response)
-                        await client.send_message(chat, formatted_response)
-                    else:
-                        await client.send_message(chat, "❌ Gagal mengunduh gambar")
-                        
-                except Exception as e:
-                    log.error(f"Error in KTP extraction: {e}")
-                    log.error(traceback.format_exc())
-                    await client.send_message(chat, f"❌ Error saat memproses KTP: {str(e)}")
+    Setiap sampel diberi label shard="i"; HELP/TYPE ditulis sekali per family
+    dan sampel dari semua shard dikelompokkan di bawah family yang sama.
+    """
+    families = OrderedDict()
+    for shard, text in shard_texts:
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                parts = line.split(" ", 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = families.setdefault(parts[2], {"meta": [], "samples": []})
+                    if len(family["meta"]) < 2:
+                        family["meta"].append(line)
+                continue
+            name_part, _, value = line.rpartition(" ")
+            name, brace, labels = name_part.partition("{")
+            if family is None:
+                family = families.setdefault(name, {"meta": [], "samples": []})
+            shard_label = f'shard="{shard}"'
+            if not brace:
+                family["samples"].append(f"{name}{{{shard_label}}} {value}")
+            elif labels == "}":
+                family["samples"].append(f"{name}{{{shard_label}}} {value}")
             else:
-                await client.send_message(chat, "❌ Silakan reply pesan gambar KTP dengan perintah 'ktp'")
+                family["samples"].append(f"{name}{{{shard_label},{labels} {value}")
+    lines = []
+    for family in families.values():
+        lines += family["meta"]
+        lines += family["samples"]
+    return "\n".join(lines) + "\n" if lines else ""
 
-        # Command untuk ekstrak KK (Kartu Keluarga)
-        elif text.lower() == "kk":
-            if has_quoted and quoted_type == "image":
-                await client.send_message(chat, "📷 Mengunduh gambar Kartu Keluarga...")
-                
-                try:
-                    # Download gambar
-                    media_bytes, mime_type, temp_path = await download_media(client, quoted_message, quoted_type)
-                    
-                    if media_bytes:
-                        # Kirim ke API ekstraksi KK
-                        await client.send_message(chat, "🔍 Mengekstrak data Kartu Keluarga...")
-                        
-                        file_name = os.path.basename(temp_path)
-                        response = await query_kk_extractor(media_bytes, mime_type, file_name)
-                        
-                        # Format dan kirim respons
-                        formatted_response = format_kk_response(response)
-                        await client.send_message(chat, formatted_response)
-                    else:
-                        await client.send_message(chat, "❌ Gagal mengunduh gambar")
-                        
-                except Exception as e:
-                    log.error(f"Error in KK extraction: {e}")
-                    log.error(traceback.format_exc())
-                    await client.send_message(chat, f"❌ Error saat memproses Kartu Keluarga: {str(e)}")
-            else:
-                await client.send_message(chat, "❌ Silakan reply pesan gambar Kartu Keluarga dengan perintah 'kk'")
-        
-        # Command untuk ekstrak SIM
-        elif text.lower() == "sim":
-            if has_quoted and quoted_type == "image":
-                await client.send_message(chat, "📷 Mengunduh gambar SIM...")
-                
-                try:
-                    # Download gambar
-                    media_bytes, mime_type, temp_path = await download_media(client, quoted_message, quoted_type)
-                    
-                    if media_bytes:
-                        # Kirim ke API ekstraksi SIM
-                        await client.send_message(chat, "🔍 Mengekstrak data SIM...")
-                        
-                        file_name = os.path.basename(temp_path)
-                        response = await query_sim_extractor(media_bytes, mime_type, file_name)
-                        
-                        # Format dan kirim respons
-                        formatted_response = format_sim_response(response)
-                        await client.send_message(chat, formatted_response)
-                    else:
-                        await client.send_message(chat, "❌ Gagal mengunduh gambar")
-                        
-                except Exception as e:
-                    log.error(f"Error in SIM extraction: {e}")
-                    log.error(traceback.format_exc())
-                    await client.send_message(chat, f"❌ Error saat memproses SIM: {str(e)}")
-            else:
-                await client.send_message(chat, "❌ Silakan reply pesan gambar SIM dengan perintah 'sim'")
+class ShardProcess:
+    """Satu proses worker shard beserta status restart-nya"""
 
-        
-        # Command untuk ekstrak Ijazah
-        elif text.lower() == "ijazah":
-            if has_quoted and quoted_type == "image":
-                await client.send_message(chat, "📷 Mengunduh gambar Ijazah...")
-                
+    def __init__(self, index, metrics_port):
+        self.index = index
+        self.metrics_port = metrics_port
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.last_exit = None
+        self.finished = False
+
+    @property
+    def up(self):
+        return self.process is not None and self.process.returncode is None
+
+class ShardSupervisor:
+    """
+    Menjalankan satu proses worker per shard dan me-restart yang crash.
+
+    Setiap worker adalah main.py yang sama dengan SHARD_INDEX/SHARD_COUNT di
+    environment (konfigurasi lain diwarisi), sehingga punya event loop, HTTP
+    pool, scheduler dan GIL sendiri. Device dibagi secara sticky lewat
+    shard_for_jid. Worker yang keluar dengan kode 0 (mis. tidak punya device)
+    tidak di-restart; worker yang crash di-restart dengan backoff eksponensial.
+    """
+
+    def __init__(self, shard_count, metrics_base_port=0):
+        self.shards = [
+            ShardProcess(index, metrics_base_port + index if metrics_base_port else 0)
+            for index in range(shard_count)
+        ]
+        self._stopping = False
+
+    def worker_env(self, shard):
+        env = dict(os.environ)
+        env["SHARD_COUNT"] = str(len(self.shards))
+        env["SHARD_INDEX"] = str(shard.index)
+        env["METRICS_HOST"] = "127.0.0.1"
+        env["METRICS_PORT"] = str(shard.metrics_port)
+        return env
+
+    async def _spawn(self, shard):
+        shard.process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), env=self.worker_env(shard)
+        )
+        shard.started = time.monotonic()
+        log.info("Started shard %s (pid %s)", shard.index, shard.process.pid)
+
+    async def _watch(self, shard):
+        delay = SHARD_RESTART_DELAY
+        while not self._stopping:
+            await self._spawn(shard)
+            code = await shard.process.wait()
+            shard.last_exit = code
+            if self._stopping:
+                return
+            if code == 0:
+                log.info("Shard %s exited cleanly, not restarting", shard.index)
+                shard.finished = True
+                return
+            if time.monotonic() - shard.started >= SHARD_STABLE_UPTIME:
+                delay = SHARD_RESTART_DELAY
+            log.error("Shard %s exited with code %s, restarting in %.1fs", shard.index, code, delay)
+            shard.restarts += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SHARD_RESTART_MAX_DELAY)
+
+    async def run(self):
+        try:
+            await asyncio.gather(*(self._watch(shard) for shard in self.shards))
+        finally:
+            await self.stop()
+
+    def signal_workers(self, signum):
+        for shard in self.shards:
+            if shard.up:
+                shard.process.send_signal(signum)
+
+    def request_stop(self):
+        """Menghentikan semua worker (SIGTERM) tanpa restart"""
+        self._stopping = True
+        self.signal_workers(signal.SIGTERM)
+
+    async def stop(self, timeout=10):
+        self.request_stop()
+        for shard in self.shards:
+            if shard.process is None or shard.process.returncode is not None:
+                continue
+            try:
+                await asyncio.wait_for(shard.process.wait(), timeout)
+            except asyncio.TimeoutError:
+                log.warning("Shard %s did not exit within %ss, killing", shard.index, timeout)
+                shard.process.kill()
+                await shard.process.wait()
+
+    async def scrape(self, shard, path):
+        """Mengambil /metrics atau /health dari worker; None jika worker tidak menjawab"""
+        if not shard.metrics_port or not shard.up:
+            return None
+        url = f"http://127.0.0.1:{shard.metrics_port}{path}"
+        try:
+            import aiohttp
+            async with get_http_session().get(url, timeout=aiohttp.ClientTimeout(total=SHARD_SCRAPE_TIMEOUT)) as response:
+                if response.status != 200:
+                    return None
+                return await response.text()
+        except Exception as e:
+            log.debug("Error scraping shard %s %s: %s", shard.index, path, e)
+            return None
+
+    def render_own_metrics(self):
+        lines = [
+            f"# HELP {METRICS_NAMESPACE}_shard_up Whether the shard worker process is running",
+            f"# TYPE {METRICS_NAMESPACE}_shard_up gauge",
+        ]
+        lines += [f'{METRICS_NAMESPACE}_shard_up{{shard="{shard.index}"}} {int(shard.up)}' for shard in self.shards]
+        lines += [
+            f"# HELP {METRICS_NAMESPACE}_shard_restarts_total Shard worker restarts after a crash",
+            f"# TYPE {METRICS_NAMESPACE}_shard_restarts_total counter",
+        ]
+        lines += [f'{METRICS_NAMESPACE}_shard_restarts_total{{shard="{shard.index}"}} {shard.restarts}'
+                  for shard in self.shards]
+        return "\n".join(lines) + "\n"
+
+    async def handle_metrics(self, request):
+        texts = await asyncio.gather(*(self.scrape(shard, "/metrics") for shard in self.shards))
+        from aiohttp import web
+        body = self.render_own_metrics() + merge_shard_metrics(
+            (shard.index, text) for shard, text in zip(self.shards, texts) if text
+        )
+        return web.Response(body=body.encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def handle_health(self, request):
+        from aiohttp import web
+        texts = await asyncio.gather(*(self.scrape(shard, "/health") for shard in self.shards))
+        totals = {"clients": 0, "queued": 0, "in_flight": 0, "completed": 0, "rejected": 0}
+        shards = []
+        healthy = True
+        for shard, text in zip(self.shards, texts):
+            health = None
+            if text:
                 try:
-                    # Download gambar
-                    media_bytes, mime_type, temp_path = await download_media(client, quoted_message, quoted_type)
-                    
-                    if media_bytes:
-                        # Kirim ke API ekstraksi Ijazah
-                        await client.send_message(chat, "🔍 Mengekstrak data Ijazah...")
-                        
-                        file_name = os.path.basename(temp_path)
-                        response = await query_ijazah_extractor(media_bytes, mime_type, file_name)
-                        
-                        # Format dan kirim respons
-                        formatted_response = format_ijazah_response(response)
-                        await client.send_message(chat, formatted_response)
-                    else:
-                        await client.send_message(chat, "❌ Gagal mengunduh gambar")
-                        
-                except Exception as e:
-                    log.error(f"Error in Ijazah extraction: {e}")
-                    log.error(traceback.format_exc())
-                    await client.send_message(chat, f"❌ Error saat memproses Ijazah: {str(e)}")
-            else:
-                await client.send_message(chat, "❌ Silakan reply pesan gambar Ijazah dengan perintah 'ijazah'")
-
-        elif text.lower() == "help":
-            help_text = """
-*WhatsApp Dokumen Extractor Bot*
-
-*Perintah:*
-- `ping` - Cek apakah bot aktif
-- `debug` - Menampilkan detail pesan (reply ke media untuk melihat attributnya)
-- `ktp` - Ekstrak data dari gambar KTP (reply ke gambar KTP)
-- `kk` - Ekstrak data dari gambar Kartu Keluarga (reply ke gambar KK)
-- `ijazah` - Ekstrak data dari gambar Ijazah (reply ke gambar Ijazah)
-- `sim` - Ekstrak data dari gambar SIM (reply ke gambar SIM)
-- `help` - Tampilkan bantuan ini
-
-*Contoh:*
-> Reply gambar KTP dengan pesan "ktp"
-> Reply gambar Kartu Keluarga dengan pesan "kk"
-> Reply gambar Ijazah dengan pesan "ijazah" 
-> Reply gambar SIM dengan pesan "sim"
-> Tunggu proses ekstraksi selesai
-> Data dokumen akan ditampilkan secara lengkap
-"""
-            await client.send_message(chat, help_text)
-            
-    except Exception as e:
-        log.error(f"Error in message handler: {e}")
-        log.error(traceback.format_exc())
+                    health = json.loads(text)
+                except ValueError:
+                    pass
+            if health:
+                for key in totals:
+                    totals[key] += health.get(key, 0)
+            elif not shard.finished:
+                healthy = False
+            shards.append({
+                "shard": shard.index,
+                "pid": shard.process.pid if shard.up else None,
+                "up": shard.up,
+                "finished": shard.finished,
+                "restarts": shard.restarts,
+                "last_exit": shard.last_exit,
+                "health": health,
+            })
+        return web.json_response({"healthy": healthy, "totals": totals, "shards": shards},
+                                 status=200 if healthy else 503)
+
+async def run_supervisor():
+    metrics_base_port = (SHARD_METRICS_BASE_PORT or METRICS_PORT + 1) if METRICS_PORT > 0 else 0
+    supervisor = ShardSupervisor(SHARD_COUNT, metrics_base_port)
+    log.info("Starting shard supervisor with %s workers", SHARD_COUNT)
+    loop = asyncio.get_running_loop()
+    try:
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, supervisor.request_stop)
+        # Sinyal profiling diteruskan ke semua worker
+        for signum in (signal.SIGUSR1, signal.SIGUSR2):
+            loop.add_signal_handler(signum, supervisor.signal_workers, signum)
+    except (AttributeError, NotImplementedError, RuntimeError):
+        log.info("Supervisor signal handlers are not available on this platform")
+    metrics_runner = await start_metrics_server(supervisor.handle_metrics, supervisor.handle_health)
+    try:
+        await supervisor.run()
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await close_http_session()
+
+async def start_services():
+    # Buat HTTP session bersama saat startup, tutup saat shutdown
+    get_http_session()
+    extraction_scheduler.start()
+    if extraction_history is not None:
+        extraction_history.start()
+    if extractor_quota_store is not None:
+        await extractor_quota_store.start()
+    metrics_runner = await start_metrics_server()
+    install_profiling_signals()
+    return metrics_runner
+
+async def run_bot():
+    create_client_factory()
+    startup_timer.mark("neonize")
+    # Daftar device dibaca dari SQLite (di thread) sementara layanan lain dinyalakan
+    _, metrics_runner = await asyncio.gather(load_sessions(), start_services())
+    startup_timer.mark("restore")
+    log.info("Startup ready: %s", startup_timer.describe())
+    try:
+        await client_factory.run()
+    finally:
+        job_profiler.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await extraction_scheduler.stop()
+        if extraction_history is not None:
+            await extraction_history.stop()
+        if extractor_quota_store is not None:
+            await extractor_quota_store.stop()
+        await close_http_session()
+        shutdown_image_pool()
+        if extraction_cache is not None:
+            extraction_cache.close()
+
+def main():
+    """Entry point: konfigurasi logging lalu jalankan bot atau supervisor shard"""
+    configure_logging()
+    startup_timer.mark("logging")
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(run_supervisor() if IS_SHARD_SUPERVISOR else run_bot())
+    finally:
+        loop.close()
+
+startup_timer.mark("import")
 
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(client_factory.run())
+    main()
@@ -0,0 +1,169 @@
+"""
+Smoke test alur pesan end-to-end: perintah `ktp` yang me-reply gambar masuk
+lewat handle_message, melewati scheduler, download (single-flight), extractor
+dan renderer, lalu hasilnya dikirim ke chat. neonize tidak dibutuhkan: pesan
+dan client diganti objek tiruan, download dan HTTP extractor di-monkeypatch.
+"""
+import asyncio
+import base64
+import hashlib
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+KTP_RESPONSE = {
+    "status": "success",
+    "data": {"analysis": {"parsed": {
+        "status": "success", "nik": "3201010101010001", "nama": "BUDI SANTOSO",
+    }}},
+}
+
+class FakeProto(SimpleNamespace):
+    """Pengganti pesan protobuf: HasField bernilai True untuk atribut yang diisi"""
+
+    def HasField(self, name):
+        return hasattr(self, name)
+
+class FakeClient:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, to, message, *args, **kwargs):
+        self.sent.append(str(message))
+
+    async def reply_message(self, message, quoted, *args, **kwargs):
+        self.sent.append(str(message))
+
+    async def send_document(self, to, file, caption=None, *args, **kwargs):
+        self.sent.append(caption)
+
+def make_jid(user, server):
+    return SimpleNamespace(User=user, Server=server)
+
+def make_event(message_id, text, image_bytes=None):
+    message = FakeProto(conversation=text)
+    if image_bytes is not None:
+        image = SimpleNamespace(
+            fileSHA256=hashlib.sha256(image_bytes).digest(), mimetype="image/jpeg",
+            width=1280, height=800, directPath="", mediaKey=b"", JPEGThumbnail=b"",
+        )
+        message = FakeProto(conversation="", extendedTextMessage=SimpleNamespace(
+            text=text, contextInfo=SimpleNamespace(quotedMessage=SimpleNamespace(imageMessage=image)),
+        ))
+    return SimpleNamespace(
+        Info=SimpleNamespace(ID=message_id, MessageSource=SimpleNamespace(
+            Chat=make_jid("120363000001", "g.us"), Sender=make_jid("62811000001", "s.whatsapp.net"),
+            IsFromMe=False, IsGroup=True,
+        )),
+        Message=message,
+    )
+
+async def run_messages(events, timeout=5):
+    client = FakeClient()
+    scheduler = main.extraction_scheduler
+    scheduler.start()
+    try:
+        for event in events:
+            await main.handle_message(client, event)
+        deadline = asyncio.get_running_loop().time() + timeout
+        while scheduler.queued or scheduler.in_flight:
+            assert asyncio.get_running_loop().time() < deadline, "extraction jobs did not finish"
+            await asyncio.sleep(0.01)
+    finally:
+        await scheduler.stop()
+    return client
+
+@pytest.fixture
+def extractor(monkeypatch):
+    """Download dan endpoint extractor tiruan; mencatat setiap panggilan"""
+    calls = {"download": 0, "extractor": 0}
+
+    async def fake_download_media(client, quoted_message, quoted_type):
+        calls["download"] += 1
+        return main.MediaDownload(b"fake image bytes", "image/jpeg", "image.jpg", "download_any")
+
+    async def fake_query_extractor_endpoint(doc, url, media_bytes, mime_type, file_name, timeout=None):
+        calls["extractor"] += 1
+        return KTP_RESPONSE
+
+    monkeypatch.setattr(main, "download_media", fake_download_media)
+    monkeypatch.setattr(main, "query_extractor_endpoint", fake_query_extractor_endpoint)
+    monkeypatch.setattr(main, "extraction_cache", None)
+    monkeypatch.setattr(main, "media_cache", None)
+    return calls
+
+def test_ktp_command_extracts_and_replies(extractor):
+    client = asyncio.run(run_messages([make_event("MSG1", "ktp", image_bytes=b"fake image bytes")]))
+
+    assert extractor == {"download": 1, "extractor": 1}
+    assert any("BUDI SANTOSO" in message for message in client.sent), client.sent
+    assert not any(message.startswith("❌") for message in client.sent), client.sent
+
+def test_ordinary_chat_gets_no_reply(extractor):
+    client = asyncio.run(run_messages([
+        make_event("MSG2", "halo semua"),
+        make_event("MSG3", "ktp saya sudah dikirim belum?"),
+        make_event("MSG4", "riwayat hidup saya"),
+        make_event("MSG5", "cari makan dulu"),
+    ]))
+
+    assert client.sent == []
+    assert extractor == {"download": 0, "extractor": 0}
+
+def test_history_command_ignores_ordinary_chat(tmp_path, monkeypatch):
+    history = main.ExtractionHistory(str(tmp_path / "history.sqlite3"), 0, 1, 10)
+    monkeypatch.setattr(main, "extraction_history", history)
+    event = make_event("MSG6", "riwayat hidup saya")
+    client = FakeClient()
+
+    async def run():
+        chat = event.Info.MessageSource.Chat
+        await main.handle_history_command(client, event, chat, "hidup saya")
+        await main.handle_history_search_command(client, event, chat, "makan dulu")
+        await main.handle_history_command(client, event, chat, "")
+        await history.stop()
+
+    asyncio.run(run())
+    assert len(client.sent) == 1 and "Belum ada riwayat" in client.sent[0], client.sent
+
+@pytest.mark.parametrize("response, successes, failures", [
+    ({"status": "success", "data": {}}, 1, 0),
+    ({"status": "error", "code": 400, "message": "bad request"}, 0, 0),
+    ({"status": "error", "code": 404, "message": "not found"}, 0, 0),
+    ({"status": "error", "code": 429, "message": "too many requests"}, 0, 0),
+    ({"status": "error", "code": 503, "message": "unavailable"}, 0, 1),
+])
+def test_breaker_counts_only_server_failures(monkeypatch, response, successes, failures):
+    async def fake_query_extractor_endpoint(doc, url, media_bytes, mime_type, file_name, timeout=None):
+        return response
+
+    monkeypatch.setattr(main, "query_extractor_endpoint", fake_query_extractor_endpoint)
+    monkeypatch.setattr(main, "endpoint_health", {})
+    monkeypatch.setattr(main, "endpoint_limiters", {})
+    monkeypatch.setattr(main, "RETRY_MAX_ATTEMPTS", 0)
+    doc = main.DOCUMENT_TYPES["ktp"]
+
+    assert asyncio.run(main.query_extractor(doc, b"image", "image/jpeg", "image.jpg")) == response
+    for url in doc.endpoints:
+        health = main.get_endpoint_health(doc, url)
+        assert (health.successes, health.failures) == (successes, failures)
+        assert len(health._latencies) == successes
+        if not main.is_retryable_response(response):
+            # Respons yang tidak dialihkan hanya menyentuh endpoint pertama
+            break
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 48 * 1024])
+def test_upload_body_is_valid_base64_for_any_chunk_size(monkeypatch, chunk_size):
+    monkeypatch.setattr(main, "UPLOAD_CHUNK_SIZE", chunk_size)
+    media_bytes = bytes(range(256)) * 3 + b"xy"
+
+    async def collect():
+        return b"".join([chunk async for chunk in main.iter_base64_json_body(b"[", media_bytes, b"]")])
+
+    assert asyncio.run(collect()) == b"[" + base64.b64encode(media_bytes) + b"]"